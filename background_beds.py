@@ -0,0 +1,268 @@
+import os
+import math
+import time
+import uuid
+import random
+import logging
+import argparse
+
+logger = logging.getLogger("RedditContentFarmer.background_beds")
+
+
+def plan_background(
+    duration: int,
+    length_per_clip: int = 14,
+    music: bool = False,
+    videos_dir: str = "background_videos",
+    music_dir: str = "background_music",
+) -> dict:
+    """
+    Pick the random background video segments and music of a video\n
+    :param duration: Seconds of narration the background has to cover
+    :param length_per_clip: Length of each background video clip
+    :param music: Whether to pick background music
+    :param videos_dir: Folder with the background `.mp4` files
+    :param music_dir: Folder with the background `.mp3` files
+    :return: The background clips and music file to use
+    """
+    from moviepy.editor import VideoFileClip
+
+    num_iterations = duration // length_per_clip
+    remainder = duration % length_per_clip
+    clips = []
+    durations = {}
+    for i in range(num_iterations + 1):
+        if i == num_iterations:
+            clip_duration = remainder + 1
+        else:
+            clip_duration = length_per_clip
+
+        background_video_path = random.choice(os.listdir(videos_dir))
+        logger.debug(f"Clip {i}: {background_video_path}, Duration: {clip_duration}")
+        if background_video_path not in durations:
+            full_clip = VideoFileClip(os.path.join(videos_dir, background_video_path))
+            durations[background_video_path] = full_clip.duration
+            full_clip.close()
+        clip_start = (
+            random.randint(0, math.floor(durations[background_video_path]))
+            - clip_duration
+        )
+        clips.append(
+            {
+                "file": background_video_path,
+                "start": clip_start,
+                "duration": clip_duration,
+            }
+        )
+
+    return {
+        "clips": clips,
+        "music": random.choice(os.listdir(music_dir)) if music else None,
+    }
+
+
+def compose_background(
+    plan: dict,
+    videos_dir: str = "background_videos",
+    music_dir: str = "background_music",
+):
+    """
+    Cut and concatenate the clips of a background plan\n
+    :param plan: Background clips and music picked by plan_background
+    :param videos_dir: Folder with the background `.mp4` files
+    :param music_dir: Folder with the background `.mp3` files
+    :return: The silent background video and the music looped to its length, or None
+    """
+    from moviepy.editor import AudioFileClip, VideoFileClip, concatenate_videoclips
+    from moviepy.audio.fx.audio_loop import audio_loop
+    from moviepy.audio.fx.volumex import volumex
+
+    background_video_clips = []
+    for planned_clip in plan["clips"]:
+        full_clip = VideoFileClip(os.path.join(videos_dir, planned_clip["file"]))
+        clip = full_clip.subclip(
+            planned_clip["start"], planned_clip["start"] + planned_clip["duration"]
+        ).without_audio()
+        background_video_clips.append(clip)
+    video = concatenate_videoclips(background_video_clips, method="compose")
+
+    music = None
+    if plan["music"]:
+        music = volumex(AudioFileClip(os.path.join(music_dir, plan["music"])), 0.1)
+        music = audio_loop(music, duration=video.duration)
+    return video, music
+
+
+class BedPool:
+    """
+    Pool of pre-rendered background tracks ("beds") at standard lengths\n
+    Beds are rendered while the machine is idle, so making a video only has to
+    trim one to the narration and overlay the title card and subtitles
+    """
+
+    def __init__(
+        self,
+        pool_dir: str = "background_beds",
+        lengths=(60, 90, 180, 300),
+        target: int = 2,
+        length_per_clip: int = 14,
+        music: bool = False,
+        fps: int = 30,
+        videos_dir: str = "background_videos",
+        music_dir: str = "background_music",
+    ):
+        """
+        Initialize the pool\n
+        :param pool_dir: Folder the beds are kept in
+        :param lengths: Standard lengths of the beds in seconds
+        :param target: Number of beds to keep ready for every length
+        :param length_per_clip: Length of each background video clip in a bed
+        :param music: Whether the beds have background music mixed in
+        :param fps: Frame rate of the beds, should match the rendered videos
+        :param videos_dir: Folder with the background `.mp4` files
+        :param music_dir: Folder with the background `.mp3` files
+        """
+        if not lengths:
+            raise ValueError("Please provide at least one bed length")
+        if target < 1:
+            raise ValueError("Target cannot be less than 1")
+
+        self.pool_dir = pool_dir
+        self.lengths = sorted(lengths)
+        self.target = target
+        self.length_per_clip = length_per_clip
+        self.music = music
+        self.fps = fps
+        self.__videos_dir = videos_dir
+        self.__music_dir = music_dir
+        for length in self.lengths:
+            os.makedirs(self.__length_dir_(length), exist_ok=True)
+
+    def available(self) -> dict:
+        """
+        Get the number of ready beds of every length
+        """
+        return {length: len(self.__beds_(length)) for length in self.lengths}
+
+    def missing(self) -> dict:
+        """
+        Get the number of beds every length is short of its target
+        """
+        return {
+            length: self.target - count
+            for length, count in self.available().items()
+            if count < self.target
+        }
+
+    def take(self, duration: float) -> str:
+        """
+        Take the shortest ready bed that covers a duration out of the pool\n
+        :param duration: Seconds the bed has to cover
+        :return: Path of the bed, which now belongs to the caller, or None if there is none
+        """
+        for length in self.lengths:
+            if length < duration:
+                continue
+            for bed in self.__beds_(length):
+                bed_path = os.path.join(self.__length_dir_(length), bed)
+                claimed_path = os.path.join(
+                    self.pool_dir, f".claimed-{uuid.uuid4().hex}.mp4"
+                )
+                try:
+                    # Renaming claims the bed, another process taking the same
+                    # bed gets FileNotFoundError
+                    os.rename(bed_path, claimed_path)
+                    # Claimed beds are cleaned up by age, which starts now
+                    os.utime(claimed_path)
+                except FileNotFoundError:
+                    continue
+                logger.debug(f"Took a {length}s background bed for {duration}s")
+                return claimed_path
+        logger.debug(f"No background bed of at least {duration}s is ready")
+        return None
+
+    def replenish(self, max_beds: int = None) -> int:
+        """
+        Render beds until every length reaches its target\n
+        :param max_beds: Maximum number of beds to render, e.g. 1 to use a short idle period
+        :return: Number of beds rendered
+        """
+        self.__remove_leftovers_()
+        rendered = 0
+        while max_beds is None or rendered < max_beds:
+            missing = self.missing()
+            if not missing:
+                break
+            # The length furthest below its target goes first
+            length = max(missing, key=lambda length: (missing[length], -length))
+            self.render_bed(length)
+            rendered += 1
+        return rendered
+
+    def render_bed(self, length: int) -> str:
+        """
+        Render one bed and add it to the pool\n
+        :param length: Length of the bed in seconds
+        :return: Path of the bed
+        """
+        logger.debug(f"Rendering a {length}s background bed...")
+        plan = plan_background(
+            length,
+            self.length_per_clip,
+            self.music,
+            self.__videos_dir,
+            self.__music_dir,
+        )
+        video, music = compose_background(plan, self.__videos_dir, self.__music_dir)
+        if music is not None:
+            video = video.set_audio(music)
+        name = uuid.uuid4().hex
+        temp_path = os.path.join(self.pool_dir, f".{name}.tmp.mp4")
+        try:
+            video.write_videofile(
+                temp_path,
+                temp_audiofile=os.path.join(self.pool_dir, f".{name}.tmp.mp3"),
+                fps=self.fps,
+                audio=music is not None,
+                verbose=False,
+                logger=None,
+            )
+            # Only complete beds appear in the pool
+            bed_path = os.path.join(self.__length_dir_(length), f"{name}.mp4")
+            os.replace(temp_path, bed_path)
+        finally:
+            video.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return bed_path
+
+    def __remove_leftovers_(self, max_age: int = 6 * 3600):
+        # Beds claimed or half rendered by processes that died
+        for name in os.listdir(self.pool_dir):
+            path = os.path.join(self.pool_dir, name)
+            if not name.startswith("."):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Moved by a job taking the bed meanwhile
+                pass
+
+    def __beds_(self, length: int) -> list:
+        beds = os.listdir(self.__length_dir_(length))
+        return sorted(bed for bed in beds if bed.endswith(".mp4"))
+
+    def __length_dir_(self, length: int) -> str:
+        return os.path.join(self.pool_dir, f"{length}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill the background bed pool")
+    parser.add_argument("--pool-dir", default="background_beds")
+    parser.add_argument("--target", type=int, default=2)
+    parser.add_argument("--music", action="store_true")
+    args = parser.parse_args()
+
+    pool = BedPool(args.pool_dir, target=args.target, music=args.music)
+    print(f"Rendered {pool.replenish()} beds, ready: {pool.available()}")
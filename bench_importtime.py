@@ -0,0 +1,122 @@
+"""
+Measures how long it takes to import the modules of this project using `python -X importtime`
+
+Usage:
+    python bench_importtime.py                          # print import times
+    python bench_importtime.py --save before.json       # save them for later
+    python bench_importtime.py --compare before.json    # show the savings since then
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+MODULES = [
+    "main",
+    "redditcontentfarmer",
+    "speechify_narration",
+    "tiktok_uploader",
+    "daemon",
+]
+
+
+def import_times(code: str) -> dict:
+    """
+    Run code in a fresh interpreter and return the cumulative time of the top two levels of imports\n
+    :param code: Python code to run
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise ValueError(f"Could not run `{code}`:\n{result.stderr.strip()}")
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        # Nested imports are indented by two spaces per level and are already
+        # included in the cumulative time of their parent
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > 1 or not name.strip():
+            continue
+        imports[name.strip()] = (depth, int(cumulative_us))
+    return imports
+
+
+def measure_import(module: str, startup: set) -> dict:
+    """
+    Import a module in a fresh interpreter and return the import times in microseconds\n
+    :param module: Name of the module to import
+    :param startup: Modules imported by the interpreter itself, which are not counted
+    """
+    imports = {
+        name: timing
+        for name, timing in import_times(f"import {module}").items()
+        if name not in startup
+    }
+    total = sum(
+        cumulative_us for depth, cumulative_us in imports.values() if depth == 0
+    )
+    return {
+        "total_us": total,
+        "imports": {name: timing[1] for name, timing in imports.items()},
+    }
+
+
+def benchmark(modules: list, runs: int) -> dict:
+    """
+    Measure every module several times and keep the median\n
+    :param modules: Names of the modules to import
+    :param runs: Number of fresh interpreters to start per module
+    """
+    startup = set(import_times("pass"))
+    results = {}
+    for module in modules:
+        samples = [measure_import(module, startup) for _ in range(runs)]
+        median = statistics.median(sample["total_us"] for sample in samples)
+        # Report the breakdown of the run closest to the median
+        closest = min(samples, key=lambda sample: abs(sample["total_us"] - median))
+        results[module] = {"total_us": median, "imports": closest["imports"]}
+    return results
+
+
+def print_results(results: dict, baseline: dict = None, top: int = 5):
+    for module, result in results.items():
+        line = f"{module:<24} {result['total_us'] / 1000:>9.1f} ms"
+        if baseline and module in baseline:
+            before = baseline[module]["total_us"]
+            saved = before - result["total_us"]
+            line += f"   (was {before / 1000:.1f} ms, saved {saved / 1000:.1f} ms)"
+        print(line)
+        heaviest = sorted(
+            result["imports"].items(), key=lambda item: item[1], reverse=True
+        )
+        for name, cumulative_us in heaviest[:top]:
+            print(f"    {name:<20} {cumulative_us / 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="Save the results to a JSON file")
+    parser.add_argument("--compare", help="Compare against results saved earlier")
+    args = parser.parse_args()
+
+    results = benchmark(args.modules, args.runs)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
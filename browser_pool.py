@@ -0,0 +1,363 @@
+import os
+import time
+import logging
+import threading
+import contextlib
+import browser_processes
+from metrics import REGISTRY
+
+logger = logging.getLogger("RedditContentFarmer.browser_pool")
+
+LEASES = REGISTRY.counter(
+    "rcf_browser_leases_total",
+    "Browsers lent out by whether they were reused or launched",
+    ["source"],
+)
+LEASE_WAIT_SECONDS = REGISTRY.histogram(
+    "rcf_browser_lease_wait_seconds",
+    "Seconds spent waiting for a browser, launch included",
+    buckets=(0.01, 0.1, 1, 5, 10, 30, 60, 120, 300),
+)
+RETIRED = REGISTRY.counter(
+    "rcf_browsers_retired_total", "Browsers shut down by reason", ["reason"]
+)
+
+_del_patched = False
+_del_lock = threading.Lock()
+
+
+def suppress_exception_in_del(uc):
+    """
+    Silence the errors uc.Chrome raises when it is garbage collected after it was killed,
+    patching the class only once however often it is called\n
+    :param uc: The undetected_chromedriver module
+    """
+    global _del_patched
+    with _del_lock:
+        if _del_patched:
+            return
+        old_del = uc.Chrome.__del__
+
+        def new_del(self) -> None:
+            try:
+                old_del(self)
+            except:
+                pass
+
+        setattr(uc.Chrome, "__del__", new_del)
+        _del_patched = True
+
+
+class PooledBrowser:
+    """
+    A browser of the pool and what it was used for
+    """
+
+    def __init__(self, driver, pids: list, profile_dir: str, performance_logs: bool):
+        """
+        :param driver: The uc.Chrome instance
+        :param pids: Process ids of its chromedriver and chrome processes
+        :param profile_dir: Chrome profile folder it was started with, or None
+        :param performance_logs: Whether it records the performance log
+        """
+        self.driver = driver
+        self.pids = pids
+        self.key = (profile_dir, performance_logs)
+        self.uses = 0
+        self.created_at = time.monotonic()
+        self.idle_since = self.created_at
+
+    @property
+    def profile_dir(self) -> str:
+        return self.key[0]
+
+    def rss_mb(self) -> float:
+        """
+        Get the resident memory of the browser's process trees in megabytes
+        """
+        return sum(browser_processes.tree_rss_mb(pid) for pid in self.pids)
+
+    def is_healthy(self) -> bool:
+        """
+        Check that the browser's processes are alive and that it still answers
+        """
+        if not all(os.path.exists(f"/proc/{pid}") for pid in self.pids):
+            return False
+        try:
+            # Uploads may have left the driver inside an iframe
+            self.driver.switch_to.default_content()
+            return self.driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+
+class BrowserPool:
+    """
+    Headless Chrome instances shared by the narration and upload modules\n
+    Browsers are reused between jobs, at most max_browsers run at once, and a browser
+    is replaced once it has been used max_uses times or grows past max_rss_mb.
+    Only the process trees of the pool's own browsers are ever killed
+    """
+
+    def __init__(
+        self,
+        max_browsers: int = 4,
+        max_uses: int = 20,
+        max_rss_mb: float = 1500,
+        max_idle_seconds: float = 600,
+    ):
+        """
+        Initialize the pool, browsers are only started when they are first needed\n
+        :param max_browsers: Maximum number of browsers running at the same time
+        :param max_uses: Number of leases after which a browser is replaced
+        :param max_rss_mb: Resident memory of a browser's processes after which it is replaced
+        :param max_idle_seconds: Seconds an unused browser is kept running
+        """
+        if max_browsers < 1:
+            raise ValueError("Max browsers cannot be less than 1")
+        if max_uses < 1:
+            raise ValueError("Max uses cannot be less than 1")
+
+        self.max_browsers = max_browsers
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self.max_idle_seconds = max_idle_seconds
+        self.__idle = []
+        self.__busy = []
+        self.__launching = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__stats = {
+            "launched": 0,
+            "reused": 0,
+            "retired": {},
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+        gauge = REGISTRY.gauge(
+            "rcf_browser_pool_browsers", "Browsers in the pool by state", ["state"]
+        )
+        gauge.set_function(lambda: len(self.__idle), state="idle")
+        gauge.set_function(lambda: len(self.__busy), state="busy")
+
+    @contextlib.contextmanager
+    def lease(
+        self,
+        profile_dir: str = None,
+        performance_logs: bool = False,
+        timeout: float = 900,
+    ):
+        """
+        Borrow a healthy browser for the duration of a with block\n
+        A browser whose block raises is shut down instead of being returned to the pool
+        :param profile_dir: Chrome profile folder to keep cookies in, or None for a fresh profile
+        :param performance_logs: Whether the browser has to record the performance log
+        :param timeout: Maximum seconds to wait for a browser
+        """
+        if profile_dir:
+            profile_dir = os.path.abspath(profile_dir)
+        browser = self.__acquire_((profile_dir, performance_logs), timeout)
+        try:
+            yield browser.driver
+        except BaseException:
+            self.__retire_(browser, "failed")
+            raise
+        self.__release_(browser)
+
+    def trim(self) -> int:
+        """
+        Shut down the browsers that have been unused for longer than max_idle_seconds\n
+        :return: Number of browsers shut down
+        """
+        now = time.monotonic()
+        with self.__condition:
+            expired = [
+                browser
+                for browser in self.__idle
+                if now - browser.idle_since > self.max_idle_seconds
+            ]
+            for browser in expired:
+                self.__idle.remove(browser)
+        for browser in expired:
+            self.__retire_(browser, "idle")
+        return len(expired)
+
+    def stats(self) -> dict:
+        """
+        Get the usage of the pool, e.g. to size max_browsers for a host
+        """
+        with self.__condition:
+            stats = dict(self.__stats, retired=dict(self.__stats["retired"]))
+            stats["idle"] = len(self.__idle)
+            stats["busy"] = len(self.__busy)
+        waits = stats["waits"]
+        stats["mean_wait_seconds"] = stats["wait_seconds"] / waits if waits else 0
+        return stats
+
+    def close(self):
+        """
+        Shut down every idle browser and refuse new leases, busy browsers are shut
+        down when they are returned
+        """
+        with self.__condition:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__condition.notify_all()
+        for browser in idle:
+            self.__retire_(browser, "closed")
+        logger.debug(f"Browser pool closed: {self.stats()}")
+
+    def __acquire_(self, key: tuple, timeout: float) -> PooledBrowser:
+        self.trim()
+        start = time.monotonic()
+        evicted = None
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise ValueError("The browser pool is closed")
+                browser = next(
+                    (browser for browser in self.__idle if browser.key == key), None
+                )
+                if browser:
+                    self.__idle.remove(browser)
+                    break
+                # Chrome locks its profile folder, so only one browser may use it
+                profile_in_use = key[0] and any(
+                    browser.profile_dir == key[0]
+                    for browser in self.__idle + self.__busy
+                )
+                running = len(self.__idle) + len(self.__busy) + self.__launching
+                if not profile_in_use and running < self.max_browsers:
+                    self.__launching += 1
+                    break
+                if not profile_in_use and self.__idle:
+                    # Make room by replacing the browser unused for the longest
+                    evicted = min(self.__idle, key=lambda browser: browser.idle_since)
+                    self.__idle.remove(evicted)
+                    self.__launching += 1
+                    break
+                if timeout is None:
+                    self.__condition.wait()
+                    continue
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a browser from the pool")
+                self.__condition.wait(remaining)
+            if browser:
+                self.__busy.append(browser)
+        if evicted:
+            self.__retire_(evicted, "evicted")
+
+        if browser and not browser.is_healthy():
+            logger.debug("Pooled browser is unhealthy, replacing it")
+            # Its slot is handed over to the replacement
+            with self.__condition:
+                self.__busy.remove(browser)
+                self.__launching += 1
+            self.__retire_(browser, "unhealthy")
+            browser = None
+        source = "reused"
+        if not browser:
+            source = "launched"
+            try:
+                browser = self.__launch_(*key)
+            finally:
+                with self.__condition:
+                    self.__launching -= 1
+                    if browser:
+                        self.__busy.append(browser)
+                    self.__condition.notify_all()
+
+        browser.uses += 1
+        waited = time.monotonic() - start
+        with self.__condition:
+            self.__stats[source] += 1
+            self.__stats["waits"] += 1
+            self.__stats["wait_seconds"] += waited
+            self.__stats["max_wait_seconds"] = max(
+                self.__stats["max_wait_seconds"], waited
+            )
+        LEASES.inc(source=source)
+        LEASE_WAIT_SECONDS.observe(waited)
+        return browser
+
+    def __release_(self, browser: PooledBrowser):
+        reason = None
+        if browser.uses >= self.max_uses:
+            reason = "uses"
+        elif self.max_rss_mb and browser.rss_mb() > self.max_rss_mb:
+            reason = "rss"
+        with self.__condition:
+            self.__busy.remove(browser)
+            if not reason and not self.__closed:
+                browser.idle_since = time.monotonic()
+                self.__idle.append(browser)
+            self.__condition.notify_all()
+        if reason or self.__closed:
+            self.__retire_(browser, reason or "closed")
+
+    def __retire_(self, browser: PooledBrowser, reason: str):
+        with self.__condition:
+            if browser in self.__busy:
+                self.__busy.remove(browser)
+            retired = self.__stats["retired"]
+            retired[reason] = retired.get(reason, 0) + 1
+            self.__condition.notify_all()
+        RETIRED.inc(reason=reason)
+        logger.debug(
+            f"Shutting down browser after {browser.uses} uses, reason: {reason}"
+        )
+        if reason not in ("failed", "unhealthy"):
+            try:
+                browser.driver.quit()
+            except Exception:
+                pass
+        # Only the trees of this browser, other Chrome processes are left alone
+        for pid in browser.pids:
+            browser_processes.kill_tree(pid)
+
+    def __launch_(self, profile_dir: str, performance_logs: bool) -> PooledBrowser:
+        # Imported here so that importing this module does not load selenium
+        import undetected_chromedriver as uc
+
+        suppress_exception_in_del(uc)
+        options = uc.ChromeOptions()
+        options.add_argument("--headless=new")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        if performance_logs:
+            options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        if profile_dir:
+            driver = uc.Chrome(options=options, user_data_dir=profile_dir)
+        else:
+            driver = uc.Chrome(options=options)
+        pids = browser_processes.track_driver(driver)
+        logger.debug(f"Launched browser {pids}")
+        return PooledBrowser(driver, pids, profile_dir, performance_logs)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool() -> BrowserPool:
+    """
+    Get the browser pool shared by every module of this process
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = BrowserPool()
+        return _shared_pool
+
+
+def close_shared_pool():
+    """
+    Shut down the browsers of the shared pool, a later lease starts a new pool
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        pool, _shared_pool = _shared_pool, None
+    if pool:
+        pool.close()
@@ -0,0 +1,154 @@
+import os
+import signal
+import threading
+from metrics import REGISTRY
+
+# Process ids of the browsers and drivers started by this Python process,
+# mapped to the thread that started them
+_tracked = {}
+_lock = threading.Lock()
+
+
+def track(pid: int) -> None:
+    """
+    Remember a process started by this process so it can be cleaned up later\n
+    :param pid: Process id to track
+    """
+    if pid:
+        with _lock:
+            _tracked[pid] = threading.get_ident()
+
+
+def untrack(pid: int) -> None:
+    """
+    Forget a process that has already exited or been cleaned up\n
+    :param pid: Process id to forget
+    """
+    with _lock:
+        _tracked.pop(pid, None)
+
+
+def tracked(current_thread_only: bool = False) -> list:
+    """
+    Get the process ids that are currently tracked\n
+    :param current_thread_only: Only return processes started by the calling thread
+    """
+    with _lock:
+        if current_thread_only:
+            thread = threading.get_ident()
+            return sorted(pid for pid, owner in _tracked.items() if owner == thread)
+        return sorted(_tracked)
+
+
+def track_driver(driver) -> list:
+    """
+    Track the chromedriver and chrome processes of an undetected_chromedriver instance\n
+    :param driver: The uc.Chrome instance
+    """
+    pids = []
+    service = getattr(driver, "service", None)
+    process = getattr(service, "process", None)
+    if process is not None:
+        pids.append(process.pid)
+    browser_pid = getattr(driver, "browser_pid", None)
+    if browser_pid:
+        pids.append(browser_pid)
+    for pid in pids:
+        track(pid)
+    return pids
+
+
+def children(pid: int) -> list:
+    """
+    Get the direct children of a process (Linux only)\n
+    :param pid: Process id of the parent
+    """
+    result = []
+    task_dir = f"/proc/{pid}/task"
+    if not os.path.isdir(task_dir):
+        return result
+    for task in os.listdir(task_dir):
+        try:
+            with open(f"{task_dir}/{task}/children", "r") as file:
+                result += [int(child) for child in file.read().split()]
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return result
+
+
+def descendants(pid: int) -> list:
+    """
+    Get a process and all of its descendants, parents first\n
+    :param pid: Process id of the root of the tree
+    """
+    result = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        if current in result:
+            continue
+        result.append(current)
+        pending += children(current)
+    return result
+
+
+def kill_tree(pid: int) -> None:
+    """
+    Kill a process and all of its descendants\n
+    :param pid: Process id of the root of the tree
+    """
+    # Collect the whole tree before killing anything, so that orphaned
+    # children are not reparented out of reach
+    for current in descendants(pid):
+        try:
+            os.kill(current, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    untrack(pid)
+
+
+def kill_tracked(current_thread_only: bool = False) -> list:
+    """
+    Kill every tracked process tree and return the ids of their roots\n
+    :param current_thread_only: Only kill processes started by the calling thread
+    """
+    pids = tracked(current_thread_only)
+    for pid in pids:
+        kill_tree(pid)
+    return pids
+
+
+def tree_rss_mb(pid: int) -> float:
+    """
+    Get the resident memory of a process and all of its descendants in megabytes (Linux only)\n
+    :param pid: Process id of the root of the tree
+    """
+    total = 0
+    for current in descendants(pid):
+        try:
+            with open(f"/proc/{current}/status", "r") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        # In kilobytes
+                        total += int(line.split()[1])
+                        break
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total / 1024
+
+
+def count_running() -> int:
+    """
+    Get the number of live processes in the tracked process trees
+    """
+    return sum(
+        1
+        for root in tracked()
+        for pid in descendants(root)
+        if os.path.exists(f"/proc/{pid}")
+    )
+
+
+REGISTRY.gauge(
+    "rcf_browser_processes", "Live browser and driver processes started by this process"
+).set_function(count_running)
@@ -0,0 +1,576 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from typing import Literal
+from metrics import REGISTRY
+from pipeline import hash_file
+from sqlite_transaction import Transaction
+
+logger = logging.getLogger("RedditContentFarmer.cache_manager")
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "rcf_cache_lookups_total", "Cache lookups by namespace", ["namespace", "result"]
+)
+
+
+class CacheManager:
+    """
+    Disk cache shared by every subsystem and every worker process, kept within byte budgets\n
+    Every subsystem registers a namespace with its own budget. An entry is a folder
+    of files that is written atomically, and the index of entries lives in a
+    SQLite file next to them so processes sharing the folder agree on what is cached
+    """
+
+    def __init__(
+        self,
+        root: str = "cache",
+        max_bytes: int = None,
+        policy: Literal["lru", "size"] = "lru",
+        min_age: int = 60,
+    ):
+        """
+        Open the cache, creating its folder and index if needed\n
+        :param root: Folder holding the cached files and their index
+        :param max_bytes: Budget of all namespaces together, keeps the last saved budget if not set
+        :param policy: `lru` evicts the least recently used entries first, `size` the largest
+        :param min_age: Entries used within this many seconds are never evicted, so
+            another process can finish reading them
+        """
+        if policy not in ("lru", "size"):
+            raise ValueError("Policy must be `lru` or `size`")
+
+        self.root = root
+        self.policy = policy
+        self.min_age = min_age
+        self.__local = threading.local()
+        self.__temp_dir = os.path.join(root, ".tmp")
+        os.makedirs(self.__temp_dir, exist_ok=True)
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    files TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS namespaces (
+                    namespace TEXT PRIMARY KEY,
+                    max_bytes INTEGER,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0,
+                    writes INTEGER NOT NULL DEFAULT 0,
+                    bytes_written INTEGER NOT NULL DEFAULT 0,
+                    evictions INTEGER NOT NULL DEFAULT 0,
+                    corrupt INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)"
+            )
+            if max_bytes is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO settings VALUES ('max_bytes', ?)",
+                    (max_bytes,),
+                )
+
+    @property
+    def max_bytes(self) -> int:
+        """
+        Budget of all namespaces together, None if unlimited
+        """
+        with self.__connect_() as connection:
+            row = connection.execute(
+                "SELECT value FROM settings WHERE name = 'max_bytes'"
+            ).fetchone()
+        return row[0] if row else None
+
+    def register(self, namespace: str, max_bytes: int = None) -> "CacheNamespace":
+        """
+        Register a subsystem's namespace\n
+        :param namespace: Name of the namespace, e.g. `narration`
+        :param max_bytes: Budget of the namespace, only the global budget applies if not set
+        """
+        if not namespace or namespace.startswith(".") or os.sep in namespace:
+            raise ValueError(f"Invalid cache namespace: {namespace}")
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR IGNORE INTO namespaces (namespace) VALUES (?)",
+                (namespace,),
+            )
+            connection.execute(
+                "UPDATE namespaces SET max_bytes = ? WHERE namespace = ?",
+                (max_bytes, namespace),
+            )
+        os.makedirs(os.path.join(self.root, namespace), exist_ok=True)
+        return CacheNamespace(self, namespace)
+
+    def namespaces(self) -> list:
+        """
+        Get the names of the registered namespaces
+        """
+        with self.__connect_() as connection:
+            rows = connection.execute(
+                "SELECT namespace FROM namespaces ORDER BY namespace"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self, namespace: str = None) -> dict:
+        """
+        Get the metrics of every namespace, or of one\n
+        :param namespace: Name of the namespace, all namespaces if not set
+        :return: Namespaces mapped to their entries, bytes, budget, hits, misses,
+            hit rate, writes, bytes written, evictions and corrupt entries
+        """
+        query = """
+            SELECT n.namespace, n.max_bytes, n.hits, n.misses, n.writes,
+                n.bytes_written, n.evictions, n.corrupt,
+                COUNT(e.key), COALESCE(SUM(e.size), 0)
+            FROM namespaces n LEFT JOIN entries e ON e.namespace = n.namespace
+        """
+        params = ()
+        if namespace:
+            query += " WHERE n.namespace = ?"
+            params = (namespace,)
+        query += " GROUP BY n.namespace ORDER BY n.namespace"
+        with self.__connect_() as connection:
+            rows = connection.execute(query, params).fetchall()
+        stats = {}
+        for row in rows:
+            name, max_bytes, hits, misses, writes, written, evictions, corrupt = row[:8]
+            lookups = hits + misses
+            stats[name] = {
+                "entries": row[8],
+                "bytes": row[9],
+                "max_bytes": max_bytes,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "writes": writes,
+                "bytes_written": written,
+                "evictions": evictions,
+                "corrupt": corrupt,
+            }
+        return stats
+
+    def prune(self, namespace: str = None) -> int:
+        """
+        Evict entries until every budget is met and delete files missing from the index\n
+        :param namespace: Name of the namespace to prune, all namespaces if not set
+        :return: Number of entries and stray folders deleted
+        """
+        removed = 0
+        for name in [namespace] if namespace else self.namespaces():
+            removed += self.evict(name)
+        removed += self.__remove_strays_(namespace)
+        return removed
+
+    def clear(self, namespace: str = None) -> int:
+        """
+        Delete every entry\n
+        :param namespace: Name of the namespace to clear, all namespaces if not set
+        :return: Number of entries deleted
+        """
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if namespace:
+                rows = connection.execute(
+                    "SELECT namespace, key FROM entries WHERE namespace = ?",
+                    (namespace,),
+                ).fetchall()
+                connection.execute(
+                    "DELETE FROM entries WHERE namespace = ?", (namespace,)
+                )
+            else:
+                rows = connection.execute(
+                    "SELECT namespace, key FROM entries"
+                ).fetchall()
+                connection.execute("DELETE FROM entries")
+        for name, key in rows:
+            self.__remove_folder_(self.entry_dir(name, key))
+        return len(rows)
+
+    def verify(self, namespace: str = None) -> int:
+        """
+        Check the checksum of every cached file and delete the entries that do not match\n
+        :param namespace: Name of the namespace to check, all namespaces if not set
+        :return: Number of corrupt entries deleted
+        """
+        query = "SELECT namespace, key, files FROM entries"
+        params = ()
+        if namespace:
+            query += " WHERE namespace = ?"
+            params = (namespace,)
+        with self.__connect_() as connection:
+            rows = connection.execute(query, params).fetchall()
+        corrupt = 0
+        for name, key, files in rows:
+            if not self.check(name, key, json.loads(files), checksums=True):
+                self.discard(name, key, corrupt=True)
+                corrupt += 1
+        return corrupt
+
+    def entry_dir(self, namespace: str, key: str) -> str:
+        """
+        Get the folder of an entry\n
+        :param namespace: Name of the namespace
+        :param key: Key of the entry
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, namespace, digest[:2], digest)
+
+    def lookup(self, namespace: str, key: str, checksums: bool = False) -> str:
+        """
+        Get the folder of a cached entry and mark it as used, or None on a miss\n
+        :param namespace: Name of the namespace
+        :param key: Key of the entry
+        :param checksums: Whether to check the checksums of the files, otherwise only their sizes
+        """
+        with self.__connect_() as connection:
+            row = connection.execute(
+                "SELECT files FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        if row and not self.check(namespace, key, json.loads(row[0]), checksums):
+            logger.debug(f"Cache entry {namespace}/{key} is corrupt, discarding it")
+            self.discard(namespace, key, corrupt=True)
+            row = None
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if row:
+                connection.execute(
+                    """
+                    UPDATE entries SET accessed_at = ?
+                    WHERE namespace = ? AND key = ?
+                    """,
+                    (time.time(), namespace, key),
+                )
+            connection.execute(
+                f"""
+                UPDATE namespaces SET {"hits" if row else "misses"} =
+                    {"hits" if row else "misses"} + 1
+                WHERE namespace = ?
+                """,
+                (namespace,),
+            )
+        CACHE_LOOKUPS.inc(namespace=namespace, result="hit" if row else "miss")
+        return self.entry_dir(namespace, key) if row else None
+
+    def store(self, namespace: str, key: str, files: dict) -> str:
+        """
+        Add an entry atomically and evict entries that no longer fit in the budgets\n
+        :param namespace: Name of the namespace
+        :param key: Key of the entry
+        :param files: File names mapped to the path of the file to copy or to its bytes
+        :return: The folder of the entry
+        """
+        # The files are written to a temporary folder on the same filesystem and
+        # renamed into place, so readers never see a partially written entry
+        temp_dir = os.path.join(self.__temp_dir, uuid.uuid4().hex)
+        os.makedirs(temp_dir)
+        checksums = {}
+        try:
+            for name, source in files.items():
+                path = os.path.join(temp_dir, name)
+                if isinstance(source, (bytes, bytearray)):
+                    with open(path, "wb") as file:
+                        file.write(source)
+                else:
+                    shutil.copyfile(source, path)
+                checksums[name] = {
+                    "size": os.path.getsize(path),
+                    "sha256": hash_file(path),
+                }
+            entry_dir = self.entry_dir(namespace, key)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            if os.path.exists(entry_dir):
+                # Replaced entries are moved aside first since a folder cannot
+                # be renamed over a folder that is not empty
+                self.__remove_folder_(entry_dir)
+            try:
+                os.rename(temp_dir, entry_dir)
+            except OSError:
+                # Another process stored the same entry in the meantime
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return entry_dir
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        size = sum(checksum["size"] for checksum in checksums.values())
+        now = time.time()
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(checksums), size, now, now),
+            )
+            connection.execute(
+                """
+                UPDATE namespaces SET writes = writes + 1,
+                    bytes_written = bytes_written + ?
+                WHERE namespace = ?
+                """,
+                (size, namespace),
+            )
+        self.evict(namespace)
+        return entry_dir
+
+    def discard(self, namespace: str, key: str, corrupt: bool = False):
+        """
+        Delete an entry\n
+        :param namespace: Name of the namespace
+        :param key: Key of the entry
+        :param corrupt: Whether the entry is deleted because it is corrupt
+        """
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            )
+            if corrupt:
+                connection.execute(
+                    "UPDATE namespaces SET corrupt = corrupt + 1 WHERE namespace = ?",
+                    (namespace,),
+                )
+        self.__remove_folder_(self.entry_dir(namespace, key))
+
+    def check(
+        self, namespace: str, key: str, files: dict, checksums: bool = False
+    ) -> bool:
+        """
+        Check that the files of an entry are intact\n
+        :param namespace: Name of the namespace
+        :param key: Key of the entry
+        :param files: File names mapped to their recorded size and sha256
+        :param checksums: Whether to check the checksums, otherwise only the sizes
+        """
+        entry_dir = self.entry_dir(namespace, key)
+        for name, checksum in files.items():
+            path = os.path.join(entry_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) != checksum["size"]:
+                return False
+            if checksums and hash_file(path) != checksum["sha256"]:
+                return False
+        return True
+
+    def evict(self, namespace: str) -> int:
+        """
+        Evict entries until the namespace and the whole cache fit in their budgets\n
+        :param namespace: Name of the namespace that grew
+        :return: Number of entries evicted
+        """
+        if self.policy == "lru":
+            order = "accessed_at ASC"
+        else:
+            order = "size DESC, accessed_at ASC"
+        cutoff = time.time() - self.min_age
+        evicted = []
+        with self.__connect_() as connection:
+            # Locks the index so two processes do not evict for the same overflow
+            connection.execute("BEGIN IMMEDIATE")
+            budgets = [
+                (
+                    "WHERE namespace = ?",
+                    (namespace,),
+                    connection.execute(
+                        "SELECT max_bytes FROM namespaces WHERE namespace = ?",
+                        (namespace,),
+                    ).fetchone(),
+                ),
+                (
+                    "",
+                    (),
+                    connection.execute(
+                        "SELECT value FROM settings WHERE name = 'max_bytes'"
+                    ).fetchone(),
+                ),
+            ]
+            for where, params, budget in budgets:
+                if not budget or budget[0] is None:
+                    continue
+                total = connection.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM entries {where}", params
+                ).fetchone()[0]
+                if total <= budget[0]:
+                    continue
+                candidates = connection.execute(
+                    f"""
+                    SELECT namespace, key, size FROM entries
+                    {where} {"AND" if where else "WHERE"} accessed_at < ?
+                    ORDER BY {order}
+                    """,
+                    params + (cutoff,),
+                ).fetchall()
+                for name, key, size in candidates:
+                    if total <= budget[0]:
+                        break
+                    connection.execute(
+                        "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                        (name, key),
+                    )
+                    connection.execute(
+                        """
+                        UPDATE namespaces SET evictions = evictions + 1
+                        WHERE namespace = ?
+                        """,
+                        (name,),
+                    )
+                    evicted.append((name, key))
+                    total -= size
+        for name, key in evicted:
+            self.__remove_folder_(self.entry_dir(name, key))
+        if evicted:
+            logger.debug(f"Evicted {len(evicted)} cache entries")
+        return len(evicted)
+
+    def __remove_strays_(self, namespace: str = None) -> int:
+        """
+        Delete entry folders missing from the index, e.g. left by a process that died
+        """
+        with self.__connect_() as connection:
+            indexed = {
+                self.entry_dir(name, key)
+                for name, key in connection.execute(
+                    "SELECT namespace, key FROM entries"
+                ).fetchall()
+            }
+        cutoff = time.time() - self.min_age
+        removed = 0
+        for name in [namespace] if namespace else self.namespaces():
+            namespace_dir = os.path.join(self.root, name)
+            if not os.path.isdir(namespace_dir):
+                continue
+            for prefix in os.listdir(namespace_dir):
+                prefix_dir = os.path.join(namespace_dir, prefix)
+                for digest in os.listdir(prefix_dir):
+                    entry_dir = os.path.join(prefix_dir, digest)
+                    # Recent folders may belong to an entry being stored
+                    if entry_dir in indexed or os.path.getmtime(entry_dir) > cutoff:
+                        continue
+                    self.__remove_folder_(entry_dir)
+                    removed += 1
+        for name in os.listdir(self.__temp_dir):
+            temp_path = os.path.join(self.__temp_dir, name)
+            if os.path.getmtime(temp_path) < cutoff:
+                shutil.rmtree(temp_path, ignore_errors=True)
+        return removed
+
+    def __remove_folder_(self, path: str):
+        # Renamed away first so other processes never see a half deleted entry
+        trash = os.path.join(self.__temp_dir, uuid.uuid4().hex)
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def __connect_(self) -> Transaction:
+        # One connection per thread, SQLite connections cannot be shared
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                os.path.join(self.root, "index.sqlite"),
+                timeout=30,
+                isolation_level=None,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.__local.connection = connection
+        return Transaction(connection)
+
+
+class CacheNamespace:
+    """
+    The part of the cache that belongs to one subsystem
+    """
+
+    def __init__(self, manager: CacheManager, namespace: str):
+        self.manager = manager
+        self.namespace = namespace
+
+    def get(self, key: str, checksums: bool = False) -> str:
+        """
+        Get the folder of a cached entry, or None on a miss\n
+        :param key: Key of the entry
+        :param checksums: Whether to check the checksums of the files, otherwise only their sizes
+        """
+        return self.manager.lookup(self.namespace, key, checksums)
+
+    def put(self, key: str, files: dict) -> str:
+        """
+        Add an entry, replacing any entry with the same key\n
+        :param key: Key of the entry
+        :param files: File names mapped to the path of the file to copy or to its bytes
+        :return: The folder of the entry
+        """
+        return self.manager.store(self.namespace, key, files)
+
+    def discard(self, key: str):
+        """
+        Delete an entry\n
+        :param key: Key of the entry
+        """
+        self.manager.discard(self.namespace, key)
+
+    def stats(self) -> dict:
+        """
+        Get the metrics of the namespace
+        """
+        return self.manager.stats(self.namespace).get(self.namespace, {})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and prune the cache")
+    parser.add_argument("command", choices=["stats", "prune", "verify", "clear"])
+    parser.add_argument("--root", default="cache", help="Folder of the cache")
+    parser.add_argument("--namespace", help="Only act on this namespace")
+    parser.add_argument(
+        "--max-bytes", type=int, help="Set the budget of all namespaces together"
+    )
+    args = parser.parse_args()
+
+    cache = CacheManager(args.root, max_bytes=args.max_bytes)
+    if args.command == "prune":
+        print(f"Deleted {cache.prune(args.namespace)} entries")
+    elif args.command == "verify":
+        print(f"Deleted {cache.verify(args.namespace)} corrupt entries")
+    elif args.command == "clear":
+        print(f"Deleted {cache.clear(args.namespace)} entries")
+
+    stats = cache.stats(args.namespace)
+    total = sum(namespace["bytes"] for namespace in stats.values())
+    print(f"{'namespace':<16}{'entries':>9}{'MB':>10}{'budget MB':>11}", end="")
+    print(f"{'hit rate':>10}{'evictions':>11}{'corrupt':>9}")
+    for name, namespace in stats.items():
+        budget = namespace["max_bytes"]
+        hit_rate = namespace["hit_rate"]
+        print(
+            f"{name:<16}{namespace['entries']:>9}"
+            f"{namespace['bytes'] / 1e6:>10.1f}"
+            f"{budget / 1e6 if budget else float('inf'):>11.1f}"
+            f"{hit_rate if hit_rate is not None else '-':>10}"
+            f"{namespace['evictions']:>11}{namespace['corrupt']:>9}"
+        )
+    budget = cache.max_bytes
+    print(
+        f"Total: {total / 1e6:.1f} MB"
+        + (f" of {budget / 1e6:.1f} MB" if budget else "")
+    )
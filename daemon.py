@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+from typing import Callable
+from metrics import REGISTRY
+
+logger = logging.getLogger("RedditContentFarmer.daemon")
+
+JOBS = REGISTRY.counter("rcf_jobs_total", "Jobs run by the daemon", ["result"])
+
+
+class Daemon:
+    """
+    Keeps a RedditContentFarmer resident and produces videos on a schedule or from a queue
+    """
+
+    def __init__(
+        self,
+        produce: Callable[[dict], None],
+        interval: int = None,
+        queue_dir: str = None,
+        poll_interval: int = 10,
+        max_jobs: int = None,
+        cleanup: Callable[[], None] = None,
+        idle: Callable[[], bool] = None,
+    ):
+        """
+        Initialize the daemon\n
+        :param produce: Function that produces one video from a job dictionary
+        :param interval: Seconds between scheduled videos
+        :param queue_dir: Folder to watch for `.json` job files
+        :param poll_interval: Seconds between checks of the queue folder
+        :param max_jobs: Number of jobs to run before exiting, runs forever if not set
+        :param cleanup: Function called after every job, e.g. to kill leftover browsers
+        :param idle: Function that does a piece of background work while there is no
+            job to run, and returns whether there was any work to do. It runs in a
+            background thread, so jobs that come due and stop requests never wait for it
+        """
+        if interval is None and queue_dir is None:
+            raise ValueError("Please provide an interval or a queue folder")
+        if interval is not None and interval < 1:
+            raise ValueError("Interval cannot be less than 1")
+
+        self.__produce = produce
+        self.__interval = interval
+        self.__queue_dir = queue_dir
+        self.__poll_interval = poll_interval
+        self.__max_jobs = max_jobs
+        self.__cleanup = cleanup
+        self.__idle = idle
+        self.__idle_thread = None
+        self.__stopping = False
+        self.jobs_done = 0
+        self.jobs_failed = 0
+
+        if queue_dir and not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        if queue_dir:
+            REGISTRY.gauge(
+                "rcf_daemon_queue_depth", "Job files waiting in the queue folder"
+            ).set_function(self.queued)
+
+    def stop(self, *_):
+        """
+        Ask the daemon to exit once the current job has finished
+        """
+        logger.debug("Stop requested, finishing current job...")
+        self.__stopping = True
+
+    def queued(self) -> int:
+        """
+        Get the number of job files waiting in the queue folder
+        """
+        if not self.__queue_dir:
+            return 0
+        return sum(1 for file in os.listdir(self.__queue_dir) if file.endswith(".json"))
+
+    def run(self):
+        """
+        Run jobs until stopped or until max_jobs have been run
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        next_scheduled = time.monotonic()
+        while not self.__stopping and not self.__reached_max_jobs_():
+            if self.__queue_dir:
+                job_path = self.__next_queued_job_()
+                if job_path:
+                    self.__run_queued_job_(job_path)
+                    continue
+            if self.__interval is not None and time.monotonic() >= next_scheduled:
+                next_scheduled = time.monotonic() + self.__interval
+                self.__run_job_({})
+                continue
+            if self.__idle:
+                self.__start_idle_()
+            self.__sleep_(self.__poll_interval)
+        if self.__idle_thread and self.__idle_thread.is_alive():
+            # Its work is unfinished and is not waited for, e.g. a bed render
+            # that leaves a temporary file the next replenish removes
+            logger.debug("Leaving the idle work unfinished")
+        logger.debug(
+            f"Daemon exiting after {self.jobs_done} jobs ({self.jobs_failed} failed)"
+        )
+
+    def __reached_max_jobs_(self) -> bool:
+        if self.__max_jobs is None:
+            return False
+        return self.jobs_done + self.jobs_failed >= self.__max_jobs
+
+    def __start_idle_(self):
+        # Only one piece of idle work runs at a time
+        if self.__idle_thread and self.__idle_thread.is_alive():
+            return
+        self.__idle_thread = threading.Thread(
+            target=self.__run_idle_, name="daemon-idle", daemon=True
+        )
+        self.__idle_thread.start()
+
+    def __run_idle_(self) -> bool:
+        try:
+            return bool(self.__idle())
+        except Exception:
+            logger.exception("Idle work failed")
+            return False
+
+    def __sleep_(self, seconds: int):
+        # Sleep in short steps so a stop request is noticed quickly
+        end = time.monotonic() + seconds
+        while not self.__stopping and time.monotonic() < end:
+            time.sleep(min(1, end - time.monotonic()))
+
+    def __next_queued_job_(self):
+        jobs = sorted(
+            file for file in os.listdir(self.__queue_dir) if file.endswith(".json")
+        )
+        if not jobs:
+            return None
+        return os.path.join(self.__queue_dir, jobs[0])
+
+    def __run_queued_job_(self, job_path: str):
+        # Claim the job first so that other daemons watching the folder skip it
+        processing_path = job_path + ".processing"
+        try:
+            os.rename(job_path, processing_path)
+        except FileNotFoundError:
+            return
+        try:
+            with open(processing_path, "r") as file:
+                job = json.load(file)
+        except ValueError:
+            logger.exception(f"Invalid job file {job_path}")
+            os.rename(processing_path, job_path + ".failed")
+            self.jobs_failed += 1
+            JOBS.inc(result="failed")
+            return
+        succeeded = self.__run_job_(job)
+        os.rename(processing_path, job_path + (".done" if succeeded else ".failed"))
+
+    def __run_job_(self, job: dict) -> bool:
+        logger.debug(f"Running job {job}")
+        try:
+            self.__produce(job)
+        except Exception:
+            logger.exception("Job failed")
+            self.jobs_failed += 1
+            JOBS.inc(result="failed")
+            return False
+        finally:
+            if self.__cleanup:
+                self.__cleanup()
+        self.jobs_done += 1
+        JOBS.inc(result="done")
+        return True
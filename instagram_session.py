@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Callable
+from pipeline import atomic_write_json
+
+logger = logging.getLogger("RedditContentFarmer.instagram_session")
+
+
+class InstagramSessionManager:
+    """
+    Keeps one logged in instagrapi client per Instagram account
+    """
+
+    def __init__(
+        self, session_dir: str = "instagram_session", validation_ttl: int = 3600
+    ):
+        """
+        Initialize the session manager\n
+        :param session_dir: Folder where the session settings of every account are saved
+        :param validation_ttl: Seconds a session is trusted before it is checked again
+        """
+        self.__session_dir = session_dir
+        self.__validation_ttl = validation_ttl
+        self.__sessions = {}
+        self.__lock = threading.Lock()
+
+    def get_client(self, username: str, password: str):
+        """
+        Get a client for an account, logging in only if there is no valid session\n
+        :param username: Username of the Instagram account
+        :param password: Password of the Instagram account
+        """
+        if not username or not password:
+            raise ValueError("Please provide an Instagram username and password")
+
+        session = self.__get_session_(username)
+        with session["lock"]:
+            if session["client"] is None:
+                session["client"] = self.__load_client_(username, password)
+                session["validated_at"] = 0
+            if time.monotonic() - session["validated_at"] > self.__validation_ttl:
+                self.__validate_(session["client"], username, password)
+                session["validated_at"] = time.monotonic()
+            return session["client"]
+
+    def run(self, username: str, password: str, action: Callable):
+        """
+        Run an action with the account's client, logging in again once if the session expired\n
+        :param username: Username of the Instagram account
+        :param password: Password of the Instagram account
+        :param action: Function that takes the client
+        """
+        from instagrapi.exceptions import LoginRequired
+
+        client = self.get_client(username, password)
+        try:
+            return action(client)
+        except LoginRequired:
+            logger.debug(f"Session of {username} expired, logging in again...")
+            session = self.__get_session_(username)
+            with session["lock"]:
+                self.__relogin_(client, username, password)
+                session["validated_at"] = time.monotonic()
+            return action(client)
+
+    def invalidate(self, username: str):
+        """
+        Forget the in-memory client of an account so the next use loads it again\n
+        :param username: Username of the Instagram account
+        """
+        with self.__lock:
+            self.__sessions.pop(username, None)
+
+    def __get_session_(self, username: str) -> dict:
+        with self.__lock:
+            if username not in self.__sessions:
+                self.__sessions[username] = {
+                    "client": None,
+                    "validated_at": 0,
+                    "lock": threading.Lock(),
+                }
+            return self.__sessions[username]
+
+    def __session_path_(self, username: str) -> str:
+        return os.path.join(self.__session_dir, f"{username}.json")
+
+    def __load_client_(self, username: str, password: str):
+        try:
+            from instagrapi import Client
+        except ModuleNotFoundError:
+            raise ValueError(
+                "Please install instagrapi by running `pip install -r requirements.txt`"
+            ) from None
+
+        client = Client()
+        session_path = self.__session_path_(username)
+        settings = {}
+        if os.path.exists(session_path):
+            with open(session_path, "r") as file:
+                settings = json.load(file)
+        elif self.__migrate_legacy_session_(client, username, password):
+            return client
+        if settings.get("authorization_data"):
+            logger.debug(f"Loading session of {username}...")
+            client.set_settings(settings)
+            client.username = username
+            client.password = password
+        else:
+            logger.debug(f"No session found for {username}, logging in...")
+            client.login(username, password)
+            self.__save_(client, username)
+        return client
+
+    def __migrate_legacy_session_(self, client, username: str, password: str) -> bool:
+        # Sessions saved before accounts had their own file, which is shared by
+        # every account and so only used if it was logged in as this one
+        legacy_path = os.path.join(self.__session_dir, "session.json")
+        if not os.path.exists(legacy_path):
+            return False
+        with open(legacy_path, "r") as file:
+            settings = json.load(file)
+        if not settings.get("authorization_data"):
+            return False
+        client.set_settings(settings)
+        try:
+            owner = client.account_info().username
+        except Exception:
+            owner = None
+        if owner != username:
+            logger.debug(f"The legacy session is not logged in as {username}")
+            # Another account's device ids are not reused either
+            client.set_settings({})
+            return False
+        logger.debug(f"Moving the legacy session to the session of {username}...")
+        client.username = username
+        client.password = password
+        self.__save_(client, username)
+        return True
+
+    def __validate_(self, client, username: str, password: str):
+        from instagrapi.exceptions import LoginRequired
+
+        try:
+            client.get_timeline_feed()
+        except LoginRequired:
+            logger.debug(f"Session of {username} is invalid, logging in again...")
+            self.__relogin_(client, username, password)
+
+    def __relogin_(self, client, username: str, password: str):
+        from instagrapi.exceptions import LoginRequired
+
+        # Keep the device ids so Instagram sees the same device logging in again
+        old_settings = client.get_settings()
+        client.set_settings({})
+        client.set_uuids(old_settings["uuids"])
+        try:
+            client.login(username, password)
+        except LoginRequired:
+            raise ValueError("Invalid username or password.") from None
+        self.__save_(client, username)
+
+    def __save_(self, client, username: str):
+        if not os.path.exists(self.__session_dir):
+            os.makedirs(self.__session_dir)
+        atomic_write_json(self.__session_path_(username), client.get_settings())
@@ -1,8 +1,19 @@
 import os
 import random
+import argparse
+import browser_processes
 from dotenv import load_dotenv
+from daemon import Daemon
+from metrics import MetricsServer
+from background_beds import BedPool
+from near_duplicates import NearDuplicateIndex
+from pipeline import JobManifest
+from output_profiles import DEFAULT_PROFILES
+from render_planner import RenderPlanner
+from workspace import Workspace, default_scratch_root
 from redditcontentfarmer import RedditContentFarmer
 from tiktok_uploader import upload_tiktok_video
+from upload_pipeline import FinishedVideo, UploadPipeline
 
 load_dotenv()
 
@@ -16,37 +27,222 @@ subreddits = [
     "socialskills",
 ]
 narrators = ["snoop", "mrbeast", "gwyneth", "male", "female", "narrator"]
+# Every job gets a folder here with its manifest and final files
+jobs_dir = "output/jobs"
+# Whether the videos get background music
+has_music = False
+# Every video is uploaded to each of these accounts
+instagram_accounts = [
+    (os.getenv("INSTAGRAM_USERNAME"), os.getenv("INSTAGRAM_PASSWORD")),
+]
+
+
+def produce_video(
+    rcf: RedditContentFarmer,
+    uploads: UploadPipeline,
+    planner: RenderPlanner,
+    bed_pool: BedPool,
+    job: dict,
+):
+    """
+    Create one video and queue it for upload, resuming an unfinished job if there is one\n
+    :param rcf: The RedditContentFarmer to use
+    :param uploads: The upload pipeline to queue the finished video on
+    :param planner: The planner that picks the render settings
+    :param bed_pool: The pool of pre-rendered backgrounds
+    :param job: Optional overrides for `id`, `subreddit` and `narrator`
+    """
+    # Intermediate files are kept in memory when there is room for them
+    scratch_root = default_scratch_root()
+    Workspace.clean_stale(jobs_dir, scratch_root)
+    manifest = JobManifest.resume_or_create(jobs_dir, job_id=job.get("id"))
+    workspace = Workspace(manifest.job_dir, scratch_root)
+    try:
+        # Random choices are kept in the manifest so a resumed job makes the
+        # same video
+        params = manifest.params
+        params.setdefault("subreddit", job.get("subreddit", random.choice(subreddits)))
+        params.setdefault("narrator", job.get("narrator", random.choice(narrators)))
+        manifest.save()
+
+        def select_post():
+            rcf.get_posts(subreddit=params["subreddit"], word_limit=600, span="week")
+            return {"post_id": rcf.post.id}
+
+        selected = manifest.run_stage(
+            "select_post", {"subreddit": params["subreddit"]}, select_post
+        )
+        if rcf.post is None or rcf.post.id != selected["post_id"]:
+            rcf.use_post(selected["post_id"])
 
-rcf = RedditContentFarmer(
-    client_id=os.getenv("REDDIT_CLIENT_ID"),
-    client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
-    user_agent=os.getenv("REDDIT_USER_AGENT"),
-    verbose=True,
-    track_used_posts=True,
-)
+        # Predict the cost of the video before committing to it and pick the
+        # settings that make it within the target time
+        def plan_render():
+            planner.refresh()
+            # Beds mixed with or without music cannot be used for the other kind
+            bed_lengths = []
+            if bed_pool.music == has_music:
+                bed_lengths = [
+                    length for length, count in bed_pool.available().items() if count
+                ]
+            return planner.plan(
+                rcf.narration_texts(), DEFAULT_PROFILES, bed_lengths
+            ).to_dict()
 
-rcf.get_posts(subreddit=random.choice(subreddits), word_limit=600, span="week")
+        plan = manifest.run_stage(
+            "plan",
+            {"post_id": selected["post_id"], "target": planner.target_seconds},
+            plan_render,
+        )
 
-rcf.create_video(
-    pvleopard_access_key=os.getenv("PVLEOPARD_ACCESS_KEY"),
-    narrator=random.choice(narrators),
-)
+        # Every job has its own workspace so the next render does not
+        # overwrite files that are still being uploaded
+        rcf.create_video(
+            pvleopard_access_key=os.getenv("PVLEOPARD_ACCESS_KEY"),
+            narrator=params["narrator"],
+            hasMusic=has_music,
+            manifest=manifest,
+            workspace=workspace,
+            narration_workers=plan["settings"]["narration_workers"],
+            use_bed=plan["settings"]["renderer"] == "bed",
+            profiles=[
+                profile
+                for profile in DEFAULT_PROFILES
+                if profile.name in plan["settings"]["profiles"]
+            ],
+        )
+    except Exception:
+        manifest.set_status("failed")
+        manifest.release()
+        raise
 
-caption = f"""
+    caption = f"""
 {rcf.post_title}
 #redditfeeds #askreddit #reddit #redditstories #redditreadings #redditmemes #dating #datingadvice #memes #trending #funnymemes #nsfw #reels
 """
 
-rcf.upload_to_instagram(
-    username=os.getenv("INSTAGRAM_USERNAME"),
-    password=os.getenv("INSTAGRAM_PASSWORD"),
-    input_path="output/output.mp4",
-    output_path="output",
-    caption=caption,
-)
-
-upload_tiktok_video(
-    token=os.getenv("TIKTOK_TOKEN"),
-    session_id=os.getenv("TIKTOK_SESSIONID"),
-    caption=caption,
-)
+    manifest.set_status("uploading")
+    uploads.submit(
+        FinishedVideo(
+            video_id=rcf.post.id,
+            path=workspace.path("output.mp4"),
+            caption=caption,
+            output_path=workspace.job_dir,
+            duration=rcf.audio_duration,
+            post=rcf.post,
+            manifest=manifest,
+            workspace=workspace,
+            variants=rcf.variants,
+        )
+    )
+
+
+def create_upload_pipeline(rcf: RedditContentFarmer) -> UploadPipeline:
+    """
+    Create the pipeline that uploads finished videos to Instagram and TikTok\n
+    :param rcf: The RedditContentFarmer used to upload to Instagram
+    """
+
+    def instagram_publisher(username: str, password: str):
+        def upload_instagram(video: FinishedVideo):
+            rcf.upload_to_instagram(
+                username=username,
+                password=password,
+                input_path=video.variant("instagram"),
+                output_path=video.output_path,
+                caption=video.caption,
+                duration=video.duration,
+                post=video.post,
+                mark_used=False,
+            )
+
+        return upload_instagram
+
+    def upload_tiktok(video: FinishedVideo):
+        return upload_tiktok_video(
+            token=os.getenv("TIKTOK_TOKEN"),
+            session_id=os.getenv("TIKTOK_SESSIONID"),
+            caption=video.caption,
+            video_path=video.variant("tiktok"),
+        )
+
+    def mark_used(video: FinishedVideo, report: dict):
+        if any(result["status"] == "uploaded" for result in report.values()):
+            rcf.add_story_title_to_file(video.post)
+
+    publishers = {
+        f"instagram:{username}": instagram_publisher(username, password)
+        for username, password in instagram_accounts
+    }
+    publishers["tiktok"] = upload_tiktok
+    return UploadPipeline(
+        publishers=publishers,
+        max_queued=2,
+        on_report=mark_used,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--daemon", action="store_true", help="Stay resident and keep making videos"
+    )
+    parser.add_argument(
+        "--interval", type=int, help="Seconds between videos in daemon mode"
+    )
+    parser.add_argument(
+        "--queue-dir", help="Folder of `.json` jobs to process in daemon mode"
+    )
+    parser.add_argument(
+        "--max-jobs", type=int, help="Exit the daemon after this many jobs"
+    )
+    parser.add_argument(
+        "--shutdown", action="store_true", help="Shut down the machine when done"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=9464,
+        help="Port to serve Prometheus metrics on at 127.0.0.1 in daemon mode, 0 to disable",
+    )
+    args = parser.parse_args()
+
+    if args.daemon and args.metrics_port:
+        MetricsServer(port=args.metrics_port).start()
+
+    # Backgrounds are rendered ahead of time while the daemon has nothing to do
+    bed_pool = BedPool()
+    planner = RenderPlanner(jobs_dir, target_seconds=900)
+
+    with RedditContentFarmer(
+        client_id=os.getenv("REDDIT_CLIENT_ID"),
+        client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
+        user_agent=os.getenv("REDDIT_USER_AGENT"),
+        verbose=True,
+        track_used_posts=True,
+        shutdown_on_close=args.shutdown,
+        near_duplicate_index=NearDuplicateIndex(threshold=0.6),
+        bed_pool=bed_pool,
+    ) as rcf:
+        uploads = create_upload_pipeline(rcf)
+        try:
+            if args.daemon:
+                Daemon(
+                    produce=lambda job: produce_video(
+                        rcf, uploads, planner, bed_pool, job
+                    ),
+                    interval=args.interval,
+                    queue_dir=args.queue_dir,
+                    max_jobs=args.max_jobs,
+                    # Browsers of uploads still running in the background are
+                    # owned by the upload threads and are left alone
+                    cleanup=lambda: browser_processes.kill_tracked(
+                        current_thread_only=True
+                    ),
+                    # Renders a bed in the background while no job is due
+                    idle=lambda: bed_pool.replenish(max_beds=1) > 0,
+                ).run()
+            else:
+                produce_video(rcf, uploads, planner, bed_pool, {})
+        finally:
+            uploads.close()
@@ -0,0 +1,354 @@
+import bisect
+import socket
+import logging
+import threading
+from typing import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("RedditContentFarmer.metrics")
+
+# Seconds, from a cache hit to a long render
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 2400)
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    A named metric with one value per combination of label values
+    """
+
+    kind = None
+
+    def __init__(self, name: str, description: str, labels=()):
+        """
+        :param name: Name of the metric, e.g. `rcf_videos_total`
+        :param description: Help text shown on the endpoint
+        :param labels: Names of the labels the values are split by
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels) or any(
+            label not in labels for label in self.labels
+        ):
+            raise ValueError(
+                f"Metric {self.name} takes the labels {', '.join(self.labels)}"
+            )
+        return tuple(labels[label] for label in self.labels)
+
+    def samples(self) -> list:
+        """
+        Get the lines of the metric in the Prometheus text format
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. the number of videos made
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Add to the counter\n
+        :param amount: Amount to add, cannot be negative
+        :param labels: Values of the metric's labels
+        """
+        if amount < 0:
+            raise ValueError("Counters cannot be decreased")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. the number of queued jobs
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels=()):
+        super().__init__(name, description, labels)
+        self.__functions = {}
+
+    def set(self, value: float, **labels):
+        """
+        Set the gauge\n
+        :param value: The new value
+        :param labels: Values of the metric's labels
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Add to the gauge\n
+        :param amount: Amount to add, negative to subtract
+        :param labels: Values of the metric's labels
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """
+        Get the value from a function whenever the metrics are read, for values
+        that are expensive to keep up to date, e.g. the Reddit API budget\n
+        :param function: Function returning the current value
+        :param labels: Values of the metric's labels
+        """
+        key = self._key(labels)
+        with self._lock:
+            self.__functions[key] = function
+
+    def samples(self) -> list:
+        with self._lock:
+            functions = list(self.__functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                logger.exception(f"Could not read metric {self.name}")
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super().samples()
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. how long each stage takes
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS
+    ):
+        """
+        :param name: Name of the metric, e.g. `rcf_stage_seconds`
+        :param description: Help text shown on the endpoint
+        :param labels: Names of the labels the values are split by
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, description, labels)
+        if list(buckets) != sorted(buckets):
+            raise ValueError("Histogram buckets must be in increasing order")
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """
+        Record a value\n
+        :param value: The observed value
+        :param labels: Values of the metric's labels
+        """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket and one for larger values, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                labels = _format_labels(
+                    self.labels, key, f'le="{_format_value(float(bound))}"'
+                )
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process, shared by every module that reports them
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name: str, description: str, labels=()) -> Counter:
+        """
+        Get a counter, creating it on first use\n
+        :param name: Name of the metric
+        :param description: Help text shown on the endpoint
+        :param labels: Names of the labels the values are split by
+        """
+        return self.__get_or_create_(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels=()) -> Gauge:
+        """
+        Get a gauge, creating it on first use\n
+        :param name: Name of the metric
+        :param description: Help text shown on the endpoint
+        :param labels: Names of the labels the values are split by
+        """
+        return self.__get_or_create_(Gauge, name, description, labels)
+
+    def histogram(
+        self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        """
+        Get a histogram, creating it on first use\n
+        :param name: Name of the metric
+        :param description: Help text shown on the endpoint
+        :param labels: Names of the labels the values are split by
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        return self.__get_or_create_(
+            Histogram, name, description, labels, buckets=buckets
+        )
+
+    def render(self) -> str:
+        """
+        Get every metric in the Prometheus text format
+        """
+        with self.__lock:
+            metrics = sorted(self.__metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.description)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+    def __get_or_create_(self, cls, name: str, description: str, labels, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = cls(name, description, labels, **kwargs)
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError(f"Metric {name} already exists with other settings")
+            return metric
+
+
+class _IPv6HTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+# Every module reports to this registry unless given another one
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer:
+    """
+    Serves a registry on a local HTTP endpoint for Prometheus to scrape
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry = REGISTRY,
+        host: str = "127.0.0.1",
+        port: int = 9464,
+    ):
+        """
+        Initialize the server, call start to serve\n
+        :param registry: The metrics to serve
+        :param host: Loopback address to listen on, the metrics are never exposed publicly
+        :param port: Port to listen on, 0 to pick a free one
+        """
+        if host not in LOOPBACK_HOSTS:
+            raise ValueError("The metrics can only be served on a loopback address")
+
+        self.registry = registry
+        self.__address = (host, port)
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        if ":" in host:
+            host = f"[{host}]"
+        return f"http://{host}:{port}/metrics"
+
+    def start(self) -> "MetricsServer":
+        """
+        Start serving in a background thread
+        """
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server_class = ThreadingHTTPServer
+        if ":" in self.__address[0]:
+            server_class = _IPv6HTTPServer
+        self.__server = server_class(self.__address, Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, name="metrics-server", daemon=True
+        )
+        self.__thread.start()
+        logger.debug(f"Serving metrics on {self.url}")
+        return self
+
+    def close(self):
+        """
+        Stop serving
+        """
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__thread.join()
+            self.__server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,215 @@
+import re
+import zlib
+import sqlite3
+import threading
+
+# Smallest prime above 2^32, the hashes are permuted modulo this prime
+_PRIME = 4294967311
+_MAX_HASH = 0xFFFFFFFF
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+def optimal_bands(threshold: float, num_perm: int) -> tuple:
+    """
+    Get the number of bands and rows per band that best separate pairs above and below a similarity threshold\n
+    :param threshold: Jaccard similarity from which two texts are duplicates
+    :param num_perm: Number of hashes in a signature
+    """
+
+    def probability(similarity, bands, rows):
+        return 1 - (1 - similarity**rows) ** bands
+
+    def integrate(function, start, end, steps=100):
+        width = (end - start) / steps
+        return sum(function(start + (i + 0.5) * width) for i in range(steps)) * width
+
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        false_positives = integrate(
+            lambda s: probability(s, bands, rows), 0, threshold
+        )
+        false_negatives = integrate(
+            lambda s: 1 - probability(s, bands, rows), threshold, 1
+        )
+        error = false_positives + false_negatives
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash/LSH index that finds texts similar to ones seen before
+    """
+
+    def __init__(
+        self,
+        path: str = "near_duplicates.sqlite",
+        threshold: float = 0.6,
+        num_perm: int = 128,
+        shingle_size: int = 3,
+        seed: int = 1,
+    ):
+        """
+        Open the index and load its entries\n
+        :param path: Path to the SQLite file holding the signatures, or None to keep them in memory only
+        :param threshold: Estimated Jaccard similarity of word shingles from which two texts are duplicates
+        :param num_perm: Number of hashes in a signature, more is more accurate but slower
+        :param shingle_size: Number of words per shingle
+        :param seed: Seed of the hash permutations, must never change for an existing index
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError("Threshold must be between 0 and 1")
+
+        # Imported here so that importing this module stays cheap
+        try:
+            import numpy as np
+        except ModuleNotFoundError:
+            raise ValueError(
+                "Please install numpy by running `pip install -r requirements.txt`"
+            ) from None
+
+        self.threshold = threshold
+        self.__num_perm = num_perm
+        self.__shingle_size = shingle_size
+        self.__bands, self.__rows = optimal_bands(threshold, num_perm)
+        generator = np.random.RandomState(seed)
+        self.__a = generator.randint(1, _MAX_HASH, num_perm, dtype=np.uint64)
+        self.__b = generator.randint(0, _MAX_HASH, num_perm, dtype=np.uint64)
+
+        self.__lock = threading.RLock()
+        self.__signatures = {}
+        self.__buckets = [{} for _ in range(self.__bands)]
+        self.__last_rowid = 0
+        self.__connection = None
+        if path:
+            self.__connection = sqlite3.connect(
+                path, timeout=30, check_same_thread=False
+            )
+            with self.__connection:
+                self.__connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS entries (
+                        key TEXT PRIMARY KEY,
+                        signature BLOB NOT NULL
+                    )
+                    """
+                )
+            self.refresh()
+
+    def __len__(self):
+        return len(self.__signatures)
+
+    def signature(self, text: str):
+        """
+        Get the MinHash signature of a text, or None if it is too short to compare\n
+        :param text: The text to hash
+        """
+        import numpy as np
+
+        words = _WORD.findall(text.lower())
+        if len(words) < self.__shingle_size:
+            return None
+        shingles = {
+            " ".join(words[i : i + self.__shingle_size])
+            for i in range(len(words) - self.__shingle_size + 1)
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # Every column is one random permutation of the shingle hashes
+        permuted = (np.outer(hashes, self.__a) + self.__b) % _PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def add(self, key: str, text: str, persist: bool = True) -> bool:
+        """
+        Add a text to the index\n
+        :param key: Unique key of the text, e.g. the Reddit post id
+        :param text: The text to index
+        :param persist: Whether to save the entry, unsaved entries only live in this process
+        :return: Whether the text was long enough to be indexed
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return False
+        with self.__lock:
+            self.__insert_(key, signature)
+            if persist and self.__connection:
+                with self.__connection:
+                    self.__connection.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?)",
+                        (key, signature.tobytes()),
+                    )
+        return True
+
+    def query(self, text: str, refresh: bool = True) -> list:
+        """
+        Get the keys of indexed texts similar to the given text, most similar first\n
+        :param text: The text to look up
+        :param refresh: Whether to load entries other processes added first
+        :return: List of (key, estimated similarity) tuples
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        if refresh:
+            self.refresh()
+        import numpy as np
+
+        with self.__lock:
+            candidates = set()
+            for band, bucket in enumerate(self.__buckets):
+                candidates.update(bucket.get(self.__band_key_(signature, band), ()))
+            matches = []
+            for key in candidates:
+                similarity = float(np.mean(self.__signatures[key] == signature))
+                if similarity >= self.threshold:
+                    matches.append((key, similarity))
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+    def is_duplicate(self, text: str) -> bool:
+        """
+        Check whether a text is a near-duplicate of anything in the index\n
+        :param text: The text to look up
+        """
+        return len(self.query(text)) > 0
+
+    def refresh(self):
+        """
+        Load the entries other processes have saved since the last refresh
+        """
+        if not self.__connection:
+            return
+        import numpy as np
+
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT rowid, key, signature FROM entries WHERE rowid > ?",
+                (self.__last_rowid,),
+            ).fetchall()
+            for rowid, key, signature in rows:
+                self.__insert_(key, np.frombuffer(signature, dtype=np.uint32))
+                self.__last_rowid = max(self.__last_rowid, rowid)
+
+    def __insert_(self, key: str, signature):
+        if key in self.__signatures:
+            self.__remove_(key)
+        self.__signatures[key] = signature
+        for band, bucket in enumerate(self.__buckets):
+            bucket.setdefault(self.__band_key_(signature, band), set()).add(key)
+
+    def __remove_(self, key: str):
+        signature = self.__signatures.pop(key)
+        for band, bucket in enumerate(self.__buckets):
+            band_key = self.__band_key_(signature, band)
+            bucket[band_key].discard(key)
+            if not bucket[band_key]:
+                del bucket[band_key]
+
+    def __band_key_(self, signature, band: int) -> bytes:
+        return signature[band * self.__rows : (band + 1) * self.__rows].tobytes()
@@ -0,0 +1,164 @@
+import os
+import logging
+
+logger = logging.getLogger("RedditContentFarmer.output_profiles")
+
+
+class OutputProfile:
+    """
+    Encoding settings of one variant of the rendered video
+    """
+
+    def __init__(
+        self,
+        name: str,
+        width: int = None,
+        height: int = None,
+        bitrate: str = None,
+        faststart: bool = True,
+        fragmented: bool = False,
+        max_duration: float = None,
+        codec: str = "libx264",
+        preset: str = "medium",
+        draft: bool = False,
+    ):
+        """
+        :param name: Name of the variant, e.g. the platform it is uploaded to
+        :param width: Width of the variant, the rendered size if not set
+        :param height: Height of the variant, the rendered size if not set
+        :param bitrate: Video bitrate, e.g. `4000k`, chosen by ffmpeg if not set
+        :param faststart: Whether to move the index to the front so playback starts before the download ends
+        :param fragmented: Whether to write a fragmented MP4
+        :param max_duration: Seconds the variant is cut at, e.g. the platform's length limit
+        :param codec: Video codec
+        :param preset: Encoder preset, slower presets give smaller files
+        :param draft: Whether the profile is only meant for previews, draft
+            profiles are refused by production renders
+        """
+        if (width is None) != (height is None):
+            raise ValueError("Please provide both the width and height or neither")
+
+        self.name = name
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self.faststart = faststart
+        self.fragmented = fragmented
+        self.max_duration = max_duration
+        self.codec = codec
+        self.preset = preset
+        self.draft = draft
+
+    @property
+    def filename(self) -> str:
+        return "output.mp4" if self.name == "master" else f"output_{self.name}.mp4"
+
+    def ffmpeg_params(self) -> list:
+        """
+        Get the ffmpeg output options of the profile
+        """
+        params = []
+        if self.width:
+            # Scaled to fit and padded, so the aspect ratio is kept
+            params += [
+                "-vf",
+                f"scale={self.width}:{self.height}:force_original_aspect_ratio=decrease,"
+                f"pad={self.width}:{self.height}:(ow-iw)/2:(oh-ih)/2",
+            ]
+        flags = []
+        if self.faststart:
+            flags.append("+faststart")
+        if self.fragmented:
+            flags.append("+frag_keyframe+empty_moov+default_base_moof")
+        if flags:
+            params += ["-movflags", "".join(flags)]
+        if self.max_duration is not None:
+            # Also cuts the audio, which is muxed in as a whole
+            params += ["-t", str(self.max_duration)]
+        return params
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+MASTER = OutputProfile("master")
+INSTAGRAM = OutputProfile(
+    "instagram", width=1080, height=1920, bitrate="3500k", max_duration=900
+)
+TIKTOK = OutputProfile(
+    "tiktok", width=1080, height=1920, bitrate="5000k", max_duration=600
+)
+DEFAULT_PROFILES = [MASTER, INSTAGRAM, TIKTOK]
+
+# Previews are composited at a quarter of the size and a third of the frame
+# rate, so the draft profile itself does no scaling
+DRAFT = OutputProfile(
+    "draft", bitrate="500k", faststart=False, preset="ultrafast", draft=True
+)
+DRAFT_SCALE = 0.25
+DRAFT_FPS = 10
+
+
+def write_variants(
+    clip,
+    profiles: list,
+    output_dir: str,
+    temp_audiofile: str,
+    fps: int = 30,
+) -> dict:
+    """
+    Encode every profile of a clip from a single pass over its frames\n
+    The composite is rendered once per frame and each frame is fed to one
+    ffmpeg process per profile, and the audio is encoded once and shared
+    :param clip: The composited video clip
+    :param profiles: Profiles to encode
+    :param output_dir: Folder to write the variants to
+    :param temp_audiofile: Path of the audio file shared by the variants
+    :param fps: Frame rate of the variants
+    :return: Profile names mapped to the paths of their variants
+    """
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+    if not profiles:
+        raise ValueError("Please provide at least one output profile")
+    names = [profile.name for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError("Output profile names must be unique")
+
+    audiofile = None
+    if clip.audio is not None:
+        clip.audio.write_audiofile(
+            temp_audiofile, fps=44100, codec="libmp3lame", verbose=False, logger=None
+        )
+        audiofile = temp_audiofile
+
+    paths = {}
+    writers = []
+    try:
+        for profile in profiles:
+            path = os.path.join(output_dir, profile.filename)
+            writers.append(
+                (
+                    profile,
+                    FFMPEG_VideoWriter(
+                        path,
+                        clip.size,
+                        fps,
+                        codec=profile.codec,
+                        preset=profile.preset,
+                        bitrate=profile.bitrate,
+                        audiofile=audiofile,
+                        ffmpeg_params=profile.ffmpeg_params(),
+                    ),
+                )
+            )
+            paths[profile.name] = path
+        for t, frame in clip.iter_frames(fps=fps, with_times=True, dtype="uint8"):
+            for profile, writer in writers:
+                if profile.max_duration is None or t < profile.max_duration:
+                    writer.write_frame(frame)
+    finally:
+        for _, writer in writers:
+            writer.close()
+    logger.debug(f"Wrote variants {', '.join(names)} in one pass")
+    return paths
@@ -0,0 +1,338 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import itertools
+import threading
+import contextlib
+from typing import Callable
+from metrics import REGISTRY
+
+logger = logging.getLogger("RedditContentFarmer.pipeline")
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rcf_stage_seconds", "Seconds each job stage took to run", ["stage"]
+)
+STAGES_SKIPPED = REGISTRY.counter(
+    "rcf_stages_skipped_total",
+    "Stages skipped because a resumed job had already done them",
+    ["stage"],
+)
+
+# Jobs opened by this process, which must not be resumed a second time
+_open_jobs = set()
+_open_jobs_lock = threading.Lock()
+# Numbers the jobs this process creates, so ids made in the same second differ
+_job_numbers = itertools.count(1)
+
+
+def hash_inputs(inputs: dict) -> str:
+    """
+    Get the key of a stage from its inputs\n
+    :param inputs: JSON serializable inputs of the stage
+    """
+    encoded = json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """
+    Get the sha256 of a file\n
+    :param path: Path to the file
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_replace(path: str):
+    """
+    Write a file under a temporary name and rename it over the path once the with
+    block succeeds, so a crash never leaves a half written file behind\n
+    :param path: Path of the file to write
+    :return: The temporary path to write to
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write_json(path: str, data, indent: int = None):
+    """
+    Save JSON to a file atomically\n
+    :param path: Path of the file
+    :param data: JSON serializable data
+    :param indent: Indentation of the JSON, compact if not set
+    """
+    with atomic_replace(path) as temp_path:
+        with open(temp_path, "w") as file:
+            json.dump(data, file, indent=indent)
+
+
+class JobManifest:
+    """
+    Records the stages of a video job so a rerun can skip the stages that already succeeded
+    """
+
+    def __init__(self, job_dir: str):
+        """
+        Open the manifest of a job, creating the job folder if needed\n
+        :param job_dir: Folder of the job, where its artifacts and manifest.json are stored
+        """
+        self.job_dir = job_dir
+        self.job_id = os.path.basename(os.path.normpath(job_dir))
+        self.__path = os.path.join(job_dir, "manifest.json")
+        self.__lock = threading.RLock()
+        if not os.path.exists(job_dir):
+            os.makedirs(job_dir, exist_ok=True)
+        if os.path.exists(self.__path):
+            with open(self.__path, "r") as file:
+                self.__data = json.load(file)
+        else:
+            self.__data = {
+                "job_id": self.job_id,
+                "status": "running",
+                "attempts": 0,
+                "params": {},
+                "stages": {},
+            }
+        self.__claim_()
+        self.__data["attempts"] += 1
+        self.save()
+
+    @classmethod
+    def resume_or_create(
+        cls, jobs_dir: str = "output/jobs", job_id: str = None, max_attempts: int = 3
+    ) -> "JobManifest":
+        """
+        Resume the given job or the newest unfinished one, or start a new job\n
+        :param jobs_dir: Folder containing a folder per job
+        :param job_id: Id of the job to open, resumes or creates a job if not set
+        :param max_attempts: Unfinished jobs that already ran this often are abandoned
+        """
+        if job_id:
+            return cls(os.path.join(jobs_dir, job_id))
+        if os.path.exists(jobs_dir):
+            for existing_id in sorted(os.listdir(jobs_dir), reverse=True):
+                job_dir = os.path.join(jobs_dir, existing_id)
+                manifest_path = os.path.join(job_dir, "manifest.json")
+                if not os.path.exists(manifest_path) or cls.is_claimed(job_dir):
+                    continue
+                with open(manifest_path, "r") as file:
+                    data = json.load(file)
+                if data["status"] in ("done", "abandoned"):
+                    continue
+                if data["attempts"] >= max_attempts:
+                    logger.debug(
+                        f"Abandoning job {existing_id} after {max_attempts} attempts"
+                    )
+                    data["status"] = "abandoned"
+                    atomic_write_json(manifest_path, data, indent=2)
+                    continue
+                logger.debug(f"Resuming job {existing_id}...")
+                try:
+                    return cls(job_dir)
+                except FileExistsError:
+                    # Another process claimed it first
+                    continue
+        while True:
+            # Zero padded so the ids still sort by the time they were created
+            new_id = (
+                time.strftime("%Y%m%d-%H%M%S")
+                + f"-{os.getpid()}-{next(_job_numbers):06d}"
+            )
+            # A job of an earlier process that had the same pid is never reopened
+            if not os.path.exists(os.path.join(jobs_dir, new_id)):
+                return cls(os.path.join(jobs_dir, new_id))
+
+    @property
+    def params(self) -> dict:
+        """
+        Parameters chosen for the job, e.g. its subreddit, kept across reruns
+        """
+        return self.__data["params"]
+
+    @property
+    def status(self) -> str:
+        return self.__data["status"]
+
+    def set_status(self, status: str):
+        """
+        Set the status of the job\n
+        :param status: `running`, `uploading`, `done`, `failed` or `abandoned`
+        """
+        with self.__lock:
+            self.__data["status"] = status
+            self.save()
+
+    def path(self, name: str) -> str:
+        """
+        Get the path of an artifact in the job folder\n
+        :param name: File name of the artifact
+        """
+        return os.path.join(self.job_dir, name)
+
+    def stage(self, name: str) -> dict:
+        """
+        Get the recorded entry of a stage, or None if it never completed\n
+        :param name: Name of the stage
+        """
+        with self.__lock:
+            return self.__data["stages"].get(name)
+
+    def stage_key(self, name: str) -> str:
+        """
+        Get the input key of a completed stage, or None\n
+        :param name: Name of the stage
+        """
+        entry = self.stage(name)
+        return entry["key"] if entry else None
+
+    def is_complete(self, name: str, inputs: dict) -> bool:
+        """
+        Check whether a stage already ran with the same inputs and its artifacts are intact\n
+        :param name: Name of the stage
+        :param inputs: Inputs the stage would run with
+        """
+        entry = self.stage(name)
+        if not entry or entry["key"] != hash_inputs(inputs):
+            return False
+        for artifact, checksum in entry["artifacts"].items():
+            path = self.path(artifact)
+            if not os.path.exists(path) or os.path.getsize(path) != checksum["size"]:
+                return False
+            if hash_file(path) != checksum["sha256"]:
+                return False
+        return True
+
+    def run_stage(
+        self, name: str, inputs: dict, run: Callable[[], dict], artifacts=()
+    ) -> dict:
+        """
+        Run a stage unless it already completed with the same inputs\n
+        :param name: Name of the stage
+        :param inputs: JSON serializable inputs, a change to any of them reruns the stage
+        :param run: Function that runs the stage and returns a JSON serializable result
+        :param artifacts: File names in the job folder the stage creates, or a function
+            that gets them from the result of the stage
+        :return: The result of the stage, from this run or the recorded one
+        """
+        if self.is_complete(name, inputs):
+            logger.debug(f"Job {self.job_id}: skipping stage {name}, already done")
+            STAGES_SKIPPED.inc(stage=name)
+            return self.stage(name)["result"]
+        logger.debug(f"Job {self.job_id}: running stage {name}...")
+        start = time.monotonic()
+        result = run() or {}
+        if callable(artifacts):
+            artifacts = artifacts(result)
+        elapsed = time.monotonic() - start
+        self.complete_stage(name, inputs, result, artifacts, elapsed)
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        return result
+
+    def complete_stage(
+        self,
+        name: str,
+        inputs: dict,
+        result: dict = None,
+        artifacts=(),
+        elapsed: float = None,
+    ):
+        """
+        Record a stage as completed\n
+        :param name: Name of the stage
+        :param inputs: JSON serializable inputs of the stage
+        :param result: JSON serializable result of the stage
+        :param artifacts: File names in the job folder the stage created
+        :param elapsed: Seconds the stage took
+        """
+        checksums = {}
+        for artifact in artifacts:
+            path = self.path(artifact)
+            if not os.path.exists(path):
+                raise ValueError(f"Stage {name} did not create {artifact}")
+            checksums[artifact] = {
+                "size": os.path.getsize(path),
+                "sha256": hash_file(path),
+            }
+        with self.__lock:
+            self.__data["stages"][name] = {
+                "key": hash_inputs(inputs),
+                "result": result or {},
+                "artifacts": checksums,
+                "elapsed": round(elapsed, 2) if elapsed is not None else None,
+                "completed_at": time.time(),
+            }
+            self.save()
+
+    def save(self):
+        """
+        Write the manifest atomically
+        """
+        with self.__lock:
+            atomic_write_json(self.__path, self.__data, indent=2)
+
+    def release(self):
+        """
+        Release the job so another run may resume it
+        """
+        # The lock file is kept, removing it would let a process that already
+        # opened it lock a file nobody else sees
+        if self.__lock_descriptor is not None:
+            os.close(self.__lock_descriptor)
+            self.__lock_descriptor = None
+        with _open_jobs_lock:
+            _open_jobs.discard(os.path.abspath(self.job_dir))
+
+    def __claim_(self):
+        self.__lock_descriptor = None
+        with _open_jobs_lock:
+            if os.path.abspath(self.job_dir) in _open_jobs:
+                raise FileExistsError(f"Job {self.job_id} is already running")
+            descriptor = os.open(
+                os.path.join(self.job_dir, ".lock"), os.O_CREAT | os.O_RDWR
+            )
+            try:
+                # Held until release, the kernel drops it if the process dies,
+                # so a crashed job is taken over without deleting anything
+                fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(descriptor)
+                raise FileExistsError(f"Job {self.job_id} is already running")
+            os.ftruncate(descriptor, 0)
+            os.write(descriptor, str(os.getpid()).encode("utf-8"))
+            self.__lock_descriptor = descriptor
+            _open_jobs.add(os.path.abspath(self.job_dir))
+
+    @staticmethod
+    def is_claimed(job_dir: str) -> bool:
+        """
+        Check whether a job is open in this or another process\n
+        :param job_dir: Folder of the job
+        """
+        with _open_jobs_lock:
+            if os.path.abspath(job_dir) in _open_jobs:
+                return True
+        try:
+            descriptor = os.open(os.path.join(job_dir, ".lock"), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            # Closing also drops the shared lock taken to check
+            os.close(descriptor)
+        return False
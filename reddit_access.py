@@ -0,0 +1,243 @@
+import os
+import math
+import time
+import sqlite3
+import logging
+import threading
+from typing import Callable
+from sqlite_transaction import Transaction
+
+logger = logging.getLogger("RedditContentFarmer.reddit_access")
+
+
+class RequestBudget:
+    """
+    Token bucket of Reddit API requests, shared by every process using the same SQLite file
+    """
+
+    def __init__(
+        self,
+        path: str = "reddit_budget.sqlite",
+        capacity: int = 100,
+        requests_per_minute: int = 100,
+    ):
+        """
+        Initialize the request budget\n
+        :param path: Path to the SQLite file that holds the bucket
+        :param capacity: Maximum number of requests that can be made in a burst
+        :param requests_per_minute: Rate at which the bucket refills
+        """
+        if capacity < 1:
+            raise ValueError("Capacity cannot be less than 1")
+        if requests_per_minute <= 0:
+            raise ValueError("Requests per minute must be greater than 0")
+
+        self.__path = path
+        self.__capacity = capacity
+        self.__rate = requests_per_minute / 60
+        self.__local = threading.local()
+        with self.__connect_() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bucket (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    server_remaining REAL,
+                    server_reset_at REAL
+                )
+                """
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO bucket VALUES (1, ?, ?, NULL, NULL)",
+                (capacity, time.time()),
+            )
+
+    def acquire(self, requests: int = 1, timeout: float = None) -> float:
+        """
+        Wait until the given number of requests may be made and take them from the budget\n
+        :param requests: Number of requests that are about to be made
+        :param timeout: Maximum number of seconds to wait, waits forever if not set
+        :return: Number of seconds spent waiting
+        """
+        requests = min(requests, self.__capacity)
+        start = time.monotonic()
+        while True:
+            wait = self.__try_acquire_(requests)
+            if wait <= 0:
+                return time.monotonic() - start
+            if timeout is not None and time.monotonic() - start + wait > timeout:
+                raise TimeoutError("Timed out waiting for Reddit API request budget")
+            logger.debug(f"Reddit API budget exhausted, waiting {wait:.1f}s...")
+            time.sleep(wait)
+
+    def observe(self, remaining: float, reset_timestamp: float):
+        """
+        Update the budget with the rate limit headers of a Reddit response\n
+        :param remaining: Value of the X-Ratelimit-Remaining header
+        :param reset_timestamp: Time at which Reddit resets the remaining requests
+        """
+        with self.__connect_() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                """
+                UPDATE bucket SET server_remaining = ?, server_reset_at = ?
+                WHERE id = 1
+                """,
+                (remaining, reset_timestamp),
+            )
+
+    def remaining(self) -> float:
+        """
+        Get the number of requests that can be made right now
+        """
+        with self.__connect_() as connection:
+            tokens, _, _ = self.__refill_(connection, time.time())
+        return tokens
+
+    def __try_acquire_(self, requests: int) -> float:
+        """
+        Take requests from the bucket if there are enough, otherwise return how long to wait
+        """
+        now = time.time()
+        with self.__connect_() as connection:
+            # Locks the database so processes cannot take the same tokens
+            connection.execute("BEGIN IMMEDIATE")
+            tokens, server_remaining, server_reset_at = self.__refill_(
+                connection, now
+            )
+            if tokens >= requests:
+                connection.execute(
+                    """
+                    UPDATE bucket SET tokens = ?, updated_at = ?,
+                        server_remaining = server_remaining - ?
+                    WHERE id = 1
+                    """,
+                    (tokens - requests, now, requests),
+                )
+                return 0
+            connection.execute(
+                "UPDATE bucket SET tokens = ?, updated_at = ? WHERE id = 1",
+                (tokens, now),
+            )
+        if server_remaining is not None and server_remaining < requests:
+            # Reddit itself has no requests left until its window resets
+            return max(server_reset_at - now, 0.1)
+        return (requests - tokens) / self.__rate
+
+    def __refill_(self, connection, now: float):
+        tokens, updated_at, server_remaining, server_reset_at = connection.execute(
+            "SELECT tokens, updated_at, server_remaining, server_reset_at FROM bucket"
+        ).fetchone()
+        tokens = min(self.__capacity, tokens + max(now - updated_at, 0) * self.__rate)
+        if server_reset_at is not None and server_reset_at <= now:
+            # Reddit's window has reset, its last remaining count no longer applies
+            connection.execute(
+                "UPDATE bucket SET server_remaining = NULL, server_reset_at = NULL"
+            )
+            server_remaining = server_reset_at = None
+        if server_remaining is not None:
+            tokens = min(tokens, max(server_remaining, 0))
+        return tokens, server_remaining, server_reset_at
+
+    def __connect_(self) -> Transaction:
+        # One connection per thread, SQLite connections cannot be shared
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.__path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.__path, timeout=30, isolation_level=None)
+            self.__local.connection = connection
+        return Transaction(connection)
+
+
+class RedditAccess:
+    """
+    Makes Reddit API calls within the shared request budget and reuses recent listings
+    """
+
+    def __init__(self, budget: RequestBudget = None, listing_ttl: int = 600):
+        """
+        Initialize the access layer\n
+        :param budget: Request budget shared with other workers, unlimited if not set
+        :param listing_ttl: Seconds a fetched listing is reused for
+        """
+        self.__budget = budget
+        self.__listing_ttl = listing_ttl
+        self.__listings = {}
+        self.__lock = threading.Lock()
+        self.requests = 0
+        self.listing_hits = 0
+        self.listing_misses = 0
+
+    @property
+    def budget(self) -> RequestBudget:
+        return self.__budget
+
+    def call(self, reddit, request: Callable, requests: int = 1):
+        """
+        Make a Reddit API call once the budget allows it\n
+        :param reddit: The praw.Reddit client the call is made with
+        :param request: Function that makes the call and returns its result
+        :param requests: Number of API requests the call makes
+        """
+        if self.__budget:
+            self.__budget.acquire(requests)
+        try:
+            return request()
+        finally:
+            with self.__lock:
+                self.requests += requests
+            self.__observe_limits_(reddit)
+
+    def listing(
+        self,
+        reddit,
+        subreddit: str,
+        sort: str,
+        span: str = None,
+        limit: int = 100,
+    ) -> list:
+        """
+        Get a subreddit listing, reusing one fetched within the listing TTL\n
+        :param reddit: The praw.Reddit client to fetch the listing with
+        :param subreddit: Name of the subreddit
+        :param sort: One of `top`, `hot`, `new`, `controversial` or `rising`
+        :param span: Time span of `top` and `controversial` listings
+        :param limit: Number of posts in the listing
+        """
+        key = (subreddit.lower(), sort, span, limit)
+        with self.__lock:
+            cached = self.__listings.get(key)
+            if cached and time.monotonic() - cached[0] < self.__listing_ttl:
+                self.listing_hits += 1
+                return cached[1]
+            self.listing_misses += 1
+
+        def fetch():
+            listing = getattr(reddit.subreddit(subreddit), sort)
+            if span is not None:
+                return list(listing(time_filter=span, limit=limit))
+            return list(listing(limit=limit))
+
+        # Reddit returns at most 100 posts per request
+        requests = max(1, math.ceil(limit / 100))
+        submissions = self.call(reddit, fetch, requests=requests)
+        with self.__lock:
+            self.__listings[key] = (time.monotonic(), submissions)
+        return submissions
+
+    def clear_listings(self):
+        """
+        Forget every cached listing
+        """
+        with self.__lock:
+            self.__listings = {}
+
+    def __observe_limits_(self, reddit):
+        if not self.__budget:
+            return
+        limits = getattr(getattr(reddit, "auth", None), "limits", None) or {}
+        if limits.get("remaining") is not None and limits.get("reset_timestamp"):
+            self.__budget.observe(limits["remaining"], limits["reset_timestamp"])
@@ -3,16 +3,38 @@ This script is derived from https://github.com/TobbleCobble/reddit-video-maker
 """
 
 import os
-import json
 import wave
 import math
 import errno
 import random
+import shutil
 import logging
+import threading
 import contextlib
+import browser_processes
+from browser_pool import close_shared_pool
 from typing import Literal
 from timeout import timeout
-from google.cloud import logging as cloud_logging
+from instagram_session import InstagramSessionManager
+from reddit_access import RedditAccess, RequestBudget
+from submission_filter import SubmissionFilter
+from near_duplicates import NearDuplicateIndex
+from pipeline import JobManifest, hash_inputs
+from workspace import Workspace
+from cache_manager import CacheManager
+from background_beds import BedPool, compose_background, plan_background
+from output_profiles import (
+    DEFAULT_PROFILES,
+    DRAFT,
+    DRAFT_FPS,
+    DRAFT_SCALE,
+    write_variants,
+)
+from subtitle_overlay import SubtitleOverlay, SubtitleSpec, peak_rss_mb
+from metrics import REGISTRY
+from concurrent.futures import ThreadPoolExecutor
+
+VIDEOS = REGISTRY.counter("rcf_videos_total", "Videos rendered and ready to upload")
 
 
 class RedditContentFarmer:
@@ -28,6 +50,13 @@ class RedditContentFarmer:
         user_agent: str,
         verbose: bool = False,
         track_used_posts: bool = False,
+        shutdown_on_close: bool = False,
+        request_budget_path: str = "reddit_budget.sqlite",
+        listing_ttl: int = 600,
+        submission_filter: SubmissionFilter = None,
+        near_duplicate_index: NearDuplicateIndex = None,
+        cache: CacheManager = None,
+        bed_pool: BedPool = None,
     ):
         """
         Initialize the RedditContentCultivator object\n
@@ -36,6 +65,13 @@ class RedditContentFarmer:
         :param user_agent: The user agent of your Reddit app
         :param verbose: Whether to enable verbose logging
         :param track_used_posts: Whether to track used posts in a file called used_stories.txt
+        :param shutdown_on_close: Whether to shut down the machine when the farmer is closed
+        :param request_budget_path: SQLite file with the Reddit API budget shared by all workers, None to disable
+        :param listing_ttl: Seconds a fetched subreddit listing is reused for
+        :param submission_filter: Rules posts must pass, by default titles mentioning Reddit are rejected
+        :param near_duplicate_index: Index of published stories, posts too similar to one of them are rejected
+        :param cache: Disk cache shared with other workers, a 5 GB cache in the `cache` folder if not set
+        :param bed_pool: Pool of pre-rendered backgrounds to use instead of composing one per video
         """
         self.__init_logger_(verbose)
 
@@ -55,6 +91,8 @@ class RedditContentFarmer:
         self.__client_secret = client_secret
         self.__user_agent = user_agent
         self.__track_used_posts = track_used_posts
+        self.__shutdown_on_close = shutdown_on_close
+        self.__closed = False
 
         # praw type alias
         PrawModels = praw.models
@@ -65,8 +103,45 @@ class RedditContentFarmer:
             user_agent=self.__user_agent,
         )
 
+        self.__reddit_access = RedditAccess(
+            budget=RequestBudget(request_budget_path) if request_budget_path else None,
+            listing_ttl=listing_ttl,
+        )
+        if self.__reddit_access.budget:
+            # Read from the shared SQLite file only when the metrics are scraped
+            REGISTRY.gauge(
+                "rcf_reddit_budget_remaining",
+                "Reddit API requests that can be made now",
+            ).set_function(self.__reddit_access.budget.remaining)
+
+        self.__submission_filter = submission_filter or SubmissionFilter()
+        self.__near_duplicate_index = near_duplicate_index
+
         self.__posts = []
+        self.__post_ids = set()
         self.__comments = {}
+        self.__thread_local = threading.local()
+        # Kept for the life of the farmer, so the Reddit clients of its threads
+        # are only authorized once
+        self.__comment_executor = None
+        self.__comment_workers = 0
+        self.__audio_duration = 0
+        self.__variants = {}
+        self.__instagram_sessions = InstagramSessionManager()
+
+        # Every subsystem caches its files in its own namespace and budget
+        self.__cache = cache or CacheManager("cache", max_bytes=5 * 1024**3)
+        self.__narration_cache = self.__cache.register(
+            "narration", max_bytes=3 * 1024**3
+        )
+        # Blocks of narrations that failed part way, so a rerun only narrates the rest
+        self.__narration_block_cache = self.__cache.register(
+            "narration_blocks", max_bytes=1024**3
+        )
+        self.__title_card_cache = self.__cache.register(
+            "title_cards", max_bytes=100 * 1024**2
+        )
+        self.__bed_pool = bed_pool
         self.__log_("RedditContentFarmer initialized")
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
@@ -92,29 +167,102 @@ class RedditContentFarmer:
             raise ValueError(
                 "Make sure you have a used_stories.txt file in the working directory of your script to track posts that have been used."
             )
-        with open("used_stories.txt", "a") as file:
-            file.write(post.title + "\n")
+        with open("used_stories.txt", "r+") as file:
+            # A resumed job reports the uploads of its earlier runs again
+            if post.title in file.read().splitlines():
+                self.__log_(f"Postid: {post.id} is already in used_stories.txt")
+            else:
+                file.write(post.title + "\n")
+        if self.__near_duplicate_index is not None:
+            self.__near_duplicate_index.add(post.id, post.selftext)
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
     def __validate_submission_(
         self, submission: "RedditContentFarmer.PrawModels.Submission", word_limit: int
     ):
-        used = self.story_already_used(submission) if self.__track_used_posts else False
-        if used:
-            self.__log_(f"Postid: {submission.id} has already been used, skipping...")
-        valid_title = "r/" not in submission.title and "reddit" not in submission.title
-        if not valid_title:
-            self.__log_(f"Postid: {submission.id} has an invalid title, skipping...")
-        below_word_limit = len(submission.selftext.split()) < word_limit
-        if not below_word_limit:
-            self.__log_(f"Postid: {submission.id} is above the word limit, skipping...")
-        submission_not_in_posts = submission not in self.__posts
-        if not submission_not_in_posts:
-            self.__log_(f"Postid: {submission.id} has already been added, skipping...")
-        valid_submission = (
-            valid_title and below_word_limit and submission_not_in_posts and not used
+        reason = self.__submission_filter.reject_reason(
+            submission, max_words=word_limit, exclude_ids=self.__post_ids
+        )
+        if reason is None:
+            reason = self.__used_reason_(submission)
+        if reason:
+            self.__submission_filter.rejections[reason] += 1
+            self.__log_(f"Postid: {submission.id} rejected by rule {reason}, skipping...")
+            return False
+        return True
+
+    def __pick_posts_(self, submissions: list, count: int, word_limit: int) -> int:
+        """
+        Filter a batch of submissions and add up to count random ones to the posts\n
+        :param submissions: The submissions to pick from
+        :param count: Number of posts to pick
+        :param word_limit: Maximum number of words in a post
+        :return: Number of posts that could not be picked
+        """
+        candidates = self.__submission_filter.filter(
+            submissions, max_words=word_limit, exclude_ids=self.__post_ids
         )
-        return valid_submission
+        random.shuffle(candidates)
+        for submission in candidates:
+            if count == 0:
+                break
+            reason = self.__used_reason_(submission)
+            if reason:
+                self.__submission_filter.rejections[reason] += 1
+                continue
+            self.__add_post_(submission)
+            count -= 1
+        return count
+
+    def __used_reason_(
+        self, submission: "RedditContentFarmer.PrawModels.Submission"
+    ) -> str:
+        """
+        Check whether a post, or a near copy of it, has been used before\n
+        :param submission: The post to check
+        :return: The name of the rule the post breaks, or None
+        """
+        if self.__near_duplicate_index is not None:
+            matches = self.__near_duplicate_index.query(submission.selftext)
+            if matches:
+                self.__log_(
+                    f"Postid: {submission.id} is a near-duplicate of {matches[0][0]} "
+                    f"(similarity {matches[0][1]:.2f})"
+                )
+                return "near_duplicate"
+        # Reading used_stories.txt is the slowest check, so it runs last
+        if self.__track_used_posts and self.story_already_used(submission):
+            return "used"
+        return None
+
+    def __add_post_(self, submission: "RedditContentFarmer.PrawModels.Submission"):
+        self.__posts.append(submission)
+        self.__post_ids.add(submission.id)
+        if self.__near_duplicate_index is not None:
+            # Queued stories are only kept in memory until they are published,
+            # so copies of them are not picked in the meantime
+            self.__near_duplicate_index.add(
+                submission.id, submission.selftext, persist=False
+            )
+
+    def use_post(self, post_id: str):
+        """
+        Use a known post instead of getting one, e.g. when resuming a job\n
+        :param post_id: Id of the post
+        """
+        self.__log_(f"Using post {post_id}...")
+
+        def fetch():
+            submission = self.__reddit_client.submission(id=post_id)
+            # Submissions are lazy, reading an attribute fetches them
+            submission.title
+            return submission
+
+        submission = self.__reddit_access.call(self.__reddit_client, fetch)
+        self.__posts = []
+        self.__post_ids = set()
+        self.__subreddit = submission.subreddit.display_name
+        self.__add_post_(submission)
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
     def get_posts(
@@ -152,7 +300,9 @@ class RedditContentFarmer:
             )
 
         self.__posts = []
+        self.__post_ids = set()
         self.__subreddit = subreddit
+        self.__submission_filter.reset_rejections()
         iterations = 0
         max_iterations = 1000
 
@@ -160,121 +310,145 @@ class RedditContentFarmer:
             while count > 0:
                 if iterations >= max_iterations:
                     raise ValueError("Could not find enough posts")
-                for submission in self.__reddit_client.subreddit(
-                    subreddit
-                ).random_rising(limit=1):
+                # Random listings are not cached, every call should differ
+                for submission in self.__reddit_access.call(
+                    self.__reddit_client,
+                    lambda: list(
+                        self.__reddit_client.subreddit(subreddit).random_rising(limit=1)
+                    ),
+                ):
                     if self.__validate_submission_(submission, word_limit):
-                        self.__posts.append(submission)
+                        self.__add_post_(submission)
                         count -= 1
                 iterations += 1
+        else:
+            # The whole listing is filtered in one batch
+            if type == "top":
+                submissions = self.__reddit_access.listing(
+                    self.__reddit_client, subreddit, "top", span, limit=max_count
+                )
+            else:
+                submissions = self.__reddit_access.listing(
+                    self.__reddit_client, subreddit, type, limit=1
+                )
+            count = self.__pick_posts_(submissions, count, word_limit)
 
-        if type == "top":
-            while count > 0:
-                if iterations >= max_iterations:
-                    raise ValueError("Could not find enough posts")
-                submissions = []
-                for submission in self.__reddit_client.subreddit(subreddit).top(
-                    span, limit=max_count
-                ):
-                    submissions.append(submission)
-                submission = random.choice(submissions)
-                if self.__validate_submission_(submission, word_limit):
-                    self.__posts.append(submission)
-                    count -= 1
-                iterations += 1
-
-        if type == "hot":
-            while count > 0:
-                if iterations >= max_iterations:
-                    raise ValueError("Could not find enough posts")
-                submissions = []
-                for submission in self.__reddit_client.subreddit(subreddit).hot(
-                    limit=1
-                ):
-                    submissions.append(submission)
-                submission = random.choice(submissions)
-                if self.__validate_submission_(submission, word_limit):
-                    self.__posts.append(submission)
-                    count -= 1
-                iterations += 1
-
-        if type == "new":
-            while count > 0:
-                if iterations >= max_iterations:
-                    raise ValueError("Could not find enough posts")
-                submissions = []
-                for submission in self.__reddit_client.subreddit(subreddit).new(
-                    limit=1
-                ):
-                    submissions.append(submission)
-                submission = random.choice(submissions)
-                if self.__validate_submission_(submission, word_limit):
-                    self.__posts.append(submission)
-                    count -= 1
-                iterations += 1
-
+        self.__log_(
+            f"Rejected posts by rule: {dict(self.__submission_filter.rejections)}"
+        )
+        if count > 0:
+            raise ValueError("Could not find enough posts")
         self.__log_("Got posts")
         return self.__posts
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
-    def get_comments(self, word_limit: int = 200, limit: int = 6):
+    def get_comments(
+        self,
+        word_limit: int = 200,
+        limit: int = 6,
+        sort: Literal["confidence", "top", "new", "controversial", "old", "qa"] = "top",
+        max_workers: int = 4,
+    ):
         """
-        Get comments from posts\n
+        Get top-level comments from posts\n
         :param word_limit: Maximum number of words in a comment
-        :param limit: Maximum number of comments to get
+        :param limit: Maximum number of comments to get per post
+        :param sort: Order in which Reddit returns the comments
+        :param max_workers: Number of posts to fetch comments for at the same time
         """
         self.__log_("Getting comments...")
-        self.__comments = {}
-        for post in self.__posts:
-            self.__comments[post.id] = []
-            for top_level_comment in post.comments:
-                if (
-                    "http" not in top_level_comment.body
-                    and len(top_level_comment.body.split()) < word_limit
-                    and len(self.__comments[post.id]) < limit
-                ):
-                    self.__comments[post.id].append(top_level_comment)
-                elif len(self.__comments[post.id]) >= limit:
-                    break
+        if limit < 1:
+            raise ValueError("Limit cannot be less than 1")
+
+        if self.__comment_executor is None or self.__comment_workers != max_workers:
+            if self.__comment_executor is not None:
+                self.__comment_executor.shutdown()
+            self.__comment_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="comments"
+            )
+            self.__comment_workers = max_workers
+        futures = {
+            post.id: self.__comment_executor.submit(
+                self.__fetch_top_level_comments_, post, word_limit, limit, sort
+            )
+            for post in self.__posts
+        }
+        self.__comments = {
+            post_id: future.result() for post_id, future in futures.items()
+        }
 
         self.__log_("Got comments")
         return self.__comments
 
-    @timeout(2400, os.strerror(errno.ETIMEDOUT))
-    def __create_subtitle_clips_(
+    def __fetch_top_level_comments_(
         self,
-        words: list,
-        video_width: int,
-        fontsize: int,
-        font: str,
-        color: str,
-        stroke_width: int,
-        stroke_color: str,
-        title_narration_duration: int = 0,
+        post: "RedditContentFarmer.PrawModels.Submission",
+        word_limit: int,
+        limit: int,
+        sort: str,
     ):
         """
-        Create subtitle clips from words\n
-        :param words: List of words
-        :param video_width: Width of the video
-        :param fontsize: Font size of the subtitles
-        :param font: Font of the subtitles
-        :param color: Color of the subtitles
-        :param stroke_width: Stroke width of the subtitles
-        :param stroke_color: Stroke color of the subtitles
+        Fetch only the first level of a post's comment tree\n
+        :param post: The post to get comments from
+        :param word_limit: Maximum number of words in a comment
+        :param limit: Maximum number of comments to get
+        :param sort: Order in which Reddit returns the comments
+        """
+        import praw
+        from praw.const import API_PATH
+
+        reddit = self.__get_thread_reddit_client_()
+        # Ask for a few extra comments since some are filtered out below,
+        # depth=1 keeps Reddit from sending the replies of every comment
+        _, comment_listing = self.__reddit_access.call(
+            reddit,
+            lambda: reddit.get(
+                API_PATH["submission"].format(id=post.id),
+                params={"limit": limit * 3, "sort": sort, "depth": 1},
+            ),
+        )
+        comments = []
+        for comment in comment_listing.children:
+            # Skips the MoreComments placeholders mixed into the listing
+            if not isinstance(comment, praw.models.Comment):
+                continue
+            if comment.stickied or comment.body in ("[deleted]", "[removed]"):
+                continue
+            if "http" in comment.body or len(comment.body.split()) >= word_limit:
+                continue
+            comments.append(comment)
+            if len(comments) >= limit:
+                break
+        return comments
+
+    def __get_thread_reddit_client_(self):
         """
+        Get a Reddit client for the calling thread, PRAW clients are not thread safe
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.__reddit_client
+        if not hasattr(self.__thread_local, "reddit_client"):
+            import praw
 
-        try:
-            from moviepy.editor import (
-                TextClip,
-                CompositeVideoClip,
+            self.__thread_local.reddit_client = praw.Reddit(
+                client_id=self.__client_id,
+                client_secret=self.__client_secret,
+                user_agent=self.__user_agent,
             )
-            from moviepy.video.fx.resize import resize
-        except ModuleNotFoundError:
-            raise ValueError(
-                "Please install moviepy by running `pip install -r requirements.txt`"
-            ) from None
+        return self.__thread_local.reddit_client
 
-        word_clips = []
+    @timeout(2400, os.strerror(errno.ETIMEDOUT))
+    def __create_subtitle_specs_(
+        self,
+        words: list,
+        title_narration_duration: int = 0,
+    ) -> list:
+        """
+        Create subtitle specs from words, they are only rasterized while the video is encoded\n
+        :param words: List of words
+        :param title_narration_duration: Second the narration of the words starts at
+        """
+        specs = []
         for word in words:
             start_time = (
                 math.floor((word.start_sec) * 100) / 100 + title_narration_duration
@@ -284,52 +458,24 @@ class RedditContentFarmer:
             self.__log_(
                 f"Word: {word.word.upper()}, Start time: {start_time}, End time: {end_time}, Duration: {duration}"
             )
-            word_stroke_layer = (
-                TextClip(
-                    word.word.upper(),
-                    fontsize=fontsize,
-                    font=font,
-                    color=color,
-                    stroke_color=stroke_color,
-                    stroke_width=stroke_width,
-                    bg_color="transparent",
-                    size=(video_width * 3 / 4, None),
-                    method="caption",
-                )
-                .set_start(start_time)
-                .set_duration(duration)
-            )
-            word_color_layer = (
-                TextClip(
-                    word.word.upper(),
-                    fontsize=fontsize,
-                    font=font,
-                    stroke_color="transparent",
-                    stroke_width=stroke_width,
-                    color=color,
-                    bg_color="transparent",
-                    size=(video_width * 3 / 4, None),
-                    method="caption",
-                )
-                .set_start(start_time)
-                .set_duration(duration)
+            specs.append(
+                SubtitleSpec(word.word.upper(), start_time, start_time + duration)
             )
-            word_clip = CompositeVideoClip([word_stroke_layer, word_color_layer])
-            word_position = ("center", "center")
-            word_clips.append(word_clip.set_position(word_position))
 
-        return word_clips
+        return specs
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
     def __create_title_image_clip_(
         self,
         words: list,
         title_image: str,
+        scale: float = 1,
     ):
         """
         Create title image from title words\n
         :param words: List of words
         :param title_image: Path to the title image
+        :param scale: Factor the title image is scaled by, on top of its usual size
         """
 
         try:
@@ -349,7 +495,7 @@ class RedditContentFarmer:
             f"Title image: {title_image}, Start time: {start_time}, End time: {end_time}, Duration: {duration}"
         )
         title_image_clip = ImageClip(title_image).set_duration(duration)
-        title_image_clip = resize(title_image_clip, newsize=1.2)
+        title_image_clip = resize(title_image_clip, newsize=1.2 * scale)
         title_image_clips = [title_image_clip.set_position("center")]
 
         return title_image_clips
@@ -371,6 +517,24 @@ class RedditContentFarmer:
                 f"Please make sure you have the default `reddit.png` file in your subreddit_icons folder."
             )
 
+        # The icons are part of the key so replacing one redraws the cards
+        icons = [
+            (icon, os.path.getsize(icon), os.path.getmtime(icon))
+            for icon in ("subreddit_icons/reddit.png", "subreddit_icons/awards.png")
+        ]
+        cache_key = hash_inputs({"text": text, "username": username, "icons": icons})
+        entry_dir = self.__title_card_cache.get(cache_key)
+        if entry_dir:
+            try:
+                for name in ("title.png", "thumbnail.png"):
+                    shutil.copyfile(
+                        os.path.join(entry_dir, name), os.path.join(output_path, name)
+                    )
+                return
+            except FileNotFoundError:
+                # Evicted by another process while it was being read
+                pass
+
         def add_corners(im, rad):
             circle = Image.new("L", (rad * 2, rad * 2), 0)
             draw = ImageDraw.Draw(circle)
@@ -436,6 +600,34 @@ class RedditContentFarmer:
         thumbnail = Image.new(img.mode, (550, 550), (255, 255, 255))
         thumbnail.paste(img, (25, 275 - math.floor((len(lines) * 28 + 10) / 2)))
         thumbnail.save(output_path + "/thumbnail.png")
+        self.__title_card_cache.put(
+            cache_key,
+            {
+                "title.png": output_path + "/title.png",
+                "thumbnail.png": output_path + "/thumbnail.png",
+            },
+        )
+
+    def narration_texts(self, include_comments: bool = False) -> dict:
+        """
+        Get the texts narrated in a video of the current post. The title, story and
+        comments are separate narration units so they can be cached and narrated in parallel\n
+        :param include_comments: Whether to narrate the post's comments after the story
+        :return: Names of the narration units mapped to their text
+        """
+        if len(self.__posts) == 0:
+            raise ValueError("Please get posts before getting the narration texts")
+
+        post = self.__posts[0]
+        texts = {"title": post.title}
+        if post.selftext.strip():
+            texts["story"] = post.selftext
+        if include_comments:
+            if post.id not in self.__comments:
+                self.get_comments()
+            for index, comment in enumerate(self.__comments[post.id]):
+                texts[f"comment_{index}"] = comment.body
+        return texts
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
     def create_video(
@@ -450,6 +642,14 @@ class RedditContentFarmer:
         color: str = "white",
         stroke_width: int = 10,
         stroke_color: str = "black",
+        include_comments: bool = False,
+        narration_workers: int = 2,
+        use_bed: bool = True,
+        manifest: JobManifest = None,
+        workspace: Workspace = None,
+        profiles: list = None,
+        draft: bool = False,
+        contact_sheet: list = None,
     ):
         """
         Create a video from posts\n
@@ -463,6 +663,19 @@ class RedditContentFarmer:
         :param color: Color of the subtitles
         :param stroke_width: Stroke width of the subtitles
         :param stroke_color: Stroke color of the subtitles
+        :param include_comments: Whether to narrate the post's comments after the story
+        :param narration_workers: Number of narrations to create at the same time
+        :param use_bed: Whether to take a pre-rendered background from the bed pool,
+            otherwise the background is composed from clips
+        :param manifest: Manifest of the job, stages it records as done are skipped
+        :param workspace: Workspace of the job, output_path is ignored if set
+        :param profiles: OutputProfiles of the variants to encode from the single render,
+            the master, Instagram and TikTok variants if not set
+        :param draft: Whether to quickly render a small, low frame rate preview to
+            output_draft.mp4 instead of the variants, e.g. to check a new font
+        :param contact_sheet: Seconds to take still frames at for contact_sheet.png,
+            instead of encoding a video
+        :return: Path of the preview or contact sheet, if one was made
         """
         self.__log_(f"Creating video with narrator {narrator}...")
 
@@ -470,7 +683,7 @@ class RedditContentFarmer:
             raise ValueError("Please get posts before creating a video")
 
         try:
-            from speechify_narration import get_speechify_narration
+            from speechify_narration import Word
         except ModuleNotFoundError:
             raise ValueError(
                 "The speechify narration module is not found. Please refer to the README for installation instructions and try reinstalling the files."
@@ -507,92 +720,312 @@ class RedditContentFarmer:
                 "Please install pvleopard by running `pip install -r requirements.txt`"
             ) from None
 
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
+        # Intermediate files go to the scratch folder and only the video is
+        # published to the output folder
+        if workspace is None:
+            workspace = Workspace(output_path)
+        output_path = workspace.job_dir
+        preview = draft or bool(contact_sheet)
+        if preview:
+            # Previews never change the variants or the job's recorded render
+            profiles = [DRAFT]
+        else:
+            profiles = profiles or DEFAULT_PROFILES
+            if any(profile.draft for profile in profiles):
+                raise ValueError("Draft profiles can only be used with draft=True")
+        scratch_artifact = lambda name: os.path.abspath(workspace.scratch(name))
+
+        # Without a manifest every stage simply runs
+        if manifest is None:
+            run_stage = lambda name, inputs, run, artifacts=(): run()
+        else:
+            run_stage = manifest.run_stage
+
+        post = self.__posts[0]
+        self.post_title = post.title
+        title_inputs = {
+            "post_id": post.id,
+            "title": post.title,
+            "username": post.author.name,
+        }
+        run_stage(
+            "title_card",
+            title_inputs,
+            lambda: self.__create_title_image_(
+                text=post.title,
+                username=post.author.name,
+                output_path=output_path,
+            ),
+            artifacts=["title.png", "thumbnail.png"],
+        )
 
-        self.post_title = self.__posts[0].title
-        self.__create_title_image_(
-            text=self.__posts[0].title,
-            username=self.__posts[0].author.name,
-            output_path=output_path,
+        # Creates the mp3 files for the title, story and comments in the scratch
+        # folder
+        narration_texts = self.narration_texts(include_comments)
+        # The audio is recorded by its path in the scratch folder, which may
+        # change between runs, e.g. when /dev/shm is not available
+        narration_inputs = {
+            "narrator": narrator,
+            "texts": narration_texts,
+            "scratch_dir": os.path.abspath(workspace.scratch_dir),
+        }
+        narration = run_stage(
+            "narration",
+            narration_inputs,
+            lambda: self.__narrate_(
+                narrator=narrator,
+                texts=narration_texts,
+                output_path=workspace.scratch_dir,
+                narration_workers=narration_workers,
+            ),
+            artifacts=[
+                scratch_artifact(f"{name}_narration.{extension}")
+                for name in narration_texts
+                for extension in ("wav", "mp3")
+            ],
+        )
+        narration_words = {
+            name: [Word(**word) for word in words]
+            for name, words in narration["words"].items()
+        }
+        self.__audio_duration = narration["audio_duration"]
+
+        background_inputs = {
+            "audio_duration": self.__audio_duration,
+            "length_per_clip": length_per_clip,
+            "hasMusic": hasMusic,
+            "background_videos": sorted(os.listdir("background_videos/")),
+            "background_music": (
+                sorted(os.listdir("background_music/")) if hasMusic else []
+            ),
+        }
+        if preview:
+            # Previews reuse the job's background if it has one, but never
+            # take a bed from the pool or record a background of their own
+            if manifest and manifest.is_complete("background_plan", background_inputs):
+                background_plan = manifest.stage("background_plan")["result"]
+            else:
+                background_plan = plan_background(
+                    self.__audio_duration, length_per_clip, hasMusic
+                )
+            self.__log_("Rendering preview...")
+            result = self.__render_video_(
+                narration_words=narration_words,
+                background_plan=background_plan,
+                workspace=workspace,
+                font=font,
+                fontsize=fontsize,
+                color=color,
+                stroke_width=stroke_width,
+                stroke_color=stroke_color,
+                profiles=profiles,
+                fps=DRAFT_FPS,
+                scale=DRAFT_SCALE if draft else 1,
+                contact_sheet=contact_sheet,
+            )
+            return result.get("contact_sheet") or workspace.path(DRAFT.filename)
+
+        background_plan = run_stage(
+            "background_plan",
+            background_inputs,
+            lambda: self.__plan_background_(
+                audio_duration=self.__audio_duration,
+                length_per_clip=length_per_clip,
+                hasMusic=hasMusic,
+                use_bed=use_bed,
+                workspace=workspace,
+            ),
+            artifacts=lambda plan: [plan["bed"]] if plan.get("bed") else [],
         )
 
-        # Creates the mp3 files for the title and story in the output folder
-        self.__log_("Getting narration audio files...")
-        title_words = get_speechify_narration(
-            narrator=narrator,
-            text=self.__posts[0].title,
-            output_path=output_path,
-            output_filename="title_narration.wav",
+        render_inputs = {
+            "title_card": hash_inputs(title_inputs),
+            "narration": hash_inputs(narration_inputs),
+            "background_plan": hash_inputs(background_plan),
+            "font": font,
+            "fontsize": fontsize,
+            "color": color,
+            "stroke_width": stroke_width,
+            "stroke_color": stroke_color,
+            "profiles": [profile.to_dict() for profile in profiles],
+        }
+        run_stage(
+            "render",
+            render_inputs,
+            lambda: self.__render_video_(
+                narration_words=narration_words,
+                background_plan=background_plan,
+                workspace=workspace,
+                font=font,
+                fontsize=fontsize,
+                color=color,
+                stroke_width=stroke_width,
+                stroke_color=stroke_color,
+                profiles=profiles,
+            ),
+            artifacts=[profile.filename for profile in profiles],
         )
-        story_words = get_speechify_narration(
+        self.__variants = {
+            profile.name: workspace.path(profile.filename) for profile in profiles
+        }
+        VIDEOS.inc()
+
+    def __narrate_(
+        self,
+        narrator: str,
+        texts: dict,
+        output_path: str,
+        narration_workers: int,
+    ) -> dict:
+        """
+        Narrate every narration unit and measure the total narration duration\n
+        :param narrator: Narrator of the video
+        :param texts: Names of the narration units mapped to their text
+        :param output_path: Path to the output folder
+        :param narration_workers: Number of narrations to create at the same time
+        :return: The words of every unit and the audio duration
+        """
+        from speechify_narration import get_speechify_narrations
+
+        self.__log_("Getting narration audio files...")
+        narration_words = get_speechify_narrations(
             narrator=narrator,
-            text=self.__posts[0].selftext,
+            texts=texts,
             output_path=output_path,
-            output_filename="story_narration.wav",
+            max_workers=narration_workers,
+            cache=self.__narration_cache,
+            block_cache=self.__narration_block_cache,
         )
 
         # Get the duration of the output from the narration audio files
         self.__log_("Getting narration audio duration...")
-        self.__audio_duration = 0
-        with contextlib.closing(
-            wave.open(output_path + "/title_narration.wav", "rb")
-        ) as f:
-            frames = f.getnframes()
-            rate = f.getframerate()
-            self.__audio_duration += math.floor(frames / float(rate)) + 1
-        with contextlib.closing(
-            wave.open(output_path + "/story_narration.wav", "rb")
-        ) as f:
-            frames = f.getnframes()
-            rate = f.getframerate()
-            self.__audio_duration += math.floor(frames / float(rate)) + 1
-
-        # Get the background video clips and concatenate them
+        narration_seconds = 0
+        for name in narration_words:
+            with contextlib.closing(
+                wave.open(f"{output_path}/{name}_narration.wav", "rb")
+            ) as f:
+                frames = f.getnframes()
+                rate = f.getframerate()
+                narration_seconds += frames / float(rate)
+        # Rounded up once, not per unit, so comments do not add seconds of silence
+        audio_duration = math.floor(narration_seconds) + 1
+
+        return {
+            "words": {
+                name: [word.__dict__ for word in words]
+                for name, words in narration_words.items()
+            },
+            "audio_duration": audio_duration,
+        }
+
+    def __plan_background_(
+        self,
+        audio_duration: int,
+        length_per_clip: int,
+        hasMusic: bool,
+        use_bed: bool,
+        workspace: Workspace,
+    ) -> dict:
+        """
+        Pick the background of a video, a pre-rendered bed if one is ready\n
+        :param audio_duration: Duration of the narration
+        :param length_per_clip: Length of each background video clip
+        :param hasMusic: Whether to add background music
+        :param use_bed: Whether to take a bed from the pool
+        :param workspace: Workspace of the job, a bed is moved into its scratch folder
+        :return: The bed, or the background clips and music file to use
+        """
+        if (
+            use_bed
+            and self.__bed_pool is not None
+            and self.__bed_pool.music == hasMusic
+        ):
+            # The background is one second longer than the narration
+            bed = self.__bed_pool.take(audio_duration + 1)
+            if bed:
+                self.__log_("Using a pre-rendered background bed...")
+                bed_path = os.path.abspath(workspace.scratch("background_bed.mp4"))
+                shutil.move(bed, bed_path)
+                return {"bed": bed_path, "duration": audio_duration + 1}
+
+        self.__log_("Planning background video clips...")
+        return plan_background(audio_duration, length_per_clip, hasMusic)
+
+    def __render_video_(
+        self,
+        narration_words: dict,
+        background_plan: dict,
+        workspace: Workspace,
+        font: str,
+        fontsize: int,
+        color: str,
+        stroke_width: int,
+        stroke_color: str,
+        profiles: list,
+        fps: int = 30,
+        scale: float = 1,
+        contact_sheet: list = None,
+    ):
+        """
+        Composite the background, narration, title card and subtitles and encode every variant\n
+        :param narration_words: Names of the narration units mapped to their words
+        :param background_plan: Background bed or clips and music picked by __plan_background_
+        :param workspace: Workspace of the job
+        :param font: Font of the subtitles
+        :param fontsize: Font size of the subtitles
+        :param color: Color of the subtitles
+        :param stroke_width: Stroke width of the subtitles
+        :param stroke_color: Stroke color of the subtitles
+        :param profiles: OutputProfiles of the variants to encode
+        :param fps: Frame rate of the variants
+        :param scale: Factor the video, title card and subtitles are scaled by before compositing
+        :param contact_sheet: Seconds to take still frames at for contact_sheet.png,
+            instead of encoding the variants
+        """
+        from moviepy.editor import (
+            CompositeAudioClip,
+            AudioFileClip,
+            VideoFileClip,
+            CompositeVideoClip,
+            concatenate_audioclips,
+        )
+
+        # Get the background video, either a bed trimmed to the narration or
+        # the planned clips concatenated
         self.__log_("Getting background video clips...")
-        num_iterations = self.__audio_duration // length_per_clip
-        remainder = self.__audio_duration % length_per_clip
-        background_video_clips = []
-        for i in range(num_iterations + 1):
-            if i == num_iterations:
-                clip_duration = remainder + 1
-            else:
-                clip_duration = length_per_clip
+        if background_plan.get("bed"):
+            bed = VideoFileClip(background_plan["bed"])
+            bed = bed.subclip(0, min(background_plan["duration"], bed.duration))
+            background_video_without_audio = bed.without_audio()
+            background_music = bed.audio
+        else:
+            background_video_without_audio, background_music = compose_background(
+                background_plan
+            )
 
-            background_video_path = random.choice(os.listdir("background_videos/"))
-            self.__log_(f"Clip {i}: {background_video_path}, Duration: {clip_duration}")
-            full_clip = VideoFileClip("background_videos/" + background_video_path)
-            clip_start = (
-                random.randint(0, math.floor(full_clip.duration)) - clip_duration
+        if scale != 1:
+            # Even sizes, since the encoder cannot handle odd ones
+            width, height = background_video_without_audio.size
+            background_video_without_audio = background_video_without_audio.resize(
+                newsize=(int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
             )
-            clip = full_clip.subclip(
-                clip_start, clip_start + clip_duration
-            ).without_audio()
-            background_video_clips.append(clip)
-        background_video_without_audio = concatenate_videoclips(
-            background_video_clips, method="compose"
-        )
+            fontsize = max(int(fontsize * scale), 1)
+            stroke_width = max(int(stroke_width * scale), 1) if stroke_width else 0
 
         # Get the background music and composite it with the narration audio
         self.__log_("Compositing audio and video files...")
-        title_narration = AudioFileClip(output_path + "/title_narration.mp3")
-        title_narration = title_narration.set_duration(
-            math.floor(title_narration.duration * 100) / 100
-        )
-        story_narration = AudioFileClip(output_path + "/story_narration.mp3")
-        story_narration = story_narration.set_duration(
-            math.floor(story_narration.duration * 100) / 100
-        )
-        narration = concatenate_audioclips([title_narration, story_narration])
-        if hasMusic:
-            background_audio_music_path = random.choice(os.listdir("background_music/"))
-            background_audio_music = volumex(
-                AudioFileClip("background_music/" + background_audio_music_path), 0.1
+        narration_clips = {}
+        for name in narration_words:
+            narration_clip = AudioFileClip(
+                os.path.join(workspace.scratch_dir, f"{name}_narration.mp3")
             )
-            background_audio_music = audio_loop(
-                background_audio_music, duration=narration.duration
+            narration_clips[name] = narration_clip.set_duration(
+                math.floor(narration_clip.duration * 100) / 100
             )
-            audio_clip = CompositeAudioClip([narration, background_audio_music])
+        narration = concatenate_audioclips(list(narration_clips.values()))
+        if background_music is not None:
+            background_music = background_music.set_duration(narration.duration)
+            audio_clip = CompositeAudioClip([narration, background_music])
         else:
             audio_clip = narration
         background_video = background_video_without_audio.set_audio(
@@ -609,31 +1042,90 @@ class RedditContentFarmer:
         #     output_path + "/story_narration.wav"
         # )
         title_image_clips = self.__create_title_image_clip_(
-            words=title_words,
-            title_image=f"{output_path}/title.png",
+            words=narration_words["title"],
+            title_image=workspace.path("title.png"),
+            scale=scale,
         )
-        subtitle_clips = self.__create_subtitle_clips_(
-            title_narration_duration=title_narration.duration,
-            words=story_words,
-            video_width=background_video.size[0],
+        subtitle_specs = []
+        narration_start = narration_clips["title"].duration
+        for name, words in narration_words.items():
+            if name == "title":
+                continue
+            subtitle_specs += self.__create_subtitle_specs_(
+                title_narration_duration=narration_start,
+                words=words,
+            )
+            narration_start += narration_clips[name].duration
+        subtitles = SubtitleOverlay(
+            subtitle_specs,
+            video_size=background_video.size,
             fontsize=fontsize,
             font=font,
             color=color,
             stroke_width=stroke_width,
             stroke_color=stroke_color,
         )
-        text_clips = title_image_clips + subtitle_clips
 
-        # Composite the background video and the subtitles
+        # Composite the background video and the title, the subtitles are drawn
+        # onto each frame as it is encoded
         self.__log_("Compositing background video and subtitles...")
-        video = CompositeVideoClip([background_video] + text_clips)
-        video.write_videofile(
-            output_path + "/output.mp4",
-            temp_audiofile=output_path + "/temp_output.mp3",
-            fps=30,
-            verbose=False,
-            logger=None,
+        video = CompositeVideoClip([background_video] + title_image_clips).fl(
+            subtitles.apply
         )
+        if contact_sheet:
+            return {
+                "contact_sheet": self.__create_contact_sheet_(
+                    video, contact_sheet, workspace.path("contact_sheet.png")
+                )
+            }
+        for profile in profiles:
+            workspace.scratch(profile.filename)
+        write_variants(
+            video,
+            profiles,
+            output_dir=workspace.scratch_dir,
+            temp_audiofile=workspace.scratch("temp_output.mp3"),
+            fps=fps,
+        )
+        for profile in profiles:
+            workspace.publish(profile.filename)
+
+        peak_rss = peak_rss_mb()
+        self.__log_(
+            f"Rasterized {subtitles.rasterized} subtitles for {len(subtitle_specs)} "
+            f"words, peak RSS {peak_rss['self']} MB, ffmpeg {peak_rss['children']} MB"
+        )
+        return {
+            "subtitles": len(subtitle_specs),
+            "rasterized_subtitles": subtitles.rasterized,
+            "peak_rss_mb": peak_rss,
+        }
+
+    def __create_contact_sheet_(self, video, timestamps: list, path: str) -> str:
+        """
+        Save still frames of a video side by side in one image, without encoding the video\n
+        :param video: The composited video clip
+        :param timestamps: Seconds to take the frames at
+        :param path: Path to save the contact sheet to
+        :return: The path of the contact sheet
+        """
+        from PIL import Image, ImageDraw
+
+        columns = min(len(timestamps), 4)
+        rows = math.ceil(len(timestamps) / columns)
+        width, height = video.size
+        sheet = Image.new("RGB", (width * columns, height * rows), (0, 0, 0))
+        draw = ImageDraw.Draw(sheet)
+        for index, timestamp in enumerate(timestamps):
+            # Frames past the end show the last frame
+            timestamp = min(max(timestamp, 0), video.duration - 1 / 30)
+            self.__log_(f"Contact sheet frame at {timestamp:.2f}s")
+            frame = Image.fromarray(video.get_frame(timestamp))
+            x, y = (index % columns) * width, (index // columns) * height
+            sheet.paste(frame, (x, y))
+            draw.text((x + 10, y + 10), f"{timestamp:.2f}s", fill=(255, 255, 0))
+        sheet.save(path)
+        return path
 
     @timeout(2400, os.strerror(errno.ETIMEDOUT))
     def upload_to_instagram(
@@ -643,24 +1135,23 @@ class RedditContentFarmer:
         input_path: str,
         output_path: str,
         caption: str,
+        duration: float = None,
+        post: "RedditContentFarmer.PrawModels.Submission" = None,
+        mark_used: bool = True,
     ):
         """
         Upload a video to Instagram\n
         :param username: Username of the Instagram account
         :param password: Password of the Instagram account
         :param input_path: Path to the video to upload
+        :param output_path: Path to the folder containing the video's thumbnail
         :param caption: Caption of the post
+        :param duration: Duration of the video, defaults to the last created video
+        :param post: Post the video was made from, defaults to the last created video
+        :param mark_used: Whether to add the post to used_stories.txt after uploading
         """
 
-        self.__log_("Uploading to Instagram...")
-        try:
-            from instagrapi import Client
-            from instagrapi.exceptions import LoginRequired
-        except ModuleNotFoundError:
-            raise ValueError(
-                "Please install instagrapi by running `pip install -r requirements.txt`"
-            ) from None
-
+        self.__log_(f"Uploading to Instagram account {username}...")
         if not os.path.exists(input_path):
             raise ValueError("Input video not found.")
 
@@ -671,71 +1162,95 @@ class RedditContentFarmer:
                 "Please install PIL by running `pip install -r requirements.txt`"
             ) from None
 
-        cl = Client()
-        self.__log_("Loading session file...")
-        session_exists = os.path.exists("instagram_session/session.json")
-        if not session_exists:
-            self.__log_("Session file not found, creating empty file...")
-            if not os.path.exists("instagram_session"):
-                os.makedirs("instagram_session")
-            with open("instagram_session/session.json", "w") as file:
-                json.dump({}, file)
-        else:
-            cl.load_settings("instagram_session/session.json")
-        cl.login(username, password)
-        if not session_exists:
-            self.__log_("Saving session to session file...")
-            cl.dump_settings("instagram_session/session.json")
-
-        try:
-            cl.get_timeline_feed()
-        except LoginRequired:
-            self.__log_("Session is invalid, logging in using username and password...")
-            old_session = cl.get_settings()
-            cl.set_settings({})
-            cl.set_uuids(old_session["uuids"])
-            cl.login(username, password)
-            cl.dump_settings("instagram_session/session.json")
+        # Each upload converts its own copy, accounts may publish the same video
+        # at the same time
+        thumbnail_path = os.path.join(
+            output_path, f"thumbnail.{os.getpid()}.{threading.get_ident()}.jpg"
+        )
+        Image.open(output_path + "/thumbnail.png").save(thumbnail_path)
+        if duration is None:
+            duration = self.__audio_duration
+        if post is None:
+            post = self.__posts[0]
+
+        def upload(cl):
+            if duration < 60:
+                cl.video_upload(
+                    path=input_path,
+                    caption=caption,
+                    thumbnail=thumbnail_path,
+                )
+            else:
+                cl.clip_upload(
+                    path=input_path,
+                    caption=caption,
+                    thumbnail=thumbnail_path,
+                )
 
+        # Reuses the logged in client of the account, logging in only when
+        # Instagram says the session is no longer valid
         try:
-            cl.get_timeline_feed()
-        except LoginRequired:
-            raise ValueError("Invalid username or password.")
-
-        thumbnail = Image.open(output_path + "/thumbnail.png")
-        thumbnail.save(output_path + "/thumbnail.jpg")
-        if self.__audio_duration < 60:
-            cl.video_upload(
-                path=input_path,
-                caption=caption,
-                thumbnail=output_path + "/thumbnail.jpg",
-            )
-        else:
-            cl.clip_upload(
-                path=input_path,
-                caption=caption,
-                thumbnail=output_path + "/thumbnail.jpg",
-            )
+            self.__instagram_sessions.run(username, password, upload)
+        finally:
+            os.remove(thumbnail_path)
         self.__log_("Uploaded to Instagram")
-        self.__log_("Updating used_stories.txt...")
-        self.add_story_title_to_file(self.__posts[0])
-        self.__log_("Updated used_stories.txt")
-
-    def __del__(self):
-        """
-        Kill browser processes
-        """
-        # Windows
-        # os.system("taskkill /f /im geckodriver.exe /T")
-        # os.system("taskkill /f /im chromedriver.exe /T")
-        # os.system("taskkill /f /im chrome.exe /T")
-        # os.system("taskkill /f /im IEDriverServer.exe /T")
-        # Linux
-        os.system("killall -KILL geckodriver")
-        os.system("killall -KILL chromedriver")
-        os.system("killall -KILL chrome")
-        os.system("killall -KILL IEDriverServer")
-        os.system("sudo shutdown -h now")
+        if mark_used:
+            self.__log_("Updating used_stories.txt...")
+            self.add_story_title_to_file(post)
+            self.__log_("Updated used_stories.txt")
+
+    @property
+    def post(self) -> "RedditContentFarmer.PrawModels.Submission":
+        """
+        The post used for the last created video
+        """
+        return self.__posts[0] if self.__posts else None
+
+    @property
+    def reddit_access(self) -> RedditAccess:
+        """
+        The access layer used for Reddit API calls
+        """
+        return self.__reddit_access
+
+    @property
+    def variants(self) -> dict:
+        """
+        Output profile names mapped to the paths of the variants of the last created video
+        """
+        return self.__variants
+
+    @property
+    def audio_duration(self) -> int:
+        """
+        Duration in seconds of the narration of the last created video
+        """
+        return self.__audio_duration
+
+    def close(self):
+        """
+        Kill the browser processes started by this process and, if enabled, shut down the machine
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__comment_executor is not None:
+            self.__comment_executor.shutdown()
+            self.__comment_executor = None
+        # Pooled browsers are quit properly, anything left over is killed
+        close_shared_pool()
+        killed = browser_processes.kill_tracked()
+        if killed:
+            self.__log_(f"Killed leftover browser processes: {killed}")
+        if self.__shutdown_on_close:
+            self.__log_("Shutting down...")
+            os.system("sudo shutdown -h now")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __log_(self, log: str) -> None:
         """
@@ -743,7 +1258,7 @@ class RedditContentFarmer:
         :param log: Message to log
         """
         self.__logger.debug(log)
-        self.__cloud_logger.log_text(log)
+        self.__get_cloud_logger_().log_text(log)
 
     def __init_logger_(self, verbose: bool) -> None:
         """
@@ -751,7 +1266,8 @@ class RedditContentFarmer:
         :param verbose: Whether to enable verbose logging
         """
         self.__logger = logging.getLogger("RedditContentFarmer")
-        self.__cloud_logger = cloud_logging.Client().logger("RedditContentFarmer")
+        # Created on the first log call, see __get_cloud_logger_
+        self.__cloud_logger = None
         # self.__cloud_logger = FakeCloudLogger()
         self.__logger.setLevel(logging.DEBUG)
         if verbose:
@@ -760,6 +1276,16 @@ class RedditContentFarmer:
             stream_handler.setFormatter(formatter)
             self.__logger.addHandler(stream_handler)
 
+    def __get_cloud_logger_(self):
+        """
+        Get the Cloud Logging logger, creating the client on first use
+        """
+        if self.__cloud_logger is None:
+            from google.cloud import logging as cloud_logging
+
+            self.__cloud_logger = cloud_logging.Client().logger("RedditContentFarmer")
+        return self.__cloud_logger
+
 
 # class FakeCloudLogger:
 #     def __init__(self):
@@ -0,0 +1,246 @@
+import os
+import json
+import math
+import logging
+
+logger = logging.getLogger("RedditContentFarmer.render_planner")
+
+# Used until enough jobs have run to learn from, roughly 150 spoken words per
+# minute and a render twice as slow as real time. The frames are composited once
+# for every variant, so each variant after the first only adds its encode
+DEFAULT_RATES = {
+    "audio_seconds_per_word": 0.4,
+    "narration_seconds_per_word": 0.5,
+    "render_seconds_per_second": {"bed": 1.2, "compose": 2.0},
+    "encode_seconds_per_second": 0.3,
+}
+
+
+class RenderPlan:
+    """
+    Predicted cost of a video and the settings chosen to make it
+    """
+
+    def __init__(self, estimates: dict, settings: dict, target_seconds: float):
+        """
+        :param estimates: Predicted narration duration, overlays, background segments and timings
+        :param settings: Chosen renderer, narration workers and output profiles
+        :param target_seconds: Time the video should be made in
+        """
+        self.estimates = estimates
+        self.settings = settings
+        self.target_seconds = target_seconds
+
+    @property
+    def total_seconds(self) -> float:
+        return self.estimates["narration_seconds"] + self.estimates["render_seconds"]
+
+    @property
+    def fits(self) -> bool:
+        """
+        Whether the video is predicted to be made within the target time
+        """
+        return self.total_seconds <= self.target_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "estimates": self.estimates,
+            "settings": self.settings,
+            "target_seconds": self.target_seconds,
+            "total_seconds": round(self.total_seconds, 1),
+            "fits": self.fits,
+        }
+
+
+class RenderPlanner:
+    """
+    Predicts how long narrating and rendering a story takes from the timings of past jobs
+    """
+
+    def __init__(
+        self,
+        jobs_dir: str = "output/jobs",
+        target_seconds: float = 900,
+        history: int = 200,
+        length_per_clip: int = 14,
+    ):
+        """
+        Initialize the planner\n
+        :param jobs_dir: Folder containing a folder per job, whose manifests are learned from
+        :param target_seconds: Time a video should be made in
+        :param history: Number of most recent jobs to learn from
+        :param length_per_clip: Length of each background video clip
+        """
+        self.jobs_dir = jobs_dir
+        self.target_seconds = target_seconds
+        self.history = history
+        self.length_per_clip = length_per_clip
+        self.rates = json.loads(json.dumps(DEFAULT_RATES))
+        self.samples = 0
+
+    def refresh(self) -> dict:
+        """
+        Learn the rates from the recorded stages of recent jobs\n
+        :return: The rates in use
+        """
+        words = audio = 0
+        narrated_words = narration_seconds = 0
+        render = {renderer: [0, 0] for renderer in ("bed", "compose")}
+        samples = 0
+        for stages in self.__recent_stages_():
+            plan = stages["plan"]["result"]
+            narration = stages["narration"]
+            render_stage = stages["render"]
+            estimates = plan["estimates"]
+            duration = narration["result"]["audio_duration"]
+            if not estimates["words"] or not duration:
+                continue
+            samples += 1
+            words += estimates["words"]
+            audio += duration
+            # Narrations served from the cache say nothing about the TTS speed
+            if narration["elapsed"] and narration["elapsed"] >= 1:
+                narrated_words += self.__narrated_words_(
+                    estimates["words"],
+                    estimates["longest_unit"],
+                    plan["settings"]["narration_workers"],
+                )
+                narration_seconds += narration["elapsed"]
+            # The planned bed may have been taken by another worker meanwhile
+            renderer = plan["settings"]["renderer"]
+            if "background_plan" in stages:
+                background = stages["background_plan"]["result"]
+                renderer = "bed" if background.get("bed") else "compose"
+            if render_stage["elapsed"] and renderer in render:
+                # The render stage is timed as a whole, so the encodes of the
+                # extra variants are taken off at the encode rate
+                extra_profiles = len(plan["settings"]["profiles"]) - 1
+                encode_rate = self.rates["encode_seconds_per_second"]
+                encode = duration * extra_profiles * encode_rate
+                render[renderer][0] += duration
+                render[renderer][1] += max(render_stage["elapsed"] - encode, 0)
+
+        if words:
+            self.rates["audio_seconds_per_word"] = audio / words
+        if narrated_words:
+            rate = narration_seconds / narrated_words
+            self.rates["narration_seconds_per_word"] = rate
+        for renderer, (seconds, elapsed) in render.items():
+            if seconds:
+                self.rates["render_seconds_per_second"][renderer] = elapsed / seconds
+        self.samples = samples
+        logger.debug(f"Learned render rates from {samples} jobs: {self.rates}")
+        return self.rates
+
+    def estimate(
+        self,
+        texts: dict,
+        renderer: str = "compose",
+        narration_workers: int = 2,
+        profiles: int = 3,
+    ) -> dict:
+        """
+        Predict the cost of a video\n
+        :param texts: Names of the narration units mapped to their text
+        :param renderer: `bed` if a pre-rendered background is used, otherwise `compose`
+        :param narration_workers: Number of narrations created at the same time
+        :param profiles: Number of output variants encoded
+        """
+        counts = [len(text.split()) for text in texts.values()]
+        words = sum(counts)
+        # The narration is rounded up to the next second
+        narration_duration = (
+            math.floor(words * self.rates["audio_seconds_per_word"]) + 1
+        )
+        video_seconds = narration_duration + 1
+        longest_unit = max(counts, default=0)
+        narration_seconds = (
+            self.__narrated_words_(words, longest_unit, narration_workers)
+            * self.rates["narration_seconds_per_word"]
+        )
+        render_seconds = video_seconds * (
+            self.rates["render_seconds_per_second"][renderer]
+            + max(profiles - 1, 0) * self.rates["encode_seconds_per_second"]
+        )
+        return {
+            "words": words,
+            "units": len(counts),
+            "longest_unit": longest_unit,
+            "narration_duration": narration_duration,
+            # One subtitle per word of everything but the title, which is
+            # shown as the title card
+            "overlays": words - counts[0] + 1 if counts else 0,
+            "background_segments": narration_duration // self.length_per_clip + 1,
+            "narration_seconds": round(narration_seconds, 1),
+            "render_seconds": round(render_seconds, 1),
+        }
+
+    def plan(
+        self,
+        texts: dict,
+        profiles: list,
+        bed_lengths=(),
+        max_narration_workers: int = 4,
+    ) -> RenderPlan:
+        """
+        Choose the settings that make the video within the target time with as few
+        browsers as possible. Every output profile is kept, since the uploads depend on
+        them, only the narration workers and the renderer are chosen. If none of them
+        makes the target, the fastest settings are returned with fits set to False\n
+        :param texts: Names of the narration units mapped to their text
+        :param profiles: OutputProfiles to encode
+        :param bed_lengths: Lengths of the pre-rendered backgrounds that are ready
+        :param max_narration_workers: Maximum number of browsers narrating at once
+        """
+        video_seconds = self.estimate(texts)["narration_duration"] + 1
+        renderers = ["compose"]
+        if any(length >= video_seconds for length in bed_lengths):
+            renderers.append("bed")
+        fastest = None
+        for workers in range(1, max(max_narration_workers, 1) + 1):
+            plans = [
+                RenderPlan(
+                    self.estimate(texts, renderer, workers, len(profiles)),
+                    {
+                        "renderer": renderer,
+                        "narration_workers": workers,
+                        "profiles": [profile.name for profile in profiles],
+                    },
+                    self.target_seconds,
+                )
+                for renderer in renderers
+            ]
+            plan = min(plans, key=lambda plan: plan.total_seconds)
+            if plan.fits:
+                logger.debug(
+                    f"Expecting the video to take {plan.total_seconds:.0f}s "
+                    f"with {plan.settings}: {plan.estimates}"
+                )
+                return plan
+            if fastest is None or plan.total_seconds < fastest.total_seconds:
+                fastest = plan
+        # The video is still made, only slower than the target
+        logger.warning(
+            f"No settings make the video within {self.target_seconds}s, the fastest "
+            f"takes {fastest.total_seconds:.0f}s with {fastest.settings}"
+        )
+        return fastest
+
+    @staticmethod
+    def __narrated_words_(words: int, longest_unit: int, workers: int) -> float:
+        # Units are narrated in parallel, so the narration takes as long as a
+        # worker's share of the words, or the longest unit if that is longer
+        return max(words / max(workers, 1), longest_unit)
+
+    def __recent_stages_(self):
+        if not os.path.isdir(self.jobs_dir):
+            return
+        for job_id in sorted(os.listdir(self.jobs_dir), reverse=True)[: self.history]:
+            manifest_path = os.path.join(self.jobs_dir, job_id, "manifest.json")
+            try:
+                with open(manifest_path, "r") as file:
+                    stages = json.load(file)["stages"]
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+            if all(stage in stages for stage in ("plan", "narration", "render")):
+                yield stages
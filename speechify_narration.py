@@ -1,20 +1,62 @@
 import io
+import os
 import json
 import time
-import nltk
 import math
 import base64
+import shutil
+import hashlib
+import logging
+import threading
 from typing import Literal
-from pydub import AudioSegment
-import undetected_chromedriver as uc
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from browser_pool import BrowserPool, shared_pool
+from metrics import REGISTRY
+from pipeline import atomic_write_json
+from cache_manager import CacheNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("RedditContentFarmer.speechify_narration")
+
+SPEECHIFY_URL = "https://speechify.com/text-to-speech-online/"
+
+NARRATIONS = REGISTRY.counter(
+    "rcf_narrations_total", "Narrations made with Speechify by outcome", ["result"]
+)
+NARRATION_SECONDS = REGISTRY.histogram(
+    "rcf_narration_seconds", "Seconds a Speechify narration took, browser included"
+)
+BLOCKS = REGISTRY.counter(
+    "rcf_narration_blocks_total", "Narration blocks by outcome", ["result"]
+)
+BLOCK_SECONDS = REGISTRY.histogram(
+    "rcf_narration_block_seconds", "Seconds Speechify took to narrate a block"
+)
 
 # Work in progress
 
-nltk.download("punkt")
+# nltk, pydub and selenium are imported on first use
+# so that importing this module stays cheap for workers that never narrate
+_punkt_checked = False
+_punkt_lock = threading.Lock()
+
+
+def ensure_punkt():
+    """
+    Make sure the punkt tokenizer data is installed, downloading it only if it is missing
+    """
+    global _punkt_checked
+    if _punkt_checked:
+        return
+    with _punkt_lock:
+        if _punkt_checked:
+            return
+        import nltk
+
+        try:
+            nltk.data.find("tokenizers/punkt")
+        except LookupError:
+            nltk.download("punkt", quiet=True)
+        _punkt_checked = True
 
 
 class Word:
@@ -39,7 +81,16 @@ def remove_non_bmp_characters(text):
     return "".join(char for char in text if ord(char) <= 0xFFFF)
 
 
-def split_text(text):
+def split_text(text, max_words=200):
+    """
+    Pack the sentences of a text into blocks of at most max_words words,
+    a sentence longer than that is a block of its own\n
+    :param text: Text to split
+    :param max_words: Maximum number of words of a block
+    """
+    import nltk
+
+    ensure_punkt()
     # Split the text into sentences
     sentences = nltk.sent_tokenize(text)
     # Initialize variables
@@ -49,7 +100,7 @@ def split_text(text):
     for sentence in sentences:
         word_count = len(sentence.split())
         # Check if adding the next sentence exceeds the limit
-        if current_count + word_count > 200:
+        if current_count + word_count > max_words and current_text:
             # Add the current text to the result and start a new text
             result.append(current_text.strip())
             current_text = sentence
@@ -64,6 +115,158 @@ def split_text(text):
     return result
 
 
+class BlockSizer:
+    """
+    Chooses how many words go in a narration block from how past blocks went\n
+    Blocks grow while they succeed and stay within target_seconds, and shrink when
+    Speechify fails on them, so the block size follows what the service handles
+    """
+
+    def __init__(
+        self,
+        words: int = 200,
+        min_words: int = 40,
+        max_words: int = 400,
+        target_seconds: float = 120,
+        history: int = 50,
+        path: str = None,
+    ):
+        """
+        Initialize the sizer\n
+        :param words: Block size to start with, if nothing was learned yet
+        :param min_words: Smallest block size
+        :param max_words: Largest block size
+        :param target_seconds: Time a block should take at most, including its retries
+        :param history: Number of recent blocks to learn from
+        :param path: JSON file to keep what was learned in across runs, not kept if None
+        """
+        if not 0 < min_words <= max_words:
+            raise ValueError("Min words must be between 1 and max words")
+
+        self.min_words = min_words
+        self.max_words = max_words
+        self.target_seconds = target_seconds
+        self.history = history
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__words = words
+        self.__samples = []
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    saved = json.load(file)
+                self.__words = saved["words"]
+                self.__samples = saved["samples"][-history:]
+            except (ValueError, KeyError):
+                logger.debug(f"Ignoring unreadable block sizes in {path}")
+        self.__words = min(max(self.__words, min_words), max_words)
+
+    @property
+    def words(self) -> int:
+        """
+        Number of words the next blocks should have at most
+        """
+        return self.__words
+
+    def record(self, words: int, seconds: float, failed: bool = False):
+        """
+        Learn from a narrated block\n
+        :param words: Number of words of the block
+        :param seconds: Seconds the block took
+        :param failed: Whether narrating the block failed
+        """
+        with self.__lock:
+            self.__samples.append([words, round(seconds, 2), failed])
+            del self.__samples[: -self.history]
+            if failed:
+                # Shrinks quickly, the service may not handle blocks this long
+                size = min(self.__words, words) * 0.7
+            else:
+                # Grows slowly, up to the size that still meets the target time
+                overhead, seconds_per_word = self.__fit_()
+                size = self.__words + 20
+                if seconds_per_word > 0:
+                    size = min(
+                        size, (self.target_seconds - overhead) / seconds_per_word
+                    )
+            self.__words = int(min(max(size, self.min_words), self.max_words))
+            self.__save_()
+        BLOCK_SECONDS.observe(seconds)
+        BLOCKS.inc(result="failed" if failed else "narrated")
+
+    def failure_rate(self) -> float:
+        """
+        Get the share of recent blocks that failed
+        """
+        with self.__lock:
+            if not self.__samples:
+                return 0
+            failed = sum(1 for sample in self.__samples if sample[2])
+            return failed / len(self.__samples)
+
+    def predict_seconds(self, words: int) -> float:
+        """
+        Predict how long narrating a text takes with the current block size,
+        retries of failed blocks included\n
+        :param words: Number of words of the text
+        """
+        with self.__lock:
+            overhead, seconds_per_word = self.__fit_()
+            blocks = math.ceil(words / self.__words) if words else 0
+        seconds = blocks * overhead + words * seconds_per_word
+        return seconds / max(1 - self.failure_rate(), 0.1)
+
+    def __fit_(self):
+        # Least squares fit of seconds = overhead + seconds_per_word * words over
+        # the blocks that succeeded
+        samples = [
+            (words, seconds) for words, seconds, failed in self.__samples if not failed
+        ]
+        if not samples:
+            return 0, 0
+        mean_words = sum(words for words, _ in samples) / len(samples)
+        mean_seconds = sum(seconds for _, seconds in samples) / len(samples)
+        variance = sum((words - mean_words) ** 2 for words, _ in samples)
+        if variance == 0:
+            # Every block had the same size, the overhead cannot be told apart
+            return 0, mean_seconds / mean_words if mean_words else 0
+        seconds_per_word = (
+            sum(
+                (words - mean_words) * (seconds - mean_seconds)
+                for words, seconds in samples
+            )
+            / variance
+        )
+        if seconds_per_word <= 0:
+            return 0, mean_seconds / mean_words
+        return mean_seconds - seconds_per_word * mean_words, seconds_per_word
+
+    def __save_(self):
+        if not self.__path:
+            return
+        atomic_write_json(
+            self.__path, {"words": self.__words, "samples": self.__samples}
+        )
+
+
+_block_sizer = None
+_block_sizer_lock = threading.Lock()
+
+
+def shared_block_sizer() -> BlockSizer:
+    """
+    Get the block sizer shared by every narration of this process
+    """
+    global _block_sizer
+    with _block_sizer_lock:
+        if _block_sizer is None:
+            _block_sizer = BlockSizer(path="narration_blocks.json")
+            REGISTRY.gauge(
+                "rcf_narration_block_words", "Words the next narration blocks have"
+            ).set_function(lambda: _block_sizer.words)
+        return _block_sizer
+
+
 def log_filter(log_):
     return (
         log_["method"] == "Network.responseReceived"
@@ -75,35 +278,17 @@ def log_filter(log_):
     )
 
 
-def suppress_exception_in_del(uc):
-    old_del = uc.Chrome.__del__
-
-    def new_del(self) -> None:
-        try:
-            old_del(self)
-        except:
-            pass
+def open_speechify(driver, narrator: str):
+    """
+    Load Speechify with the narrator's voice selected\n
+    :param driver: The browser to load it in
+    :param narrator: Narrator of the text
+    :return: The text area to type the blocks into
+    """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
 
-    setattr(uc.Chrome, "__del__", new_del)
-
-
-def get_speechify_narration(
-    narrator: Literal["snoop", "mrbeast", "gwyneth", "male", "female"] = "mrbeast",
-    text: str = "Heck yeah baby, I'm a text to speech bot.",
-    output_path: str = "output",
-    output_filename: str = "output.wav",
-):
-    suppress_exception_in_del(uc)
-    words = []
-    start_time = 0
-
-    options = uc.ChromeOptions()
-    options.add_argument("--headless=new")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
-    driver = uc.Chrome(options=options)
-    driver.get("https://speechify.com/text-to-speech-online/")
+    driver.get(SPEECHIFY_URL)
     # Bypasses detection?
     time.sleep(10)
     # Set a value in local storage
@@ -126,63 +311,354 @@ def get_speechify_narration(
     )
     print("Value in local storage for 'activeVoiceID':", value)
 
-    text = remove_non_bmp_characters(text)
     textArea = driver.find_element(by=By.ID, value="article")
     textArea.send_keys(Keys.TAB)
-    combined_audio = AudioSegment.empty()
-    for text_block in split_text(text):
-        time.sleep(1)
-        textArea.click()
-        time.sleep(5)
-        textArea.clear()
-        time.sleep(1)
-        textArea.send_keys(text_block)
-        time.sleep(15)
-        playButton = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.CLASS_NAME, "ttso-iframe-play"))
+    return textArea
+
+
+def narrate_block(driver, textArea, text_block: str, timeout: float = 1000):
+    """
+    Narrate one block of text on an open Speechify page\n
+    :param driver: The browser Speechify is open in
+    :param textArea: The text area returned by open_speechify
+    :param text_block: Text of the block
+    :param timeout: Maximum seconds to wait for the narration of the block
+    :return: The audio, the words with their timings from the start of the block, and
+        the duration the next block starts after
+    """
+    from pydub import AudioSegment
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    words = []
+    start_time = 0
+    audio = AudioSegment.empty()
+    time.sleep(1)
+    textArea.click()
+    time.sleep(5)
+    textArea.clear()
+    time.sleep(1)
+    textArea.send_keys(text_block)
+    time.sleep(15)
+    playButton = WebDriverWait(driver, 10).until(
+        EC.element_to_be_clickable((By.CLASS_NAME, "ttso-iframe-play"))
+    )
+    playButton.click()
+    time.sleep(1)
+    WebDriverWait(driver, timeout).until(element_has_changed(playButton))
+    logs_raw = driver.get_log("performance")
+    logs = [json.loads(lr["message"])["message"] for lr in logs_raw]
+    for index, log in enumerate(filter(log_filter, logs)):
+        resp_url = log["params"]["response"]["url"]
+        request_id = log["params"]["requestId"]
+        print(f"Caught {resp_url} at index {index}")
+        response = driver.execute_cdp_cmd(
+            "Network.getResponseBody", {"requestId": request_id}
         )
-        playButton.click()
-        time.sleep(1)
-        WebDriverWait(driver, 1000).until(element_has_changed(playButton))
-        logs_raw = driver.get_log("performance")
-        logs = [json.loads(lr["message"])["message"] for lr in logs_raw]
-        for index, log in enumerate(filter(log_filter, logs)):
-            resp_url = log["params"]["response"]["url"]
-            request_id = log["params"]["requestId"]
-            print(f"Caught {resp_url} at index {index}")
-            response = driver.execute_cdp_cmd(
-                "Network.getResponseBody", {"requestId": request_id}
+        body = json.loads(response["body"])
+        audio_data = base64.b64decode(body["audioStream"])
+        audio_segment = AudioSegment.from_file(io.BytesIO(audio_data), format="ogg")
+        audio += audio_segment
+        # Get words and their timings, rounded once the block's place in the
+        # narration is known
+        words += [
+            Word(
+                word_chunk["value"],
+                int(word_chunk["startTime"]) / 1000 + start_time,
+                int(word_chunk["endTime"]) / 1000 + start_time,
             )
-            body = json.loads(response["body"])
-            audio_data = base64.b64decode(body["audioStream"])
-            audio_segment = AudioSegment.from_file(io.BytesIO(audio_data), format="ogg")
-            combined_audio += audio_segment
-            # Get words and their timings
-            words += [
-                Word(
-                    word_chunk["value"],
-                    math.floor((int(word_chunk["startTime"]) / 1000 + start_time) * 100)
-                    / 100,
-                    math.floor((int(word_chunk["endTime"]) / 1000 + start_time) * 100)
-                    / 100,
-                )
-                for sentence_chunk in body["speechMarks"]["chunks"]
-                for word_chunk in sentence_chunk["chunks"]
-            ]
-            start_time += math.floor((len(audio_segment) / 1000) * 100) / 100
-        content = driver.find_element(by=By.ID, value="pdf-reader-content")
-        driver.execute_script(
-            "arguments[0].setAttribute('style',arguments[1])", content, "display: none;"
-        )
-        time.sleep(1)
-        driver.execute_script(
-            "arguments[0].setAttribute('style',arguments[1])", textArea, ""
-        )
+            for sentence_chunk in body["speechMarks"]["chunks"]
+            for word_chunk in sentence_chunk["chunks"]
+        ]
+        start_time += math.floor((len(audio_segment) / 1000) * 100) / 100
+    if not words:
+        raise ValueError("Speechify returned no audio for the block")
+    content = driver.find_element(by=By.ID, value="pdf-reader-content")
+    driver.execute_script(
+        "arguments[0].setAttribute('style',arguments[1])",
+        content,
+        "display: none;",
+    )
+    time.sleep(1)
+    driver.execute_script(
+        "arguments[0].setAttribute('style',arguments[1])", textArea, ""
+    )
+    return audio, words, start_time
+
+
+def get_speechify_narration(
+    narrator: Literal["snoop", "mrbeast", "gwyneth", "male", "female"] = "mrbeast",
+    text: str = "Heck yeah baby, I'm a text to speech bot.",
+    output_path: str = "output",
+    output_filename: str = "output.wav",
+    pool: BrowserPool = None,
+    block_cache: CacheNamespace = None,
+    sizer: BlockSizer = None,
+    max_attempts: int = 3,
+):
+    """
+    Narrate a text block by block, retrying only the blocks that fail\n
+    :param narrator: Narrator of the text
+    :param text: Text to narrate
+    :param output_path: Folder to save the narration in
+    :param output_filename: File name of the `.wav` narration, the `.mp3` is saved next to it
+    :param pool: Browser pool to borrow the browser from, the shared pool if not set
+    :param block_cache: Cache namespace of the narrated blocks, so a rerun only narrates
+        the blocks that did not finish, caching is disabled if None
+    :param sizer: BlockSizer choosing the block size, the shared one if not set
+    :param max_attempts: Number of times a block or the page is tried before giving up
+    :return: The words with their timings
+    """
+    from pydub import AudioSegment
+
+    started = time.monotonic()
+    pool = pool or shared_pool()
+    sizer = sizer or shared_block_sizer()
+    text = remove_non_bmp_characters(text)
+    blocks = _load_block_plan(block_cache, narrator, text) or split_text(
+        text, sizer.words
+    )
+    _save_block_plan(block_cache, narrator, text, blocks)
+    narrated = {}
+    for block in blocks:
+        cached = _get_cached_block(block_cache, narrator, block)
+        if cached:
+            narrated[block] = cached
+            BLOCKS.inc(result="cached")
+
+    failures = {}
+    page_failures = 0
+    while True:
+        pending = [block for block in blocks if block not in narrated]
+        if not pending:
+            break
+        current = None
+        try:
+            # A browser that fails is shut down by the pool instead of being reused
+            with pool.lease(performance_logs=True) as driver:
+                textArea = open_speechify(driver, narrator)
+                for block in pending:
+                    current = block
+                    block_start = time.monotonic()
+                    # A block taking far longer than the sizer's target fails
+                    # and is retried in smaller pieces instead of stalling
+                    narrated[block] = narrate_block(
+                        driver, textArea, block, timeout=2 * sizer.target_seconds
+                    )
+                    current = None
+                    sizer.record(len(block.split()), time.monotonic() - block_start)
+                    _put_cached_block(block_cache, narrator, block, narrated[block])
+        except Exception:
+            if current is None:
+                page_failures += 1
+                if page_failures >= max_attempts:
+                    NARRATIONS.inc(result="failed")
+                    raise
+                logger.debug("Could not open Speechify, retrying with a new browser")
+                continue
+            sizer.record(
+                len(current.split()), time.monotonic() - block_start, failed=True
+            )
+            failures[current] = failures.get(current, 0) + 1
+            if failures[current] >= max_attempts:
+                NARRATIONS.inc(result="failed")
+                raise
+            # Only the failed block is redone, split up if it is longer than
+            # the blocks that are working now
+            pieces = split_text(current, sizer.words)
+            index = blocks.index(current)
+            blocks[index : index + 1] = pieces
+            _save_block_plan(block_cache, narrator, text, blocks)
+            logger.debug(
+                f"Narration block of {len(current.split())} words failed, "
+                f"retrying it as {len(pieces)} blocks"
+            )
+
+    # The blocks are joined and their word timings moved to where they start
+    combined_audio = AudioSegment.empty()
+    words = []
+    block_offset = 0
+    for block in blocks:
+        audio, block_words, duration = narrated[block]
+        combined_audio += audio
+        words += [
+            Word(
+                word.word,
+                math.floor((word.start_sec + block_offset) * 100) / 100,
+                math.floor((word.end_sec + block_offset) * 100) / 100,
+            )
+            for word in block_words
+        ]
+        block_offset += duration
     combined_audio.export(f"{output_path}/{output_filename}", format="wav")
     AudioSegment.from_wav(f"{output_path}/{output_filename}").export(
         f"{output_path}/{output_filename.replace('.wav', '.mp3')}", format="mp3"
     )
-    time.sleep(10)
-    driver.quit()
-    driver.stop_client()
+    NARRATIONS.inc(result="done")
+    NARRATION_SECONDS.observe(time.monotonic() - started)
     return words
+
+
+def _load_block_plan(block_cache: CacheNamespace, narrator: str, text: str) -> list:
+    # The blocks of an unfinished narration are kept, so a rerun splits the text
+    # the same way and finds its narrated blocks in the cache
+    if block_cache is None:
+        return None
+    entry_dir = block_cache.get(f"plan-{narration_cache_key(narrator, text)}")
+    if not entry_dir:
+        return None
+    try:
+        with open(os.path.join(entry_dir, "blocks.json"), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _save_block_plan(block_cache: CacheNamespace, narrator: str, text: str, blocks):
+    if block_cache is not None:
+        block_cache.put(
+            f"plan-{narration_cache_key(narrator, text)}",
+            {"blocks.json": json.dumps(blocks).encode("utf-8")},
+        )
+
+
+def _discard_blocks(block_cache: CacheNamespace, narrator: str, text: str):
+    # Once the whole narration is cached its blocks are never read again
+    if block_cache is None:
+        return
+    for block in _load_block_plan(block_cache, narrator, text) or []:
+        block_cache.discard(narration_cache_key(narrator, block))
+    block_cache.discard(f"plan-{narration_cache_key(narrator, text)}")
+
+
+def _get_cached_block(block_cache: CacheNamespace, narrator: str, block: str):
+    from pydub import AudioSegment
+
+    if block_cache is None:
+        return None
+    entry_dir = block_cache.get(narration_cache_key(narrator, block))
+    if not entry_dir:
+        return None
+    try:
+        audio = AudioSegment.from_wav(os.path.join(entry_dir, "block.wav"))
+        with open(os.path.join(entry_dir, "block.json"), "r") as file:
+            timings = json.load(file)
+    except FileNotFoundError:
+        # Evicted by another process while it was being read
+        return None
+    words = [Word(**word) for word in timings["words"]]
+    return audio, words, timings["duration"]
+
+
+def _put_cached_block(
+    block_cache: CacheNamespace, narrator: str, block: str, narrated: tuple
+):
+    if block_cache is None:
+        return
+    audio, words, duration = narrated
+    wav = io.BytesIO()
+    audio.export(wav, format="wav")
+    timings = {"words": [word.__dict__ for word in words], "duration": duration}
+    block_cache.put(
+        narration_cache_key(narrator, block),
+        {
+            "block.wav": wav.getvalue(),
+            "block.json": json.dumps(timings).encode("utf-8"),
+        },
+    )
+
+
+def narration_cache_key(narrator: str, text: str) -> str:
+    """
+    Get the cache key of a narration\n
+    :param narrator: Narrator of the text
+    :param text: Text that is narrated
+    """
+    return hashlib.sha256(f"{narrator}\n{text}".encode("utf-8")).hexdigest()
+
+
+def get_cached_speechify_narration(
+    narrator: Literal["snoop", "mrbeast", "gwyneth", "male", "female"] = "mrbeast",
+    text: str = "Heck yeah baby, I'm a text to speech bot.",
+    output_path: str = "output",
+    output_filename: str = "output.wav",
+    cache: CacheNamespace = None,
+    block_cache: CacheNamespace = None,
+):
+    """
+    Same as get_speechify_narration, but reuses the audio and word timings of texts narrated before\n
+    :param cache: Cache namespace of the narrations, caching is disabled if None
+    :param block_cache: Cache namespace of the narrated blocks, caching is disabled if None
+    """
+    if cache is None:
+        return get_speechify_narration(
+            narrator, text, output_path, output_filename, block_cache=block_cache
+        )
+
+    key = narration_cache_key(narrator, text)
+    output_wav = os.path.join(output_path, output_filename)
+    output_mp3 = os.path.join(output_path, output_filename.replace(".wav", ".mp3"))
+
+    entry_dir = cache.get(key)
+    if entry_dir:
+        try:
+            shutil.copyfile(os.path.join(entry_dir, "narration.wav"), output_wav)
+            shutil.copyfile(os.path.join(entry_dir, "narration.mp3"), output_mp3)
+            with open(os.path.join(entry_dir, "words.json"), "r") as file:
+                return [Word(**word) for word in json.load(file)]
+        except FileNotFoundError:
+            # Evicted by another process while it was being read
+            pass
+
+    words = get_speechify_narration(
+        narrator, text, output_path, output_filename, block_cache=block_cache
+    )
+    cache.put(
+        key,
+        {
+            "narration.wav": output_wav,
+            "narration.mp3": output_mp3,
+            "words.json": json.dumps([word.__dict__ for word in words]).encode(
+                "utf-8"
+            ),
+        },
+    )
+    _discard_blocks(block_cache, narrator, remove_non_bmp_characters(text))
+    return words
+
+
+def get_speechify_narrations(
+    narrator: Literal["snoop", "mrbeast", "gwyneth", "male", "female"] = "mrbeast",
+    texts: dict = None,
+    output_path: str = "output",
+    max_workers: int = 2,
+    cache: CacheNamespace = None,
+    block_cache: CacheNamespace = None,
+) -> dict:
+    """
+    Narrate several texts in parallel, each one saved as `<name>_narration.wav/.mp3`\n
+    :param narrator: Narrator of the texts
+    :param texts: Names of the narration units mapped to their text
+    :param output_path: Folder to save the narrations in
+    :param max_workers: Number of browsers narrating at the same time
+    :param cache: Cache namespace of the narrations, caching is disabled if None
+    :param block_cache: Cache namespace of the narrated blocks, caching is disabled if None
+    :return: Names of the narration units mapped to their words
+    """
+    if not texts:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(
+                get_cached_speechify_narration,
+                narrator=narrator,
+                text=text,
+                output_path=output_path,
+                output_filename=f"{name}_narration.wav",
+                cache=cache,
+                block_cache=block_cache,
+            )
+            for name, text in texts.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,17 @@
+import sqlite3
+
+
+class Transaction:
+    """
+    Commits on success and rolls back on failure, for connections in autocommit mode
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.__connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.__connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__connection.in_transaction:
+            self.__connection.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,217 @@
+import re
+from collections import Counter
+
+
+class KeywordMatcher:
+    """
+    Matches any of a set of keywords in a single pass over the text\n
+    The keywords are compiled once into one regular expression shaped like a
+    trie, so keywords sharing a prefix are only compared once per position
+    """
+
+    def __init__(
+        self, keywords, case_sensitive: bool = False, whole_words: bool = False
+    ):
+        """
+        Compile the keywords\n
+        :param keywords: Keywords to look for
+        :param case_sensitive: Whether the case of the keywords must match
+        :param whole_words: Whether keywords only match whole words
+        """
+        self.keywords = sorted({keyword for keyword in keywords if keyword})
+        self.__case_sensitive = case_sensitive
+        self.__pattern = None
+        if not self.keywords:
+            return
+        if not case_sensitive:
+            self.keywords = sorted({keyword.lower() for keyword in self.keywords})
+        pattern = self.__trie_pattern_(self.__build_trie_(self.keywords))
+        if whole_words:
+            pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+        self.__pattern = re.compile(pattern, 0 if case_sensitive else re.IGNORECASE)
+
+    def search(self, text: str):
+        """
+        Get the first keyword found in the text, or None\n
+        :param text: Text to search
+        """
+        if self.__pattern is None or not text:
+            return None
+        match = self.__pattern.search(text)
+        if match is None:
+            return None
+        return match.group(0) if self.__case_sensitive else match.group(0).lower()
+
+    def __bool__(self):
+        return self.__pattern is not None
+
+    @staticmethod
+    def __build_trie_(keywords) -> dict:
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            # An empty key marks the end of a keyword
+            node[""] = {}
+        return trie
+
+    @classmethod
+    def __trie_pattern_(cls, node: dict) -> str:
+        ends_here = "" in node
+        branches = [
+            re.escape(char) + cls.__trie_pattern_(child)
+            for char, child in sorted(node.items())
+            if char != ""
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not ends_here:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if ends_here else pattern
+
+
+class SubmissionFilter:
+    """
+    Decides which Reddit submissions may be turned into videos
+    """
+
+    def __init__(
+        self,
+        exclude_title_keywords=("r/", "reddit"),
+        include_keywords=(),
+        exclude_keywords=(),
+        include_patterns=(),
+        exclude_patterns=(),
+        case_sensitive: bool = True,
+        whole_words: bool = False,
+        allow_nsfw: bool = True,
+        include_flairs=(),
+        exclude_flairs=(),
+        min_words: int = 0,
+        max_words: int = None,
+        min_score: int = None,
+        max_score: int = None,
+    ):
+        """
+        Compile the filter rules\n
+        :param exclude_title_keywords: Keywords that may not appear in the title
+        :param include_keywords: Keywords of which at least one must appear in the title or text
+        :param exclude_keywords: Keywords that may not appear in the title or text
+        :param include_patterns: Regular expressions of which at least one must match the title or text
+        :param exclude_patterns: Regular expressions that may not match the title or text
+        :param case_sensitive: Whether the case of the keywords must match
+        :param whole_words: Whether keywords only match whole words
+        :param allow_nsfw: Whether NSFW submissions are allowed
+        :param include_flairs: Flairs of which the submission must have one, any flair if empty
+        :param exclude_flairs: Flairs the submission may not have
+        :param min_words: Minimum number of words in the text
+        :param max_words: Number of words the text must stay below
+        :param min_score: Minimum score of the submission
+        :param max_score: Maximum score of the submission
+        """
+        self.__exclude_title = KeywordMatcher(
+            exclude_title_keywords, case_sensitive, whole_words
+        )
+        self.__include = KeywordMatcher(include_keywords, case_sensitive, whole_words)
+        self.__exclude = KeywordMatcher(exclude_keywords, case_sensitive, whole_words)
+        self.__include_patterns = [re.compile(pattern) for pattern in include_patterns]
+        self.__exclude_patterns = [re.compile(pattern) for pattern in exclude_patterns]
+        self.__allow_nsfw = allow_nsfw
+        self.__include_flairs = {flair.lower() for flair in include_flairs}
+        self.__exclude_flairs = {flair.lower() for flair in exclude_flairs}
+        self.__min_words = min_words
+        self.__max_words = max_words
+        self.__min_score = min_score
+        self.__max_score = max_score
+        self.rejections = Counter()
+
+    def reject_reason(
+        self, submission, max_words: int = None, exclude_ids: set = None
+    ) -> str:
+        """
+        Get the name of the first rule the submission breaks, or None if it passes\n
+        :param submission: The submission to check
+        :param max_words: Overrides the number of words the text must stay below
+        :param exclude_ids: Ids of submissions that may not be picked again
+        """
+        if exclude_ids and submission.id in exclude_ids:
+            return "duplicate"
+        # Cheap checks first so most rejections never look at the text
+        if not self.__allow_nsfw and getattr(submission, "over_18", False):
+            return "nsfw"
+        score = getattr(submission, "score", 0)
+        if self.__min_score is not None and score < self.__min_score:
+            return "min_score"
+        if self.__max_score is not None and score > self.__max_score:
+            return "max_score"
+        if self.__include_flairs or self.__exclude_flairs:
+            flair = (getattr(submission, "link_flair_text", None) or "").lower()
+            if self.__include_flairs and flair not in self.__include_flairs:
+                return "include_flair"
+            if flair and flair in self.__exclude_flairs:
+                return "exclude_flair"
+        title = submission.title
+        if self.__exclude_title.search(title):
+            return "exclude_title_keyword"
+
+        max_words = max_words if max_words is not None else self.__max_words
+        text = submission.selftext
+        if max_words is not None or self.__min_words:
+            word_count = len(text.split())
+            if max_words is not None and word_count >= max_words:
+                return "max_words"
+            if word_count < self.__min_words:
+                return "min_words"
+
+        if self.__exclude or self.__include:
+            if self.__exclude.search(title) or self.__exclude.search(text):
+                return "exclude_keyword"
+            if self.__include and not (
+                self.__include.search(title) or self.__include.search(text)
+            ):
+                return "include_keyword"
+        for pattern in self.__exclude_patterns:
+            if pattern.search(title) or pattern.search(text):
+                return "exclude_pattern"
+        if self.__include_patterns and not any(
+            pattern.search(title) or pattern.search(text)
+            for pattern in self.__include_patterns
+        ):
+            return "include_pattern"
+        return None
+
+    def accepts(self, submission, max_words: int = None, exclude_ids: set = None):
+        """
+        Check a single submission and count the rule it breaks\n
+        :param submission: The submission to check
+        :param max_words: Overrides the number of words the text must stay below
+        :param exclude_ids: Ids of submissions that may not be picked again
+        """
+        reason = self.reject_reason(submission, max_words, exclude_ids)
+        if reason:
+            self.rejections[reason] += 1
+            return False
+        return True
+
+    def filter(
+        self, submissions, max_words: int = None, exclude_ids: set = None
+    ) -> list:
+        """
+        Check a batch of submissions and return the ones that pass\n
+        :param submissions: The submissions to check
+        :param max_words: Overrides the number of words the text must stay below
+        :param exclude_ids: Ids of submissions that may not be picked again
+        """
+        return [
+            submission
+            for submission in submissions
+            if self.accepts(submission, max_words, exclude_ids)
+        ]
+
+    def reset_rejections(self):
+        """
+        Reset the per-rule rejection counts
+        """
+        self.rejections = Counter()
@@ -0,0 +1,183 @@
+import bisect
+import resource
+from collections import OrderedDict
+from metrics import REGISTRY
+
+GLYPH_LOOKUPS = REGISTRY.counter(
+    "rcf_glyph_cache_lookups_total", "Lookups of rasterized subtitle words", ["result"]
+)
+
+
+def peak_rss_mb() -> dict:
+    """
+    Get the peak resident memory of this process and of its finished child processes, e.g. ffmpeg
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    return {"self": round(own / 1024, 1), "children": round(children / 1024, 1)}
+
+
+class SubtitleSpec:
+    """
+    A word to show on screen, without any pixels until it is drawn
+    """
+
+    __slots__ = ("text", "start", "end")
+
+    def __init__(self, text: str, start: float, end: float):
+        """
+        :param text: The word to show
+        :param start: Second the word appears at
+        :param end: Second the word disappears at
+        """
+        self.text = text
+        self.start = start
+        self.end = end
+
+
+class SubtitleOverlay:
+    """
+    Draws subtitles onto the frames of a video while it is encoded\n
+    A word is only rasterized when it first appears on screen, and only the most
+    recently used words are kept, so memory stays flat however long the story is
+    """
+
+    def __init__(
+        self,
+        specs: list,
+        video_size: tuple,
+        fontsize: int,
+        font: str,
+        color: str,
+        stroke_width: int,
+        stroke_color: str,
+        cache_size: int = 32,
+    ):
+        """
+        :param specs: SubtitleSpecs of the words
+        :param video_size: Width and height of the video
+        :param fontsize: Font size of the subtitles
+        :param font: Font of the subtitles
+        :param color: Color of the subtitles
+        :param stroke_width: Stroke width of the subtitles
+        :param stroke_color: Stroke color of the subtitles
+        :param cache_size: Number of rasterized words to keep
+        """
+        self.__specs = sorted(specs, key=lambda spec: spec.start)
+        self.__starts = [spec.start for spec in self.__specs]
+        self.__longest = max((spec.end - spec.start for spec in specs), default=0)
+        self.__video_size = video_size
+        self.__style = {
+            "fontsize": fontsize,
+            "font": font,
+            "color": color,
+            "stroke_width": stroke_width,
+            "stroke_color": stroke_color,
+        }
+        self.__cache = OrderedDict()
+        self.__cache_size = cache_size
+        self.rasterized = 0
+
+    def active(self, t: float) -> list:
+        """
+        Get the words on screen at a time, in the order they are drawn\n
+        :param t: Time in seconds
+        """
+        index = bisect.bisect_right(self.__starts, t)
+        active = []
+        # Only words that started less than the longest word ago can still be shown
+        while index > 0 and self.__starts[index - 1] >= t - self.__longest:
+            index -= 1
+            if t < self.__specs[index].end:
+                active.append(self.__specs[index])
+        return active[::-1]
+
+    def apply(self, get_frame, t: float):
+        """
+        Draw the words on screen at a time onto a frame, for VideoClip.fl\n
+        :param get_frame: Function returning the frame without subtitles
+        :param t: Time in seconds
+        """
+        frame = get_frame(t)
+        active = self.active(t)
+        if not active:
+            return frame
+        frame = frame.copy()
+        height, width = frame.shape[:2]
+        for spec in active:
+            rgb, alpha, (x, y) = self.__rasterize_(spec.text)
+            # Clipped to the frame in case the word is larger than the video
+            x0, y0 = max(x, 0), max(y, 0)
+            x1 = min(x + rgb.shape[1], width)
+            y1 = min(y + rgb.shape[0], height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            rgb = rgb[y0 - y : y1 - y, x0 - x : x1 - x]
+            alpha = alpha[y0 - y : y1 - y, x0 - x : x1 - x]
+            region = frame[y0:y1, x0:x1]
+            frame[y0:y1, x0:x1] = region + (rgb - region) * alpha
+        return frame
+
+    def __rasterize_(self, text: str):
+        cached = self.__cache.get(text)
+        if cached is not None:
+            self.__cache.move_to_end(text)
+            GLYPH_LOOKUPS.inc(result="hit")
+            return cached
+        GLYPH_LOOKUPS.inc(result="miss")
+
+        import numpy as np
+        from moviepy.editor import TextClip
+
+        video_width, video_height = self.__video_size
+        layers = []
+        for stroke_color in (self.__style["stroke_color"], "transparent"):
+            clip = TextClip(
+                text,
+                fontsize=self.__style["fontsize"],
+                font=self.__style["font"],
+                color=self.__style["color"],
+                stroke_color=stroke_color,
+                stroke_width=self.__style["stroke_width"],
+                bg_color="transparent",
+                size=(video_width * 3 / 4, None),
+                method="caption",
+            )
+            layers.append(
+                (
+                    clip.get_frame(0).astype(np.float32),
+                    clip.mask.get_frame(0).astype(np.float32)[:, :, None],
+                )
+            )
+            clip.close()
+
+        # The color layer is drawn over the stroke layer
+        (stroke_rgb, stroke_alpha), (color_rgb, color_alpha) = layers
+        alpha = color_alpha + stroke_alpha * (1 - color_alpha)
+        rgb = color_rgb * color_alpha + stroke_rgb * stroke_alpha * (1 - color_alpha)
+        rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+
+        # Only the pixels the word covers are kept, placed where the centered
+        # text box would have put them
+        clip_height, clip_width = alpha.shape[:2]
+        rows = np.flatnonzero(alpha[:, :, 0].any(axis=1))
+        columns = np.flatnonzero(alpha[:, :, 0].any(axis=0))
+        if len(rows) == 0:
+            rows = columns = np.array([0])
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = columns[0], columns[-1] + 1
+        position = (
+            int((video_width - clip_width) / 2) + left,
+            int((video_height - clip_height) / 2) + top,
+        )
+        raster = (
+            rgb[top:bottom, left:right],
+            alpha[top:bottom, left:right],
+            position,
+        )
+        self.rasterized += 1
+        self.__cache[text] = raster
+        if len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
+        return raster
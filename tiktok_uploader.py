@@ -1,96 +1,140 @@
 import os
 import time
-import undetected_chromedriver as uc
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from browser_pool import BrowserPool, shared_pool
 
+UPLOAD_URL = "https://www.tiktok.com/creator-center/upload?from=upload"
+UPLOAD_IFRAME = (
+    "//iframe[@src='https://www.tiktok.com/creator#/upload?scene=creator_center']"
+)
+FILE_INPUT = '//input[@accept="video/*"]'
+CAPTION_INPUT = '//div[@contenteditable="true"]'
+POST_BUTTON = '//button[.//div[text()="Post"]]'
+POST_CONFIRMATION = (
+    '//*[contains(text(), "Your video has been uploaded")'
+    ' or contains(text(), "Your video is being uploaded")'
+    ' or contains(text(), "Manage your posts")]'
+)
 
-def suppress_exception_in_del(uc):
-    old_del = uc.Chrome.__del__
 
-    def new_del(self) -> None:
-        try:
-            old_del(self)
-        except:
-            pass
+class StepTimer:
+    """
+    Records how long each step of an upload takes
+    """
 
-    setattr(uc.Chrome, "__del__", new_del)
+    def __init__(self):
+        self.timings = {}
+        self.__start = time.monotonic()
+        self.__last = self.__start
+
+    def step(self, name: str):
+        """
+        Record the time since the previous step under the given name\n
+        :param name: Name of the step that just finished
+        """
+        now = time.monotonic()
+        self.timings[name] = round(now - self.__last, 2)
+        self.__last = now
+
+    def total(self) -> dict:
+        """
+        Get the step timings including the total time
+        """
+        return {**self.timings, "total": round(self.__last - self.__start, 2)}
 
 
 def upload_tiktok_video(
     token: str,
     session_id: str,
     caption: str,
-    path: str = "output",
-    file_name: str = "output.mp4",
-):
-    suppress_exception_in_del(uc)
+    video_path: str,
+    profile_dir: str = "tiktok_profile",
+    timeout: int = 600,
+    pool: BrowserPool = None,
+) -> dict:
+    """
+    Upload a video to TikTok and return how many seconds each step took\n
+    :param token: The msToken cookie of the TikTok account
+    :param session_id: The sessionid cookie of the TikTok account
+    :param caption: Caption of the post
+    :param video_path: Path to the video file
+    :param profile_dir: Chrome profile folder reused across uploads to keep cookies, or None for a fresh profile
+    :param timeout: Maximum seconds to wait for any single step
+    :param pool: Browser pool to borrow the browser from, the shared pool if not set
+    """
+    # Imported here so that importing this module does not load selenium
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
 
-    options = uc.ChromeOptions()
-    options.add_argument("--headless=new")
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    driver = uc.Chrome(options=options)
-    driver.execute_cdp_cmd(
-        "Network.setCookie",
-        {
-            "domain": ".tiktok.com",
-            "path": "/",
-            "name": "msToken",
-            "value": token,
-            "secure": True,
-        },
-    )
-    driver.execute_cdp_cmd(
-        "Network.setCookie",
-        {
-            "domain": ".tiktok.com",
-            "path": "/",
-            "name": "sessionid",
-            "value": session_id,
-            "httpOnly": True,
-            "secure": True,
-        },
-    )
+    video_path = os.path.abspath(video_path)
+    if not os.path.exists(video_path):
+        raise ValueError("Input video not found.")
 
-    driver.get("https://www.tiktok.com/creator-center/upload?from=upload")
+    timer = StepTimer()
+    pool = pool or shared_pool()
+    # A browser that fails is shut down by the pool instead of being reused
+    with pool.lease(profile_dir=profile_dir, timeout=timeout) as driver:
+        # Includes waiting for a free browser when the pool is full
+        timer.step("launch_browser")
+        wait = WebDriverWait(driver, timeout)
+        # Cookies saved in the profile are refreshed with the given ones
+        if token:
+            driver.execute_cdp_cmd(
+                "Network.setCookie",
+                {
+                    "domain": ".tiktok.com",
+                    "path": "/",
+                    "name": "msToken",
+                    "value": token,
+                    "secure": True,
+                },
+            )
+        if session_id:
+            driver.execute_cdp_cmd(
+                "Network.setCookie",
+                {
+                    "domain": ".tiktok.com",
+                    "path": "/",
+                    "name": "sessionid",
+                    "value": session_id,
+                    "httpOnly": True,
+                    "secure": True,
+                },
+            )
 
-    time.sleep(20)
-    WebDriverWait(driver, 20).until(
-        EC.frame_to_be_available_and_switch_to_it(
-            (
-                By.XPATH,
-                "//iframe[@src='https://www.tiktok.com/creator#/upload?scene=creator_center']",
+        driver.get(UPLOAD_URL)
+        # Older versions of the page put the uploader in an iframe
+        wait.until(
+            EC.any_of(
+                EC.frame_to_be_available_and_switch_to_it((By.XPATH, UPLOAD_IFRAME)),
+                EC.presence_of_element_located((By.XPATH, FILE_INPUT)),
             )
         )
-    )
-    time.sleep(20)
-    driver.find_element(by=By.XPATH, value='//input[@accept="video/*"]').send_keys(
-        os.getcwd() + f"/{path}/{file_name}"
-    )
-    time.sleep(60)
-    textInput = driver.find_element(by=By.XPATH, value='//div[@contenteditable="true"]')
-    textInput.click()
-    time.sleep(5)
-    text = file_name.split(".")[0]
-    for char in text:
-        textInput = driver.find_element(
-            by=By.XPATH, value='//div[@contenteditable="true"]'
-        )
-        textInput.send_keys(Keys.BACKSPACE)
-        time.sleep(0.025)
-    time.sleep(5)
-    text = caption
-    for char in text:
-        textInput = driver.find_element(
-            by=By.XPATH, value='//div[@contenteditable="true"]'
+        file_input = wait.until(EC.presence_of_element_located((By.XPATH, FILE_INPUT)))
+        timer.step("load_page")
+
+        file_input.send_keys(video_path)
+        # The post button stays disabled until the video has finished uploading
+        wait.until(EC.element_to_be_clickable((By.XPATH, POST_BUTTON)))
+        timer.step("upload_video")
+
+        # TikTok fills the caption with the file name, replace it in one go
+        caption_input = wait.until(
+            EC.element_to_be_clickable((By.XPATH, CAPTION_INPUT))
         )
-        textInput.send_keys(char)
-        time.sleep(0.025)
-    time.sleep(10)
-    driver.find_element(by=By.XPATH, value='//div[text()="Post"]').click()
-    time.sleep(100)
+        caption_input.click()
+        caption_input.send_keys(Keys.CONTROL, "a")
+        caption_input.send_keys(Keys.BACKSPACE)
+        caption_input.send_keys(caption.strip())
+        timer.step("enter_caption")
 
-    driver.quit()
+        wait.until(EC.element_to_be_clickable((By.XPATH, POST_BUTTON))).click()
+        wait.until(
+            EC.any_of(
+                EC.presence_of_element_located((By.XPATH, POST_CONFIRMATION)),
+                EC.url_contains("/content"),
+            )
+        )
+        timer.step("post_video")
+    return timer.total()
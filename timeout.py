@@ -2,6 +2,7 @@ import errno
 import os
 import signal
 import functools
+import threading
 
 
 class TimeoutError(Exception):
@@ -15,6 +16,10 @@ def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            # Signals can only be handled in the main thread, so calls made
+            # from worker threads run without an alarm
+            if threading.current_thread() is not threading.main_thread():
+                return func(*args, **kwargs)
             signal.signal(signal.SIGALRM, _handle_timeout)
             signal.alarm(seconds)
             try:
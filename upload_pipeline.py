@@ -0,0 +1,235 @@
+import time
+import queue
+import logging
+import threading
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import JobManifest
+from workspace import Workspace
+from metrics import REGISTRY
+
+logger = logging.getLogger("RedditContentFarmer.upload_pipeline")
+
+UPLOADS = REGISTRY.counter(
+    "rcf_uploads_total", "Uploads by platform and outcome", ["platform", "status"]
+)
+UPLOAD_SECONDS = REGISTRY.histogram(
+    "rcf_upload_seconds", "Seconds an upload took, including retries", ["platform"]
+)
+
+
+class FinishedVideo:
+    """
+    A rendered video waiting to be uploaded
+    """
+
+    def __init__(
+        self,
+        video_id: str,
+        path: str,
+        caption: str,
+        output_path: str,
+        duration: float = None,
+        post=None,
+        manifest: JobManifest = None,
+        workspace: Workspace = None,
+        variants: dict = None,
+    ):
+        """
+        :param video_id: Unique id of the video, e.g. the Reddit post id
+        :param path: Path to the video file
+        :param caption: Caption of the post
+        :param output_path: Folder containing the video's thumbnail and other files
+        :param duration: Duration of the video in seconds
+        :param post: The Reddit submission the video was made from
+        :param manifest: Manifest of the job, platforms it records as uploaded are skipped
+        :param workspace: Workspace of the job, cleaned up once every platform uploaded
+        :param variants: Output profile names mapped to the paths of the video's variants
+        """
+        self.video_id = video_id
+        self.path = path
+        self.caption = caption
+        self.output_path = output_path
+        self.duration = duration
+        self.post = post
+        self.manifest = manifest
+        self.workspace = workspace
+        self.variants = variants or {}
+
+    def variant(self, name: str) -> str:
+        """
+        Get the path of a variant of the video, or of the video if there is no such variant\n
+        :param name: Name of the output profile
+        """
+        return self.variants.get(name, self.path)
+
+
+class UploadPipeline:
+    """
+    Uploads finished videos to every platform concurrently, in the background
+    """
+
+    def __init__(
+        self,
+        publishers: dict,
+        max_attempts: int = 3,
+        retry_delay: int = 30,
+        max_queued: int = 0,
+        on_report: Callable[[FinishedVideo, dict], None] = None,
+    ):
+        """
+        Initialize the upload pipeline and start its worker threads\n
+        :param publishers: Platform names mapped to functions that upload a FinishedVideo,
+            anything they return is kept in the report as details
+        :param max_attempts: Number of times to try each platform before giving up
+        :param retry_delay: Seconds to wait before the first retry, doubled for every retry
+        :param max_queued: Number of videos that can wait in the queue, unlimited if 0
+        :param on_report: Function called with each video and its report when all platforms are done
+        """
+        if not publishers:
+            raise ValueError("Please provide at least one publisher")
+        if max_attempts < 1:
+            raise ValueError("Max attempts cannot be less than 1")
+
+        self.__publishers = publishers
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__on_report = on_report
+        self.__queue = queue.Queue(maxsize=max_queued)
+        self.__executor = ThreadPoolExecutor(
+            max_workers=len(publishers), thread_name_prefix="upload"
+        )
+        self.__reports_lock = threading.Lock()
+        self.reports = {}
+        self.__dispatcher = threading.Thread(
+            target=self.__dispatch_, name="upload-dispatcher", daemon=True
+        )
+        self.__dispatcher.start()
+        REGISTRY.gauge(
+            "rcf_upload_queue_depth", "Videos queued or being uploaded"
+        ).set_function(self.pending)
+
+    def submit(self, video: FinishedVideo):
+        """
+        Queue a finished video for upload and return immediately\n
+        :param video: The video to upload
+        """
+        logger.debug(f"Queued video {video.video_id} for upload")
+        self.__queue.put(video)
+
+    def pending(self) -> int:
+        """
+        Get the number of videos that are queued or being uploaded
+        """
+        return self.__queue.unfinished_tasks
+
+    def join(self):
+        """
+        Wait until every queued video has been uploaded or has failed
+        """
+        self.__queue.join()
+
+    def close(self):
+        """
+        Wait for the queued uploads and stop the worker threads
+        """
+        self.join()
+        self.__queue.put(None)
+        self.__dispatcher.join()
+        self.__executor.shutdown()
+
+    def __dispatch_(self):
+        while True:
+            video = self.__queue.get()
+            if video is None:
+                self.__queue.task_done()
+                return
+            try:
+                self.__upload_video_(video)
+            except Exception:
+                logger.exception(f"Could not report upload of video {video.video_id}")
+            finally:
+                self.__queue.task_done()
+
+    def __upload_video_(self, video: FinishedVideo):
+        futures = {
+            platform: self.__executor.submit(self.__publish_, platform, publish, video)
+            for platform, publish in self.__publishers.items()
+        }
+        report = {platform: future.result() for platform, future in futures.items()}
+        for platform, result in report.items():
+            UPLOADS.inc(platform=platform, status=result["status"])
+            # Platforms uploaded by an earlier run took no time in this one
+            if result["attempts"]:
+                UPLOAD_SECONDS.observe(result["seconds"], platform=platform)
+        with self.__reports_lock:
+            self.reports[video.video_id] = report
+        summary = ", ".join(
+            f"{platform}: {result['status']}" for platform, result in report.items()
+        )
+        logger.debug(f"Video {video.video_id} upload report: {summary}")
+        uploaded = all(result["status"] == "uploaded" for result in report.values())
+        if video.manifest:
+            # Failed jobs are resumed later and only retry the missing platforms
+            video.manifest.set_status("done" if uploaded else "failed")
+            video.manifest.release()
+        if uploaded and video.workspace:
+            video.workspace.cleanup()
+        if self.__on_report:
+            self.__on_report(video, report)
+
+    def __publish_(self, platform: str, publish: Callable, video: FinishedVideo):
+        start = time.monotonic()
+        error = None
+        stage = f"upload:{platform}"
+        stage_inputs = None
+        if video.manifest:
+            stage_inputs = {
+                "render": video.manifest.stage_key("render"),
+                "caption": video.caption,
+            }
+            if video.manifest.is_complete(stage, stage_inputs):
+                logger.debug(
+                    f"Video {video.video_id} was already uploaded to {platform}"
+                )
+                return {
+                    "status": "uploaded",
+                    "attempts": 0,
+                    "seconds": 0,
+                    "error": None,
+                    "details": video.manifest.stage(stage)["result"].get("details"),
+                }
+        for attempt in range(1, self.__max_attempts + 1):
+            try:
+                logger.debug(
+                    f"Uploading video {video.video_id} to {platform}, attempt {attempt}..."
+                )
+                details = publish(video)
+                if video.manifest:
+                    video.manifest.complete_stage(
+                        stage,
+                        stage_inputs,
+                        {"details": details},
+                        elapsed=time.monotonic() - start,
+                    )
+                return {
+                    "status": "uploaded",
+                    "attempts": attempt,
+                    "seconds": round(time.monotonic() - start, 2),
+                    "error": None,
+                    "details": details,
+                }
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                logger.debug(
+                    f"Upload of video {video.video_id} to {platform} failed: {error}"
+                )
+                if attempt < self.__max_attempts:
+                    time.sleep(self.__retry_delay * 2 ** (attempt - 1))
+        return {
+            "status": "failed",
+            "attempts": self.__max_attempts,
+            "seconds": round(time.monotonic() - start, 2),
+            "error": error,
+            "details": None,
+        }
@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from pipeline import JobManifest, atomic_replace
+
+logger = logging.getLogger("RedditContentFarmer.workspace")
+
+# Scratch folders are named after their job so a resumed job finds its files
+SCRATCH_PREFIX = "rcf-"
+
+
+def scratch_prefix(jobs_dir: str) -> str:
+    """
+    Get the prefix of the scratch folders of a jobs folder, so workers of other
+    checkouts on the same host never touch each other's scratch folders\n
+    :param jobs_dir: Folder containing a folder per job
+    """
+    digest = hashlib.sha256(os.path.abspath(jobs_dir).encode("utf-8")).hexdigest()
+    return f"{SCRATCH_PREFIX}{digest[:8]}-"
+
+
+def default_scratch_root(min_free_bytes: int = 512 * 1024 * 1024) -> str:
+    """
+    Get a RAM-backed folder to keep intermediate files in, or None if there is none with enough space\n
+    :param min_free_bytes: Free space the folder must have
+    """
+    root = "/dev/shm"
+    if not os.path.isdir(root) or not os.access(root, os.W_OK):
+        return None
+    if shutil.disk_usage(root).free < min_free_bytes:
+        logger.debug(f"Not enough free space in {root}, using the job folders")
+        return None
+    return root
+
+
+class Workspace:
+    """
+    Folder of a single job, with a scratch folder for its intermediate files
+    """
+
+    def __init__(self, job_dir: str, scratch_root: str = None):
+        """
+        Create the job folder and its scratch folder\n
+        :param job_dir: Durable folder the final files of the job are published to
+        :param scratch_root: Folder to create the scratch folder in, e.g. `/dev/shm`,
+            intermediate files are kept in the job folder if not set
+        """
+        self.job_dir = job_dir
+        self.job_id = os.path.basename(os.path.normpath(job_dir))
+        if scratch_root:
+            prefix = scratch_prefix(os.path.dirname(os.path.abspath(job_dir)))
+            self.scratch_dir = os.path.join(scratch_root, prefix + self.job_id)
+        else:
+            self.scratch_dir = job_dir
+        self.__scratch_files = set()
+        self.__lock = threading.Lock()
+        for directory in (self.job_dir, self.scratch_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+    @property
+    def has_separate_scratch(self) -> bool:
+        return os.path.abspath(self.scratch_dir) != os.path.abspath(self.job_dir)
+
+    def path(self, name: str) -> str:
+        """
+        Get the path of a final file in the job folder\n
+        :param name: File name
+        """
+        return os.path.join(self.job_dir, name)
+
+    def scratch(self, name: str) -> str:
+        """
+        Get the path of an intermediate file, which is deleted on cleanup\n
+        :param name: File name
+        """
+        with self.__lock:
+            self.__scratch_files.add(name)
+        return os.path.join(self.scratch_dir, name)
+
+    def publish(self, name: str, destination: str = None) -> str:
+        """
+        Move a finished file from the scratch folder to the job folder atomically,
+        so the job folder never holds a partially written file\n
+        :param name: File name in the scratch folder
+        :param destination: File name in the job folder, the same name if not set
+        :return: Path of the published file
+        """
+        source = os.path.join(self.scratch_dir, name)
+        target = self.path(destination or name)
+        if os.path.abspath(source) != os.path.abspath(target):
+            try:
+                os.replace(source, target)
+            except OSError:
+                # The scratch folder is on another filesystem, so the file is
+                # copied next to the target first and then renamed over it
+                with atomic_replace(target) as temp_path:
+                    shutil.copyfile(source, temp_path)
+                os.remove(source)
+        with self.__lock:
+            self.__scratch_files.discard(name)
+        return target
+
+    def cleanup(self):
+        """
+        Delete the intermediate files of the job, the published files are kept
+        """
+        if self.has_separate_scratch:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        else:
+            with self.__lock:
+                names = list(self.__scratch_files)
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.scratch_dir, name))
+                except FileNotFoundError:
+                    pass
+        with self.__lock:
+            self.__scratch_files = set()
+        logger.debug(f"Cleaned up workspace of job {self.job_id}")
+
+    @staticmethod
+    def clean_stale(jobs_dir: str, scratch_root: str) -> int:
+        """
+        Delete the scratch folders of this jobs folder's jobs that are finished or
+        abandoned, or whose manifest is gone and that no process has open\n
+        :param jobs_dir: Folder containing a folder per job
+        :param scratch_root: Folder the scratch folders were created in
+        :return: Number of scratch folders deleted
+        """
+        if not scratch_root or not os.path.isdir(scratch_root):
+            return 0
+        prefix = scratch_prefix(jobs_dir)
+        removed = 0
+        for name in os.listdir(scratch_root):
+            if not name.startswith(prefix):
+                continue
+            job_dir = os.path.join(jobs_dir, name[len(prefix) :])
+            try:
+                with open(os.path.join(job_dir, "manifest.json"), "r") as file:
+                    status = json.load(file)["status"]
+            except (FileNotFoundError, ValueError, KeyError):
+                status = None
+            if status is None and JobManifest.is_claimed(job_dir):
+                continue
+            # Unfinished jobs keep their scratch folder so they can be resumed
+            if status not in (None, "done", "abandoned"):
+                continue
+            shutil.rmtree(os.path.join(scratch_root, name), ignore_errors=True)
+            removed += 1
+        if removed:
+            logger.debug(f"Deleted {removed} stale scratch folders")
+        return removed